@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timedelta
+from services.ttl_dict import TTLDict
 
-_last_actions = {}
+# النوافذ قصيرة (ثوانٍ)؛ ما بعد 10 دقائق لا يلزم تذكّره
+_last_actions = TTLDict(ttl=600, max_size=50000)
 
 def too_soon(user_id: int, key: str, seconds: int = 2) -> bool:
     now = datetime.utcnow()
@@ -0,0 +1,110 @@
+# benchmarks/purchase_flows.py
+# -*- coding: utf-8 -*-
+"""
+قياس عدد مسارات الشراء المتزامنة التي يتحمّلها process واحد: قبل (db.py متزامن
+على خيوط مثل عمّال telebot) وبعد (database/async_db.py على حلقة أحداث واحدة).
+
+مسار الشراء المُحاكى (بدون أثر مالي):
+    get_available_balance -> create_hold -> release_hold
+
+التشغيل:
+    BENCH_USER_ID=123 python -m benchmarks.purchase_flows --flows 200 --concurrency 4 16 64
+
+ملاحظة: يكتب holds حقيقية ثم يحررها فورًا؛ استخدم مستخدم اختبار.
+
+بدون شبكة (المحرك المحلي database/local_backend.py؛ المسار المتزامن فقط):
+    SUPABASE_BACKEND=memory python -m benchmarks.purchase_flows --flows 2000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from database import db
+from database import async_db
+
+BENCH_USER_ID = int(os.getenv("BENCH_USER_ID", "0") or 0)
+HOLD_AMOUNT = 1
+
+
+def _sync_flow(user_id: int) -> float:
+    t0 = time.perf_counter()
+    db.get_available_balance(user_id)
+    r = db.create_hold_rpc(user_id, HOLD_AMOUNT, str(uuid.uuid4()), 60)
+    if r.data:
+        db.release_hold_rpc(str(r.data))
+    return time.perf_counter() - t0
+
+
+async def _async_flow(user_id: int) -> float:
+    t0 = time.perf_counter()
+    await async_db.aget_available_balance(user_id)
+    r = await async_db.acreate_hold_rpc(user_id, HOLD_AMOUNT, str(uuid.uuid4()), 60)
+    if r.data:
+        await async_db.arelease_hold_rpc(str(r.data))
+    return time.perf_counter() - t0
+
+
+def bench_sync(flows: int, concurrency: int, user_id: int):
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        lat = list(ex.map(lambda _: _sync_flow(user_id), range(flows)))
+    return time.perf_counter() - t0, lat
+
+
+async def _bench_async(flows: int, concurrency: int, user_id: int):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with sem:
+            return await _async_flow(user_id)
+
+    t0 = time.perf_counter()
+    lat = await asyncio.gather(*(one() for _ in range(flows)))
+    elapsed = time.perf_counter() - t0
+    await async_db.aclose()
+    return elapsed, list(lat)
+
+
+def bench_async(flows: int, concurrency: int, user_id: int):
+    return asyncio.run(_bench_async(flows, concurrency, user_id))
+
+
+def _report(label: str, concurrency: int, flows: int, elapsed: float, lat):
+    lat = sorted(lat)
+    p50 = statistics.median(lat) * 1000
+    p95 = lat[max(0, int(len(lat) * 0.95) - 1)] * 1000
+    print(f"{label:<6} c={concurrency:<4} flows={flows:<5} "
+          f"{flows / elapsed:8.1f} flows/s  p50={p50:7.1f}ms  p95={p95:7.1f}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="sync vs async purchase-flow throughput")
+    ap.add_argument("--flows", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[2, 8, 32, 64])
+    ap.add_argument("--user-id", type=int, default=BENCH_USER_ID)
+    args = ap.parse_args()
+    if db.USE_LOCAL_BACKEND:
+        # مستخدم اختبار برصيد كافٍ داخل المحرك المحلي
+        args.user_id = args.user_id or 1
+        db.ensure_user(args.user_id, "bench", default_balance=10 ** 9)
+    if not args.user_id:
+        raise SystemExit("BENCH_USER_ID (or --user-id) is required")
+
+    for c in args.concurrency:
+        elapsed, lat = bench_sync(args.flows, c, args.user_id)
+        _report("sync", c, args.flows, elapsed, lat)
+        if db.USE_LOCAL_BACKEND:
+            continue
+        elapsed, lat = bench_async(args.flows, c, args.user_id)
+        _report("async", c, args.flows, elapsed, lat)
+
+
+if __name__ == "__main__":
+    main()
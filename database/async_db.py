@@ -0,0 +1,248 @@
+# database/async_db.py
+# -*- coding: utf-8 -*-
+"""
+نسخة asyncio موازية لـ database/db.py.
+
+- نفس المتغيرات (SUPABASE_URL / SUPABASE_KEY / DEFAULT_TABLE) ونفس أسماء الدوال مع بادئة a.
+- عميل httpx.AsyncClient واحد مشترك (pool) لكل حلقة أحداث؛ لا نفتح اتصالًا لكل طلب.
+- كل طلب يمر بنفس قاطع الدائرة وسياسة إعادة المحاولة وإحصاءات الاستعلامات في db.py
+  (القراءات والكتابات المتكررة الأثر تُعاد عند أخطاء الشبكة و 429/5xx؛ RPC الرصيد لا تُعاد
+  إلا إذا فشل الاتصال قبل الإرسال)، والكتابات (جداول و RPC مثل create_hold/try_deduct)
+  تُبطل كاش المستخدمين وترفع حقب الدمج كما في الجلسة المتزامنة،
+  فلا تخدم get_wallet/get_available_balance رصيدًا قديمًا بعد كتابة من هنا.
+- الهاندلرز المتزامنة (telebot) تستطيع الانتقال تدريجيًا عبر run_sync()/submit()
+  اللتين تنفّذان الـ coroutine على حلقة خلفية واحدة بدل حجز خيط العامل.
+
+مثال:
+    from database.async_db import aget_table, run_sync
+    res = run_sync(aget_table("features").select("key").limit(1).execute())
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from typing import Any, Dict, Optional
+
+import httpx
+from postgrest import AsyncPostgrestClient
+
+from database import query_stats
+from database.db import (
+    SUPABASE_URL, SUPABASE_KEY, DEFAULT_TABLE, RETRY_ATTEMPTS,
+    _IDEMPOTENT, _PRE_SEND_ERRORS, _RETRY_STATUS, _backoff, _breaker, _bump_epoch, _retry_stats,
+    _table_of, _users_write_begin, _users_write_end,
+)
+
+# ---------- إعداد الـ pool ----------
+ASYNC_MAX_CONNECTIONS = int(os.getenv("SUPABASE_ASYNC_MAX_CONNECTIONS", "50"))
+ASYNC_MAX_KEEPALIVE = int(os.getenv("SUPABASE_ASYNC_MAX_KEEPALIVE", "20"))
+ASYNC_TIMEOUT = float(os.getenv("SUPABASE_ASYNC_TIMEOUT", "30"))
+
+_REST_URL = f"{(SUPABASE_URL or '').rstrip('/')}/rest/v1"
+_HEADERS = {
+    "apiKey": SUPABASE_KEY,
+    "Authorization": f"Bearer {SUPABASE_KEY}",
+}
+
+# عميل لكل حلقة أحداث: httpx.AsyncClient مربوط بالحلقة التي فتح فيها اتصالاته
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncPostgrestClient]" = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+class _AsyncPostgrestSession(httpx.AsyncClient):
+    """مرآة db._PostgrestSession: قاطع + إعادة محاولة + query_stats، وخطافات الكتابة (كاش المستخدمين/الحقب)."""
+
+    async def request(self, method, url, **kwargs):
+        if str(url).startswith("http"):
+            return await super().request(method, url, **kwargs)
+        name = _table_of(url)
+        if method.upper() in ("GET", "HEAD"):
+            return await self._resilient(method, url, name, kwargs)
+        ctx = _users_write_begin(method, name, kwargs)
+        r = None
+        try:
+            r = await self._resilient(method, url, name, kwargs)
+            return r
+        finally:
+            _bump_epoch(url)
+            if ctx is not None:
+                _users_write_end(ctx, r)
+
+    async def _resilient(self, method, url, name, kwargs):
+        # نفس سياسة db._PostgrestSession._resilient مع asyncio.sleep بدل time.sleep
+        breaker = _breaker(name)
+        headers = httpx.Headers(kwargs.get("headers") or {})
+        m = method.upper()
+        idempotent = m in _IDEMPOTENT or (m == "POST" and not name.startswith("rpc/")
+                                          and "resolution=" in headers.get("prefer", ""))
+        attempt = 0
+        while True:
+            breaker.before()
+            try:
+                r = await self._timed(method, url, name, kwargs)
+            except httpx.TransportError as e:
+                breaker.failure()
+                retryable = idempotent or isinstance(e, _PRE_SEND_ERRORS)
+                if not retryable or attempt >= RETRY_ATTEMPTS - 1:
+                    _retry_stats["gave_up"] += 1
+                    e._db_retried = True
+                    raise
+            else:
+                if r.status_code not in _RETRY_STATUS:
+                    breaker.success()
+                    return r
+                breaker.failure()
+                if not idempotent or attempt >= RETRY_ATTEMPTS - 1:
+                    return r
+            _retry_stats["retries"] += 1
+            await asyncio.sleep(_backoff(attempt))
+            attempt += 1
+
+    async def _timed(self, method, url, name, kwargs):
+        headers = httpx.Headers(kwargs.get("headers") or {})
+        op = query_stats.operation_of(method, name, headers.get("prefer", ""))
+        detail = str(httpx.QueryParams(kwargs.get("params") or {}))
+        t0 = time.perf_counter()
+        try:
+            r = await super().request(method, url, **kwargs)
+        except Exception as e:
+            query_stats.record(name, op, time.perf_counter() - t0, error=True, detail=f"{detail} {e}")
+            raise
+        query_stats.record(
+            name, op, time.perf_counter() - t0,
+            rows=query_stats.rows_of(r), nbytes=len(r.content or b""),
+            error=not r.is_success, detail=detail,
+        )
+        return r
+
+
+def _new_http_client() -> httpx.AsyncClient:
+    return _AsyncPostgrestSession(
+        limits=httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_MAX_KEEPALIVE,
+        ),
+        timeout=httpx.Timeout(ASYNC_TIMEOUT),
+        follow_redirects=True,
+    )
+
+
+def aclient() -> AsyncPostgrestClient:
+    """أرجِع عميل PostgREST غير المتزامن الخاص بحلقة الأحداث الحالية (يُنشأ مرة واحدة)."""
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        cli = _clients.get(loop)
+        if cli is None:
+            cli = AsyncPostgrestClient(_REST_URL, headers=dict(_HEADERS), http_client=_new_http_client())
+            _clients[loop] = cli
+        return cli
+
+
+# ---------- دوال أساسية (مرآة db.py) ----------
+def aget_table(table_name: Optional[str] = None):
+    """
+    مثل get_table لكن يرجع builder غير متزامن: await aget_table("x").select("*").execute()
+    يجب استدعاؤها من داخل حلقة أحداث.
+    """
+    name = (table_name or DEFAULT_TABLE)
+    if not name:
+        raise RuntimeError("No table name provided and SUPABASE_TABLE_NAME is not set.")
+    return aclient().from_(name)
+
+
+def atable(table_name: Optional[str] = None):
+    """بديل مريح لـ aget_table."""
+    return aget_table(table_name)
+
+
+async def arpc(fn: str, params: Optional[Dict[str, Any]] = None):
+    """ينفّذ دالة Postgres (RPC) ويرجع Response."""
+    return await aclient().rpc(fn, params or {}).execute()
+
+
+async def aget_user_by_id(user_id: int):
+    return await aget_table(DEFAULT_TABLE).select("*").eq("user_id", user_id).limit(1).execute()
+
+
+async def aget_wallet(user_id: int):
+    return await aget_table(DEFAULT_TABLE).select("balance, held").eq("user_id", user_id).limit(1).execute()
+
+
+async def aget_available_balance(user_id: int) -> int:
+    """المتاح = balance - held (0 إذا لا يوجد سجل)."""
+    res = await aget_wallet(user_id)
+    if not res.data:
+        return 0
+    balance = int(res.data[0].get("balance") or 0)
+    held = int(res.data[0].get("held") or 0)
+    return balance - held
+
+
+# ---------- واجهات RPC الذرّية ----------
+async def acreate_hold_rpc(user_id: int, amount: int, order_id: Optional[str] = None, ttl_seconds: Optional[int] = 900):
+    params: Dict[str, Any] = {
+        "p_user_id": user_id,
+        "p_amount": amount,
+        "p_order_id": order_id,
+        "p_ttl_seconds": ttl_seconds,
+    }
+    return await arpc("create_hold", params)
+
+
+async def acapture_hold_rpc(hold_id: str):
+    return await arpc("capture_hold", {"p_hold_id": hold_id})
+
+
+async def arelease_hold_rpc(hold_id: str):
+    return await arpc("release_hold", {"p_hold_id": hold_id})
+
+
+async def atransfer_amount_rpc(from_user: int, to_user: int, amount: int):
+    params = {"p_from_user": from_user, "p_to_user": to_user, "p_amount": amount}
+    return await arpc("transfer_amount", params)
+
+
+async def atry_deduct_rpc(user_id: int, amount: int):
+    params = {"p_user_id": user_id, "p_amount": amount}
+    return await arpc("try_deduct", params)
+
+
+# ---------- جسر للكود المتزامن ----------
+# حلقة أحداث واحدة في خيط خلفي؛ الخيوط المتزامنة ترسل لها الـ coroutines.
+_bg_loop: Optional[asyncio.AbstractEventLoop] = None
+_bg_lock = threading.Lock()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _bg_loop
+    with _bg_lock:
+        if _bg_loop is None:
+            loop = asyncio.new_event_loop()
+            t = threading.Thread(target=loop.run_forever, name="supabase-async", daemon=True)
+            t.start()
+            _bg_loop = loop
+        return _bg_loop
+
+
+def submit(coro) -> Future:
+    """يرسل coroutine للحلقة الخلفية ويرجع concurrent.futures.Future (بدون انتظار)."""
+    return asyncio.run_coroutine_threadsafe(coro, _background_loop())
+
+
+def run_sync(coro, timeout: Optional[float] = None):
+    """ينفّذ coroutine من كود متزامن ويرجع النتيجة (ينتظر حتى timeout)."""
+    return submit(coro).result(timeout)
+
+
+async def aclose() -> None:
+    """يغلق عميل الحلقة الحالية (عند الإيقاف)."""
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        cli = _clients.pop(loop, None)
+    if cli is not None:
+        await cli.aclose()
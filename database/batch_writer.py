@@ -0,0 +1,247 @@
+# database/batch_writer.py
+# -*- coding: utf-8 -*-
+"""
+كاتب مؤجَّل (write-behind) للجداول الإلحاقية فقط (append-only):
+transactions / purchases / *_purchases / discount_uses / admin_ledger.
+
+- الصفوف تُجمَّع لكل جدول وتُكتب كـ insert متعدد الصفوف عند بلوغ
+  WRITE_BEHIND_MAX_ROWS صفًا أو مرور WRITE_BEHIND_MAX_DELAY ثانية على أقدم صف.
+- الديمومة:
+    async  (افتراضي) — fire-and-forget: المنادي لا ينتظر؛ الأخطاء تُسجَّل فقط.
+    commit — flush-on-commit: المنادي ينتظر حتى تُكتب الدفعة التي فيها صفّه
+             (group commit: عدة منادين متزامنين يتشاركون رحلة واحدة) وتُرفع الأخطاء.
+             صف commit يوقظ خيط الكتابة فورًا، فلا ينتظر مؤقّت WRITE_BEHIND_MAX_DELAY.
+- عند رفض الخادم للدفعة (APIError) نعيد المحاولة صفًا صفًا حتى لا يُسقط صف سيئ الدفعة كلها.
+  أخطاء النقل بعد الإرسال (ReadTimeout/ReadError...) لا تُعاد: ربما كُتبت الدفعة فعلًا،
+  والإعادة تكرر الصفوف — تُعلَّم الإيصالات فاشلة وتُسجَّل فقط.
+- السجلات المالية (transactions / admin_ledger) تُكتب بـ durability="commit" من مناديها.
+- drain عند الإيقاف عبر atexit و shutdown() (main.py يستدعيها قبل إعادة التشغيل).
+- WRITE_BEHIND_ENABLED=0 يعيد السلوك القديم (insert مباشر متزامن).
+"""
+
+from __future__ import annotations
+
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from postgrest.exceptions import APIError
+
+from database.db import get_table
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "1") == "1"
+WRITE_BEHIND_DURABILITY = (os.getenv("WRITE_BEHIND_DURABILITY", "async") or "async").lower()
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "50"))
+WRITE_BEHIND_MAX_DELAY = float(os.getenv("WRITE_BEHIND_MAX_DELAY", "0.5"))
+
+
+class Ticket:
+    """إيصال صف مُدرج في الطابور؛ wait() ينتظر كتابته ويرفع خطأه إن فشل."""
+
+    __slots__ = ("_event", "error")
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.error: Optional[BaseException] = None
+
+    def _done(self, error: Optional[BaseException] = None) -> None:
+        self.error = error
+        self._event.set()
+
+    @property
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        if not self._event.wait(timeout):
+            raise TimeoutError("write-behind flush timed out")
+        if self.error is not None:
+            raise self.error
+
+
+class BatchWriter:
+    def __init__(self, max_rows: int = WRITE_BEHIND_MAX_ROWS, max_delay: float = WRITE_BEHIND_MAX_DELAY):
+        self.max_rows = max(1, int(max_rows))
+        self.max_delay = max(0.0, float(max_delay))
+        self._cond = threading.Condition()
+        self._buf: Dict[str, List[Tuple[Dict[str, Any], Ticket]]] = {}
+        self._since: Dict[str, float] = {}
+        self._urgent: set = set()  # جداول فيها صف commit ينتظره منادٍ
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self._stats = {"enqueued": 0, "batches": 0, "rows_written": 0, "failed_rows": 0, "max_batch": 0}
+
+    # ---------- واجهة ----------
+    def add(self, table_name: str, row: Dict[str, Any], urgent: bool = False) -> Ticket:
+        ticket = Ticket()
+        with self._cond:
+            stopped = self._stopped
+            if not stopped:
+                self._enqueue(table_name, row, ticket, urgent)
+        if stopped:
+            # بعد الإيقاف: كتابة مباشرة بدل الضياع
+            self._write(table_name, [(row, ticket)])
+        return ticket
+
+    def _enqueue(self, table_name: str, row: Dict[str, Any], ticket: Ticket, urgent: bool = False) -> None:
+        # يُستدعى والقفل ممسوك
+        self._ensure_thread()
+        items = self._buf.setdefault(table_name, [])
+        if not items:
+            self._since[table_name] = time.monotonic()
+        items.append((row, ticket))
+        self._stats["enqueued"] += 1
+        if urgent:
+            self._urgent.add(table_name)
+        if urgent or len(items) >= self.max_rows:
+            self._cond.notify()
+
+    def flush(self, table_name: Optional[str] = None) -> None:
+        """يكتب المعلّق فورًا (جدول واحد أو الكل) في خيط المنادي."""
+        with self._cond:
+            names = [table_name] if table_name else list(self._buf.keys())
+            batches = [(n, self._take(n)) for n in names]
+        for name, items in batches:
+            if items:
+                self._write(name, items)
+
+    def shutdown(self, timeout: float = 10.0) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        t = self._thread
+        if t is not None and t.is_alive():
+            t.join(timeout)
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            out = dict(self._stats)
+            out["pending"] = sum(len(v) for v in self._buf.values())
+            return out
+
+    # ---------- داخلي ----------
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _take(self, name: str) -> List[Tuple[Dict[str, Any], Ticket]]:
+        self._since.pop(name, None)
+        self._urgent.discard(name)
+        return self._buf.pop(name, [])
+
+    def _due(self) -> Tuple[List[str], Optional[float]]:
+        now = time.monotonic()
+        due, wait = [], None
+        for name, items in self._buf.items():
+            if not items:
+                continue
+            left = self._since.get(name, now) + self.max_delay - now
+            if len(items) >= self.max_rows or left <= 0 or name in self._urgent:
+                due.append(name)
+            elif wait is None or left < wait:
+                wait = left
+        return due, wait
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                due, wait = self._due()
+                while not due and not self._stopped:
+                    self._cond.wait(wait)
+                    due, wait = self._due()
+                if self._stopped and not due:
+                    return
+                batches = [(n, self._take(n)) for n in due]
+            for name, items in batches:
+                try:
+                    self._write(name, items)
+                except Exception:
+                    logging.exception("[write-behind] flush loop error on %s", name)
+
+    def _write(self, table_name: str, items: List[Tuple[Dict[str, Any], Ticket]]) -> None:
+        # PostgREST يتطلب نفس المفاتيح في كل صفوف insert الجماعي
+        groups: Dict[Tuple[str, ...], List[Tuple[Dict[str, Any], Ticket]]] = {}
+        for row, ticket in items:
+            groups.setdefault(tuple(sorted(row.keys())), []).append((row, ticket))
+
+        for group in groups.values():
+            rows = [r for r, _ in group]
+            try:
+                get_table(table_name).insert(rows).execute()
+                self._count(len(rows), 0)
+                for _, ticket in group:
+                    ticket._done()
+                continue
+            except APIError as e:
+                if len(group) == 1:
+                    logging.warning("[write-behind] insert into %s failed: %s", table_name, e)
+                    self._count(0, 1)
+                    group[0][1]._done(e)
+                    continue
+                logging.warning("[write-behind] batch insert into %s failed (%s rows), retrying row by row: %s",
+                                table_name, len(rows), e)
+            except Exception as e:
+                # لا نعرف إن كانت الدفعة كُتبت: لا إعادة إدراج (تفادي صفوف مكررة)
+                logging.error("[write-behind] batch insert into %s failed (%s rows, not retried): %s",
+                              table_name, len(rows), e)
+                self._count(0, len(group))
+                for _, ticket in group:
+                    ticket._done(e)
+                continue
+            for row, ticket in group:
+                try:
+                    get_table(table_name).insert(row).execute()
+                    self._count(1, 0)
+                    ticket._done()
+                except Exception as e:
+                    logging.warning("[write-behind] insert into %s failed: %s", table_name, e)
+                    self._count(0, 1)
+                    ticket._done(e)
+
+    def _count(self, written: int, failed: int) -> None:
+        with self._cond:
+            if written:
+                self._stats["batches"] += 1
+                self._stats["rows_written"] += written
+                self._stats["max_batch"] = max(self._stats["max_batch"], written)
+            self._stats["failed_rows"] += failed
+
+
+_writer = BatchWriter()
+
+
+def insert_row(table_name: str, row: Dict[str, Any], durability: Optional[str] = None) -> Optional[Ticket]:
+    """
+    يدرج صفًا في جدول إلحاقي عبر الكاتب المؤجّل.
+    durability: None (حسب WRITE_BEHIND_DURABILITY) / "async" / "commit".
+    في وضع commit ينتظر الكتابة ويرفع الخطأ مثل insert().execute() المباشر.
+    """
+    if not WRITE_BEHIND_ENABLED:
+        get_table(table_name).insert(row).execute()
+        return None
+    commit = (durability or WRITE_BEHIND_DURABILITY) == "commit"
+    ticket = _writer.add(table_name, row, urgent=commit)
+    if commit:
+        ticket.wait()
+    return ticket
+
+
+def flush(table_name: Optional[str] = None) -> None:
+    _writer.flush(table_name)
+
+
+def shutdown(timeout: float = 10.0) -> None:
+    """يفرّغ كل المعلّق ويوقف خيط الكتابة (يُستدعى عند الإيقاف/إعادة التشغيل)."""
+    _writer.shutdown(timeout)
+
+
+def stats() -> Dict[str, Any]:
+    return _writer.stats()
+
+
+atexit.register(shutdown)
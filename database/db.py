@@ -1,8 +1,19 @@
 # database/db.py
+import logging
 import os
-from typing import Optional, Any, Dict
+import random
+import threading
+import time
+from typing import Optional, Any, Dict, Tuple
+import httpx
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from postgrest import SyncPostgrestClient
+
+from postgrest import APIResponse
+
+from database.single_flight import SingleFlight
+from database.user_cache import UserCache
+from database import query_stats
 
 # حمّل متغيرات البيئة من .env عند التشغيل المحلي
 load_dotenv()
@@ -18,17 +29,535 @@ DEFAULT_TABLE = os.getenv("SUPABASE_TABLE_NAME", "USERS_TABLE")
 if DEFAULT_TABLE == "USERS_TABLE":
     DEFAULT_TABLE = "houssin363"
 
-if not SUPABASE_URL:
-    raise RuntimeError("Missing SUPABASE_URL in environment (.env)")
-if not SUPABASE_KEY:
-    raise RuntimeError("Missing SUPABASE_KEY (or SUPABASE_API_KEY) in environment (.env)")
-if not SUPABASE_URL.startswith("http"):
-    raise RuntimeError("SUPABASE_URL must start with http/https")
+# supabase (افتراضي) | memory | sqlite — الأخيران محرك محلي بدون شبكة (database/local_backend.py)
+# لقياس الأداء والتجارب؛ sqlite يحفظ الصفوف في LOCAL_DB_PATH.
+SUPABASE_BACKEND = (os.getenv("SUPABASE_BACKEND", "supabase") or "supabase").lower()
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH", "local_supabase.db")
+USE_LOCAL_BACKEND = SUPABASE_BACKEND in ("memory", "sqlite")
+
+if not USE_LOCAL_BACKEND:
+    if not SUPABASE_URL:
+        raise RuntimeError("Missing SUPABASE_URL in environment (.env)")
+    if not SUPABASE_KEY:
+        raise RuntimeError("Missing SUPABASE_KEY (or SUPABASE_API_KEY) in environment (.env)")
+    if not SUPABASE_URL.startswith("http"):
+        raise RuntimeError("SUPABASE_URL must start with http/https")
+
+# ---------- دمج القراءات المتطابقة (single-flight) ----------
+# طلبات GET المتطابقة (نفس الجدول + الفلاتر + الترتيب + الحد) التي تصل أثناء
+# وجود طلب مماثل قيد التنفيذ تنتظره وتتشارك نفس الاستجابة بدل رحلة شبكة جديدة.
+# لا نكسر read-your-writes: أي كتابة على جدول ترفع "حقبة" ذلك الجدول، و RPC ترفع حقب
+# الجداول التي تكتبها (_RPC_WRITES) أو حقبة عامة إن لم تكن معروفة؛ فالقراءة بعد الكتابة
+# لا تنضم لقراءة بدأت قبلها.
+COALESCE_READS = os.getenv("SUPABASE_COALESCE_READS", "1") == "1"
+
+_reads = SingleFlight()
+_epoch_lock = threading.Lock()
+_write_epoch: Dict[str, int] = {}
+_rpc_epoch = 0
+
+_KEY_HEADERS = ("accept", "range", "prefer", "accept-profile")
+
+
+def _table_of(url) -> str:
+    """"/houssin363" -> "houssin363" ، "/rpc/try_deduct" -> "rpc/try_deduct"."""
+    parts = str(url).split("?", 1)[0].strip("/").split("/")
+    if len(parts) >= 2 and parts[-2] == "rpc":
+        return "rpc/" + parts[-1]
+    return parts[-1]
+
+
+# الجداول التي تكتبها كل RPC (() = قراءة فقط). RPC غير مذكورة ترفع الحقبة العامة احتياطًا.
+_RPC_WRITES: Dict[str, Tuple[str, ...]] = {
+    "create_hold": (DEFAULT_TABLE, "holds"),
+    "capture_hold": (DEFAULT_TABLE, "holds"),
+    "release_hold": (DEFAULT_TABLE, "holds"),
+    "try_deduct": (DEFAULT_TABLE,),
+    "transfer_amount": (DEFAULT_TABLE,),
+    "wallet_snapshot": (DEFAULT_TABLE,),
+    "available_team_numbers": (),
+    "get_team_join_code": (),
+    "reserve_team_slot": ("tournament_entries",),
+    "state_set_keys": ("user_state",),
+    "state_del_keys": ("user_state",),
+    "state_touch": ("user_state",),
+    "purge_expired_state": ("user_state",),
+    "claim_pending_request": ("pending_requests",),
+    "release_pending_request": ("pending_requests",),
+    "postpone_pending_request": ("pending_requests",),
+    "patch_pending_payload": ("pending_requests",),
+    "rollup_queue_events": ("queue_events", "queue_stats_hourly", "queue_rollup_state"),
+}
+
+
+def _bump_epoch(url) -> None:
+    global _rpc_epoch
+    name = _table_of(url)
+    with _epoch_lock:
+        if name.startswith("rpc/"):
+            tables = _RPC_WRITES.get(name[4:])
+            if tables is None:
+                _rpc_epoch += 1
+            for t in tables or ():
+                _write_epoch[t] = _write_epoch.get(t, 0) + 1
+        else:
+            _write_epoch[name] = _write_epoch.get(name, 0) + 1
+
+
+# ---------- سياسة موحّدة لإعادة المحاولة + قاطع دائرة لكل endpoint ----------
+# - إعادة المحاولة بتأخير أُسّي مع jitter كامل عند أخطاء الشبكة و 429/5xx.
+# - الطلبات غير المتكررة الأثر (insert عادي/RPC) لا تُعاد إلا إذا فشل الاتصال قبل الإرسال.
+# - بعد SUPABASE_BREAKER_THRESHOLD فشلًا متتاليًا على نفس الجدول/الدالة يُفتح القاطع
+#   لمدة SUPABASE_BREAKER_COOLDOWN ثانية: الطلبات ترفض فورًا بـ SupabaseUnavailable
+#   بدل أن تنام الخيوط في backoff؛ بعدها طلب تجريبي واحد (half-open) يقرر الإغلاق.
+RETRY_ATTEMPTS = int(os.getenv("SUPABASE_RETRIES", "3"))
+RETRY_BASE = float(os.getenv("SUPABASE_RETRY_BASE", "0.2"))
+RETRY_CAP = float(os.getenv("SUPABASE_RETRY_CAP", "2.0"))
+BREAKER_THRESHOLD = int(os.getenv("SUPABASE_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("SUPABASE_BREAKER_COOLDOWN", "15"))
+
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+_IDEMPOTENT = {"GET", "HEAD", "OPTIONS", "PUT", "PATCH", "DELETE"}
+_PRE_SEND_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class SupabaseUnavailable(RuntimeError):
+    """القاطع مفتوح: Supabase متعثر على هذا الـ endpoint — رفض فوري بلا رحلة شبكة."""
+
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f"Supabase circuit open for {endpoint} (retry in {retry_in:.1f}s)")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._probe = False
+        self._lock = threading.Lock()
+
+    def before(self) -> None:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            left = self.opened_at + self.cooldown - time.monotonic()
+            if self.state == self.OPEN and left <= 0:
+                self.state = self.HALF_OPEN
+                self._probe = False
+            if self.state == self.HALF_OPEN and not self._probe:
+                self._probe = True  # طلب تجريبي واحد فقط
+                return
+            self.rejected += 1
+            raise SupabaseUnavailable(self.name, max(0.0, left))
+
+    def success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info("[db-breaker] %s closed", self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                    logging.warning("[db-breaker] %s open for %.0fs after %d failures",
+                                    self.name, self.cooldown, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probe = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            left = self.opened_at + self.cooldown - time.monotonic() if self.state == self.OPEN else 0.0
+            return {"state": self.state, "failures": self.failures, "trips": self.trips,
+                    "rejected": self.rejected, "retry_in": round(max(0.0, left), 1)}
+
+
+# ---------- pool HTTP مشترك (PostgREST + RPC) ----------
+# - الحجم على قدر عمّال معالجة التحديثات (مسارات المحادثات CHAT_LANES في services/chat_lanes،
+#   أو BOT_NUM_THREADS إن عُطّلت) + خيوط الخلفية (الطابور، outbox، الصيانة، write-behind...).
+# - keep-alive أقصر من مهلة الخمول عند الخادم حتى لا نعيد استخدام اتصال أغلقه الطرف الآخر
+#   (مصدر ReadError/RemoteProtocolError المتكرر).
+# - مهلة لكل فئة عمليات: قراءة / كتابة / RPC، ومهلة اتصال وانتظار pool قصيرتان.
+BOT_NUM_THREADS = int(os.getenv("BOT_NUM_THREADS", "2"))
+CHAT_LANES = int(os.getenv("CHAT_LANES", str(max(BOT_NUM_THREADS, 8))))
+POOL_MAX_CONNECTIONS = int(os.getenv("SUPABASE_POOL_MAX_CONNECTIONS", str(max(BOT_NUM_THREADS, CHAT_LANES) * 2 + 8)))
+POOL_MAX_KEEPALIVE = int(os.getenv("SUPABASE_POOL_MAX_KEEPALIVE", str(POOL_MAX_CONNECTIONS)))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "20"))
+HTTP2_ENABLED = os.getenv("SUPABASE_HTTP2", "1") == "1"
+TIMEOUT_CONNECT = float(os.getenv("SUPABASE_TIMEOUT_CONNECT", "5"))
+TIMEOUT_POOL = float(os.getenv("SUPABASE_TIMEOUT_POOL", "5"))
+TIMEOUT_READ = float(os.getenv("SUPABASE_TIMEOUT_READ", "15"))
+TIMEOUT_WRITE = float(os.getenv("SUPABASE_TIMEOUT_WRITE", "30"))
+TIMEOUT_RPC = float(os.getenv("SUPABASE_TIMEOUT_RPC", "30"))
+
+_TIMEOUTS = {
+    cls: httpx.Timeout(t, connect=TIMEOUT_CONNECT, pool=TIMEOUT_POOL)
+    for cls, t in (("read", TIMEOUT_READ), ("write", TIMEOUT_WRITE), ("rpc", TIMEOUT_RPC))
+}
+
+_pool_lock = threading.Lock()
+_pool_stats = {"requests": 0, "new_connections": 0, "reused": 0, "tls_handshakes": 0, "stale_errors": 0}
+
+
+def _op_class(method: str, name: str) -> str:
+    if name.startswith("rpc/"):
+        return "rpc"
+    return "read" if method.upper() in ("GET", "HEAD") else "write"
+
+
+def pool_stats() -> Dict[str, Any]:
+    """
+    عدّادات الـ pool: requests / new_connections / reused (طلبات على اتصال قائم)
+    tls_handshakes / stale_errors (فشل على اتصال مُعاد استخدامه أغلقه الخادم).
+    """
+    with _pool_lock:
+        out = dict(_pool_stats)
+    out["reuse_ratio"] = round(out["reused"] / out["requests"], 4) if out["requests"] else 0.0
+    out.update(max_connections=POOL_MAX_CONNECTIONS, keepalive_expiry=POOL_KEEPALIVE_EXPIRY, http2=HTTP2_ENABLED)
+    return out
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+_retry_stats = {"retries": 0, "gave_up": 0}
+
 
-# عميل موحّد (Singleton)
-_supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise RuntimeError("Missing SUPABASE_URL or SUPABASE_KEY")
+def _breaker(name: str) -> CircuitBreaker:
+    b = _breakers.get(name)
+    if b is None:
+        with _breakers_lock:
+            b = _breakers.setdefault(name, CircuitBreaker(name))
+    return b
+
+
+def _backoff(attempt: int) -> float:
+    # full jitter: تشتيت الخيوط حتى لا تعود كلها معًا على قاعدة متعثرة
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * (2 ** attempt)))
+
+
+def is_transient(e: BaseException) -> bool:
+    """أخطاء تستحق إعادة المحاولة: شبكة/مهلة أو 429/5xx من PostgREST."""
+    if isinstance(e, httpx.TransportError):
+        return True
+    code = str(getattr(e, "code", "") or "")
+    return code.isdigit() and int(code) in _RETRY_STATUS
+
+
+def with_retry(op, *args, **kwargs):
+    """
+    ينفّذ op(*args, **kwargs) بنفس السياسة الموحّدة — للعمليات التي يضمن المنادي
+    أنها آمنة للتكرار (مثل insert على جدول بقيد UNIQUE). لا يعيد خطأ شبكة مرّ بسياسة
+    الجلسة (أعادته أو رفضت إعادته لأن الطلب ربما طُبّق) ولا يعيد عند فتح القاطع.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return op(*args, **kwargs)
+        except SupabaseUnavailable:
+            raise
+        except Exception as e:
+            if getattr(e, "_db_retried", False) or not is_transient(e) or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            _retry_stats["retries"] += 1
+            logging.warning("[db-retry] %s (%d/%d): %s", getattr(op, "__qualname__", op),
+                            attempt + 1, RETRY_ATTEMPTS, e)
+            time.sleep(_backoff(attempt))
+
+
+def breaker_state() -> Dict[str, Dict[str, Any]]:
+    """حالة القواطع لكل جدول/دالة (closed/open/half_open + failures/trips/rejected/retry_in)."""
+    with _breakers_lock:
+        items = list(_breakers.items())
+    return {name: b.snapshot() for name, b in items}
+
+
+def retry_stats() -> Dict[str, int]:
+    return dict(_retry_stats)
+
+
+# ---------- كاش صفوف المستخدمين (database/user_cache.py) ----------
+# القراءات عبر get_user_row/get_user_by_id/get_wallet/get_available_balance تُخدم محليًا؛
+# أي كتابة على جدول المستخدمين أو RPC رصيد تمر بالجلسة تُحدِّث الكاش أو تبطله.
+# معطّل مع المحرك المحلي (لا يمر بالجلسة ولا يحتاج كاشًا).
+USER_CACHE_ENABLED = os.getenv("USER_CACHE_ENABLED", "1") == "1" and not USE_LOCAL_BACKEND
+_users = UserCache(int(os.getenv("USER_CACHE_SIZE", "5000")), float(os.getenv("USER_CACHE_TTL", "30")))
+
+# RPC تغيّر balance/held؛ hold_id -> user_id لمعرفة صاحب capture/release
+_BALANCE_RPCS = {"create_hold", "capture_hold", "release_hold", "transfer_amount", "try_deduct", "wallet_snapshot"}
+_USER_PARAMS = ("p_user_id", "p_from_user", "p_to_user", "p_user")
+_hold_owner: "Dict[str, int]" = {}
+_HOLD_OWNER_MAX = 10000
+
+
+def _filter_user_ids(params) -> Optional[list]:
+    """user_id=eq.5 / user_id=in.(5,6) من فلاتر PostgREST؛ None = لا نعرف المستخدمين."""
+    vals = httpx.QueryParams(params or {}).get_list("user_id")
+    if len(vals) != 1:
+        return None
+    v = vals[0]
+    if v.startswith("eq."):
+        return [v[3:]]
+    if v.startswith("in.(") and v.endswith(")"):
+        return [x.strip().strip('"') for x in v[4:-1].split(",") if x.strip()]
+    return None
+
+
+def _users_write_begin(method, name, kwargs):
+    """قبل الكتابة: حدّد المستخدمين المتأثرين واحفظ أجيالهم (None = لا علاقة بالمستخدمين)."""
+    if not USER_CACHE_ENABLED:
+        return None
+    body = kwargs.get("json")
+    if name.startswith("rpc/"):
+        fn = name[4:]
+        if fn not in _BALANCE_RPCS:
+            # p_user_id في RPC الحالة/الطابور لا يعني تغيّر صف المستخدم
+            return None
+        body = body if isinstance(body, dict) else {}
+        uids = [body[k] for k in _USER_PARAMS if body.get(k) is not None]
+        if fn in ("capture_hold", "release_hold"):
+            owner = _hold_owner.get(str(body.get("p_hold_id")))
+            uids = [owner] if owner is not None else None
+        return ("rpc", fn, uids, body)
+    if name != DEFAULT_TABLE:
+        return None
+    if method.upper() == "POST":
+        rows = body if isinstance(body, list) else [body] if isinstance(body, dict) else []
+        uids = [r.get("user_id") for r in rows if isinstance(r, dict)]
+        uids = uids if uids and all(u is not None for u in uids) else None
+    else:
+        uids = _filter_user_ids(kwargs.get("params"))
+    gens = {str(u): _users.generation(u) for u in (uids or [])}
+    return ("table", name, uids, gens)
+
+
+def _users_write_end(ctx, r: Optional[httpx.Response]) -> None:
+    kind, name, uids, extra = ctx
+    if uids is None:
+        _users.clear()
+        return
+    ok = r is not None and r.is_success
+    if kind == "rpc":
+        for u in uids:
+            _users.invalidate(u)
+        if ok and name == "create_hold" and uids:
+            try:
+                hold_id = r.json()
+            except Exception:
+                hold_id = None
+            if hold_id:
+                if len(_hold_owner) >= _HOLD_OWNER_MAX:
+                    _hold_owner.pop(next(iter(_hold_owner)))
+                _hold_owner[str(hold_id)] = int(uids[0])
+        return
+    rows = []
+    if ok:
+        try:
+            data = r.json() if r.content else []
+            rows = data if isinstance(data, list) else []
+        except Exception:
+            rows = []
+    done = set()
+    if r is not None and r.request.method != "DELETE":
+        for row in rows:
+            u = str((row or {}).get("user_id"))
+            if u in extra and "balance" in row and "held" in row:
+                _users.write_through(u, row, extra[u])
+                done.add(u)
+    for u in uids:
+        if str(u) not in done:
+            _users.invalidate(u)
+
+
+def user_cache_stats() -> Dict[str, Any]:
+    return _users.stats()
+
+
+class _PostgrestSession(httpx.Client):
+    """جلسة httpx مشتركة لـ PostgREST/RPC تمر عبرها كل execute()."""
+
+    def request(self, method, url, **kwargs):
+        if str(url).startswith("http"):
+            # روابط مطلقة = auth/storage وليست PostgREST
+            return super().request(method, url, **kwargs)
+        name = _table_of(url)
+        send = lambda: self._resilient(method, url, name, kwargs)
+        if method.upper() != "GET":
+            ctx = _users_write_begin(method, name, kwargs) if method.upper() != "HEAD" else None
+            r = None
+            try:
+                r = send()
+                return r
+            finally:
+                if method.upper() != "HEAD":
+                    _bump_epoch(url)
+                if ctx is not None:
+                    _users_write_end(ctx, r)
+        if not COALESCE_READS:
+            return send()
+        headers = httpx.Headers(kwargs.get("headers") or {})
+        with _epoch_lock:
+            epoch = (_write_epoch.get(name, 0), _rpc_epoch)
+        key = (
+            str(url),
+            str(httpx.QueryParams(kwargs.get("params") or {})),
+            tuple(headers.get(h, "") for h in _KEY_HEADERS),
+            epoch,
+        )
+        return _reads.do(key, send)
+
+    def _resilient(self, method, url, name, kwargs):
+        breaker = _breaker(name)
+        headers = httpx.Headers(kwargs.get("headers") or {})
+        m = method.upper()
+        idempotent = m in _IDEMPOTENT or (m == "POST" and not name.startswith("rpc/")
+                                          and "resolution=" in headers.get("prefer", ""))
+        attempt = 0
+        while True:
+            breaker.before()
+            try:
+                r = self._timed(method, url, name, kwargs)
+            except httpx.TransportError as e:
+                breaker.failure()
+                retryable = idempotent or isinstance(e, _PRE_SEND_ERRORS)
+                if not retryable or attempt >= RETRY_ATTEMPTS - 1:
+                    _retry_stats["gave_up"] += 1
+                    # الجلسة قرّرت: إما استُنفدت المحاولات أو قد يكون الطلب طُبّق —
+                    # with_retry لا يعيد الإرسال في الحالتين
+                    e._db_retried = True
+                    raise
+            else:
+                if r.status_code not in _RETRY_STATUS:
+                    breaker.success()
+                    return r
+                breaker.failure()
+                if not idempotent or attempt >= RETRY_ATTEMPTS - 1:
+                    return r
+            _retry_stats["retries"] += 1
+            time.sleep(_backoff(attempt))
+            attempt += 1
+
+    def _timed(self, method, url, name, kwargs):
+        # قياس الرحلة الفعلية فقط (المنضمّون عبر single-flight لا يُحسبون)
+        headers = httpx.Headers(kwargs.get("headers") or {})
+        op = query_stats.operation_of(method, name, headers.get("prefer", ""))
+        detail = str(httpx.QueryParams(kwargs.get("params") or {}))
+        kwargs = dict(kwargs)
+        kwargs.setdefault("timeout", _TIMEOUTS[_op_class(method, name)])
+        conn = {"new": False, "tls": False}
+
+        def _trace(event, info):
+            # أحداث httpcore: اتصال TCP جديد / مصافحة TLS
+            if event == "connection.connect_tcp.started":
+                conn["new"] = True
+            elif event == "connection.start_tls.complete":
+                conn["tls"] = True
+
+        kwargs["extensions"] = {**(kwargs.get("extensions") or {}), "trace": _trace}
+        t0 = time.perf_counter()
+        try:
+            r = super().request(method, url, **kwargs)
+        except Exception as e:
+            self._count_conn(conn, stale=isinstance(e, (httpx.ReadError, httpx.RemoteProtocolError,
+                                                        httpx.WriteError)) and not conn["new"])
+            query_stats.record(name, op, time.perf_counter() - t0, error=True, detail=f"{detail} {e}")
+            raise
+        self._count_conn(conn)
+        query_stats.record(
+            name, op, time.perf_counter() - t0,
+            rows=query_stats.rows_of(r), nbytes=len(r.content or b""),
+            error=not r.is_success, detail=detail,
+        )
+        return r
+
+    @staticmethod
+    def _count_conn(conn, stale: bool = False) -> None:
+        with _pool_lock:
+            _pool_stats["requests"] += 1
+            if conn["new"]:
+                _pool_stats["new_connections"] += 1
+            else:
+                _pool_stats["reused"] += 1
+            if conn["tls"]:
+                _pool_stats["tls_handshakes"] += 1
+            if stale:
+                _pool_stats["stale_errors"] += 1
+
+
+def coalesce_stats() -> Dict[str, Any]:
+    """عدّادات الدمج: leaders = رحلات فعلية، hits = رحلات موفّرة، max_dups = أعلى ذروة."""
+    return _reads.stats()
+
+
+def query_report(top: int = 15) -> str:
+    """تقرير زمن الاستعلامات (هيستوغرامات + مواضع الاستدعاء + البطيئة) — انظر database/query_stats."""
+    c = _reads.stats()
+    rs = _retry_stats
+    report = (
+        query_stats.dump(top)
+        + f"\n\n🔗 single-flight: وُفّرت {c['hits']} رحلة من {c['leaders'] + c['hits']} (ذروة {c['max_dups']})"
+        + f"\n🔁 إعادة محاولة: {rs['retries']} | استسلام: {rs['gave_up']}"
+    )
+    us = _users.stats()
+    report += (
+        f"\n👤 كاش المستخدمين: {us['size']}/{us['max_size']} | إصابة {us['hit_ratio'] * 100:.0f}%"
+        f" ({us['hits']}/{us['hits'] + us['misses']}) | إبطال {us['invalidations']}"
+    )
+    ps = pool_stats()
+    report += (
+        f"\n🔌 pool: {ps['requests']} طلب | اتصالات جديدة {ps['new_connections']}"
+        f" | إعادة استخدام {ps['reuse_ratio'] * 100:.0f}% | TLS {ps['tls_handshakes']}"
+        f" | اتصالات منتهية {ps['stale_errors']}"
+    )
+    bad = {n: b for n, b in breaker_state().items() if b["state"] != CircuitBreaker.CLOSED or b["trips"]}
+    for n, b in bad.items():
+        report += f"\n⚡ {n}: {b['state']} (فتحات {b['trips']}، مرفوض {b['rejected']}، بعد {b['retry_in']}s)"
+    return report
+
+
+# عميل موحّد (Singleton) — يكفي PostgREST: client().table(...)/client().rpc(...)
+Client = SyncPostgrestClient
+
+_http = _PostgrestSession(
+    timeout=httpx.Timeout(TIMEOUT_WRITE, connect=TIMEOUT_CONNECT, pool=TIMEOUT_POOL),
+    limits=httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+        keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+    ),
+    follow_redirects=True,
+    http2=HTTP2_ENABLED,
+)
+if USE_LOCAL_BACKEND:
+    from database.local_backend import LocalClient
+
+    _supabase: Client = LocalClient(  # type: ignore[assignment]
+        LOCAL_DB_PATH if SUPABASE_BACKEND == "sqlite" else None, users_table=DEFAULT_TABLE
+    )
+else:
+    # نستخدم PostgREST (جداول + RPC) فقط؛ عميل supabase الكامل يستورد auth/storage/realtime
+    # غير المستخدمة (~100ms عند كل إقلاع). نفس الترويسات التي يرسلها create_client.
+    _supabase = SyncPostgrestClient(
+        f"{SUPABASE_URL.rstrip('/')}/rest/v1",
+        headers={
+            "X-Client-Info": "supabase-py/2.17.0",
+            "apiKey": SUPABASE_KEY,
+            "Authorization": f"Bearer {SUPABASE_KEY}",
+        },
+        http_client=_http,
+    )
 
 
 # ---------- دوال أساسية لا تلمسها بقية الأجزاء ----------
@@ -63,12 +592,36 @@ def table(table_name: Optional[str] = None):
 # - هذه الدوال تفترض أن DEFAULT_TABLE يشير لجدول المستخدمين (USERS_TABLE).
 # - ما غيّرنا أي استدعاءات موجودة في المشروع؛ هذه فقط أدوات إضافية عند الحاجة.
 
+def get_user_row(user_id: int) -> Optional[Dict[str, Any]]:
+    """
+    صف المستخدم كاملًا (أو None) عبر كاش المستخدمين؛ الرحلة للقاعدة عند الغياب فقط.
+    """
+    if USER_CACHE_ENABLED:
+        row = _users.get(user_id)
+        if row is not None:
+            return row
+        gen = _users.generation(user_id)
+    res = table(DEFAULT_TABLE).select("*").eq("user_id", user_id).limit(1).execute()
+    row = res.data[0] if res.data else None
+    if row and USER_CACHE_ENABLED:
+        _users.put(user_id, row, gen)
+    return row
+
+
+def peek_user_row(user_id: int) -> Optional[Dict[str, Any]]:
+    """صف المستخدم من الكاش فقط (None إن لم يكن مخزّنًا) — بلا أي رحلة للقاعدة."""
+    if not USER_CACHE_ENABLED:
+        return None
+    return _users.get(user_id)
+
+
 def get_user_by_id(user_id: int):
     """
     يرجع سجل المستخدم بناءً على user_id
     return: Response من supabase-py (فيه .data و .error)
     """
-    return table(DEFAULT_TABLE).select("*").eq("user_id", user_id).limit(1).execute()
+    row = get_user_row(user_id)
+    return APIResponse(data=[row] if row else [], count=None)
 
 
 def create_user(user_id: int, name: str, balance: int = 0, extra: Optional[Dict[str, Any]] = None):
@@ -139,7 +692,9 @@ def get_wallet(user_id: int):
     """
     يرجع حقول المحفظة الأساسية للمستخدم (balance, held).
     """
-    return table(DEFAULT_TABLE).select("balance, held").eq("user_id", user_id).limit(1).execute()
+    row = get_user_row(user_id)
+    data = [{"balance": row.get("balance"), "held": row.get("held")}] if row else []
+    return APIResponse(data=data, count=None)
 
 
 def get_available_balance(user_id: int) -> int:
@@ -203,3 +758,28 @@ def try_deduct_rpc(user_id: int, amount: int):
     """
     params = {"p_user_id": user_id, "p_amount": amount}
     return _supabase.rpc("try_deduct", params).execute()
+
+
+# ---------- لقطة المحفظة في رحلة واحدة (database/sql/0006_wallet_snapshot.sql) ----------
+def wallet_snapshot(user_id: int, name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    upsert المستخدم إن لم يوجد + يرجع في استجابة واحدة:
+    balance, held, available, discount_percent (admin_percent + referral_percent بسقف 100)،
+    banned, banned_until, ban_reason.
+    يرفع الاستثناء عند الفشل (مثلاً الدالة غير منشورة) ليتولى المنادي البديل.
+    """
+    res = _supabase.rpc("wallet_snapshot", {"p_user_id": user_id, "p_name": name}).execute()
+    data = res.data
+    if isinstance(data, list):
+        data = data[0] if data else None
+    if not isinstance(data, dict):
+        raise RuntimeError(f"wallet_snapshot: unexpected response {data!r}")
+    return data
+
+
+def user_cache_invalidate(user_id: Optional[int] = None) -> None:
+    """إبطال يدوي (مستخدم واحد أو الكل) — للكتابات التي لا تمر بالجلسة."""
+    if user_id is None:
+        _users.clear()
+    else:
+        _users.invalidate(user_id)
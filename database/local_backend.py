@@ -0,0 +1,918 @@
+# database/local_backend.py
+# -*- coding: utf-8 -*-
+"""
+Backend محلي بديل لـ Supabase (للاختبارات وقياس الأداء بدون الشبكة).
+
+يُفعَّل من database/db.py عبر:
+    SUPABASE_BACKEND=memory            # كل شيء في الذاكرة
+    SUPABASE_BACKEND=sqlite            # نفس المحرك + حفظ الصفوف في ملف SQLite
+    LOCAL_DB_PATH=./local_supabase.db  # مسار الملف (sqlite فقط)
+
+يطبّق الجزء المستخدم فعلًا من postgrest builder:
+    select/eq/neq/in_/is_/lt/lte/gt/gte/match/filter/order/limit/single/maybe_single
+    insert/update/upsert(on_conflict)/delete/execute
+ودوال RPC بلغة بايثون بنفس منطق Postgres:
+    create_hold, capture_hold, release_hold, transfer_amount, try_deduct, wallet_snapshot,
+    reserve_team_slot, available_team_numbers, get_team_join_code,
+    state_set_keys, state_del_keys, state_touch, purge_expired_state
+
+الأخطاء تُرفع كـ postgrest.exceptions.APIError بنفس الأكواد (23505, PGRST116, P0001...)
+حتى يتصرف الكود الحالي كما مع Supabase.
+"""
+
+from __future__ import annotations
+
+import copy
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from postgrest.exceptions import APIError
+
+# ---------- مخطط مبسّط ----------
+# مفاتيح فريدة (لـ 23505 و upsert on_conflict)
+UNIQUE_KEYS: Dict[str, List[Tuple[str, ...]]] = {
+    "features": [("key",)],
+    "user_state": [("user_id", "state_key")],
+    "pending_requests": [("user_id",)],
+    "banned_users": [("user_id",)],
+    "tournament_types": [("key",)],
+    "tournament_entries": [("tournament_id", "user_id")],
+    "tournament_team_codes": [("tournament_id", "team_number")],
+}
+# جداول معرّفها UUID (الباقي bigserial)
+UUID_TABLES = {"holds", "discounts", "tournaments", "tournament_entries"}
+# جداول مفتاحها ليس id (لا نولّد id)
+NATURAL_KEY_TABLES = {"features", "user_state", "banned_users", "tournament_types", "tournament_team_codes"}
+
+_SEED = {
+    "tournament_types": [
+        {"key": "solo", "label": "بطولة سولو 1vs100", "team_size": 1, "max_teams": 100, "enabled": True},
+        {"key": "duo", "label": "بطولة دو 2vs100", "team_size": 2, "max_teams": 50, "enabled": True},
+        {"key": "squad", "label": "بطولة سكواد 4vs100", "team_size": 4, "max_teams": 25, "enabled": True},
+    ],
+}
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _err(message: str, code: str = "P0001", details: Optional[str] = None, hint: Optional[str] = None) -> APIError:
+    return APIError({"message": message, "code": code, "details": details, "hint": hint})
+
+
+# ---------- مقارنة القيم (PostgREST يحوّل النصوص للأنواع) ----------
+def _parse_dt(v: Any) -> Optional[datetime]:
+    if isinstance(v, datetime):
+        return v if v.tzinfo else v.replace(tzinfo=timezone.utc)
+    if isinstance(v, str) and len(v) >= 10 and v[4:5] == "-" and v[7:8] == "-":
+        try:
+            s = v[:-1] + "+00:00" if v.endswith("Z") else v
+            d = datetime.fromisoformat(s)
+            return d if d.tzinfo else d.replace(tzinfo=timezone.utc)
+        except Exception:
+            return None
+    return None
+
+
+def _coerce_pair(a: Any, b: Any) -> Tuple[Any, Any]:
+    if a is None or b is None:
+        return a, b
+    if isinstance(a, bool) or isinstance(b, bool):
+        def _b(x):
+            if isinstance(x, str):
+                return x.lower() in ("true", "t", "1")
+            return bool(x)
+        return _b(a), _b(b)
+    if isinstance(a, (int, float)) and not isinstance(b, (int, float)):
+        try:
+            return a, type(a)(b)
+        except Exception:
+            return str(a), str(b)
+    if isinstance(b, (int, float)) and not isinstance(a, (int, float)):
+        try:
+            return type(b)(a), b
+        except Exception:
+            return str(a), str(b)
+    da, db_ = _parse_dt(a), _parse_dt(b)
+    if da is not None and db_ is not None:
+        return da, db_
+    if type(a) is not type(b):
+        return str(a), str(b)
+    return a, b
+
+
+def _cmp(op: str, a: Any, b: Any) -> bool:
+    if op == "is":
+        if isinstance(b, str):
+            b = {"null": None, "true": True, "false": False}.get(b.lower(), b)
+        return a is b or a == b
+    if a is None:
+        return False if op != "neq" else b is not None
+    if op == "in":
+        return any(_cmp("eq", a, x) for x in b)
+    a, b = _coerce_pair(a, b)
+    try:
+        if op == "eq":
+            return a == b
+        if op == "neq":
+            return a != b
+        if op == "lt":
+            return a < b
+        if op == "lte":
+            return a <= b
+        if op == "gt":
+            return a > b
+        if op == "gte":
+            return a >= b
+    except TypeError:
+        return False
+    raise _err(f"operator {op} not supported by local backend", "PGRST100")
+
+
+def _get_path(row: Dict[str, Any], col: str) -> Any:
+    """يدعم col و col->key و col->>key (JSONB)."""
+    if "->" not in col:
+        return row.get(col)
+    parts = col.replace("->>", "->").split("->")
+    cur: Any = row.get(parts[0].strip())
+    for p in parts[1:]:
+        p = p.strip().strip("'\"")
+        if isinstance(cur, str):
+            try:
+                cur = json.loads(cur)
+            except Exception:
+                return None
+        if not isinstance(cur, dict):
+            return None
+        cur = cur.get(p)
+    if "->>" in col and cur is not None and not isinstance(cur, str):
+        return json.dumps(cur) if isinstance(cur, (dict, list)) else str(cur).lower() if isinstance(cur, bool) else str(cur)
+    return cur
+
+
+# ---------- الاستجابة ----------
+class LocalResponse:
+    def __init__(self, data: Any, count: Optional[int] = None):
+        self.data = data
+        self.count = count
+        self.error = None
+
+    def __repr__(self):
+        return f"LocalResponse(data={self.data!r}, count={self.count!r})"
+
+
+# ---------- المخزن ----------
+class LocalStore:
+    def __init__(self, path: Optional[str] = None, users_table: str = "houssin363"):
+        self.lock = threading.RLock()
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+        self.seq: Dict[str, int] = {}
+        self.users_table = users_table
+        UNIQUE_KEYS.setdefault(users_table, [("user_id",)])
+        NATURAL_KEY_TABLES.add(users_table)
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._open(path)
+        for name, rows in _SEED.items():
+            if not self.tables.get(name):
+                for r in rows:
+                    self.insert(name, [dict(r)])
+
+    # --- SQLite (اختياري) ---
+    def _open(self, path: str) -> None:
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS rows(tbl TEXT, rid TEXT, doc TEXT, PRIMARY KEY(tbl, rid))")
+        for tbl, doc in self._db.execute("SELECT tbl, doc FROM rows ORDER BY rowid"):
+            row = json.loads(doc)
+            self.tables.setdefault(tbl, []).append(row)
+            rid = row.get("id")
+            if isinstance(rid, int):
+                self.seq[tbl] = max(self.seq.get(tbl, 0), rid)
+
+    def _persist(self, tbl: str, rows: List[Dict[str, Any]], deleted: bool = False) -> None:
+        if self._db is None or not rows:
+            return
+        if deleted:
+            self._db.executemany("DELETE FROM rows WHERE tbl=? AND rid=?", [(tbl, r["_rid"]) for r in rows])
+        else:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO rows(tbl, rid, doc) VALUES(?,?,?)",
+                [(tbl, r["_rid"], json.dumps(r, default=str, ensure_ascii=False)) for r in rows],
+            )
+
+    # --- أدوات ---
+    def rows(self, tbl: str) -> List[Dict[str, Any]]:
+        return self.tables.setdefault(tbl, [])
+
+    def _defaults(self, tbl: str, row: Dict[str, Any]) -> Dict[str, Any]:
+        out = dict(row)
+        if tbl not in NATURAL_KEY_TABLES and "id" not in out:
+            if tbl in UUID_TABLES:
+                out["id"] = str(uuid.uuid4())
+            else:
+                self.seq[tbl] = self.seq.get(tbl, 0) + 1
+                out["id"] = self.seq[tbl]
+        out.setdefault("created_at", _now().isoformat())
+        if tbl == self.users_table:
+            out.setdefault("balance", 0)
+            out.setdefault("held", 0)
+        if tbl == "user_state":
+            out["updated_at"] = _now().isoformat()
+        out["_rid"] = out.get("_rid") or uuid.uuid4().hex
+        return out
+
+    def _conflict(self, tbl: str, row: Dict[str, Any], keys: Optional[Tuple[str, ...]] = None) -> Optional[Dict[str, Any]]:
+        key_sets = [keys] if keys else UNIQUE_KEYS.get(tbl, [])
+        if "id" in row and not keys:
+            key_sets = list(key_sets) + [("id",)]
+        for ks in key_sets:
+            if not all(k in row for k in ks):
+                continue
+            for r in self.rows(tbl):
+                if all(_cmp("eq", r.get(k), row.get(k)) for k in ks):
+                    return r
+        return None
+
+    # --- عمليات ---
+    def insert(self, tbl: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with self.lock:
+            out = []
+            for row in rows:
+                if self._conflict(tbl, row) is not None:
+                    raise _err(f'duplicate key value violates unique constraint on "{tbl}"', "23505")
+                full = self._defaults(tbl, row)
+                self.rows(tbl).append(full)
+                out.append(full)
+            self._persist(tbl, out)
+            return out
+
+    def upsert(self, tbl: str, rows: List[Dict[str, Any]], on_conflict: str = "",
+               ignore_duplicates: bool = False) -> List[Dict[str, Any]]:
+        keys = tuple(k.strip() for k in on_conflict.split(",") if k.strip()) or None
+        with self.lock:
+            out = []
+            for row in rows:
+                cur = self._conflict(tbl, row, keys)
+                if cur is None:
+                    full = self._defaults(tbl, row)
+                    self.rows(tbl).append(full)
+                    out.append(full)
+                elif not ignore_duplicates:
+                    cur.update(row)
+                    if tbl == "user_state":
+                        cur["updated_at"] = _now().isoformat()
+                    out.append(cur)
+            self._persist(tbl, out)
+            return out
+
+    def update(self, tbl: str, where: Callable[[Dict[str, Any]], bool], patch: Dict[str, Any]) -> List[Dict[str, Any]]:
+        with self.lock:
+            out = [r for r in self.rows(tbl) if where(r)]
+            for r in out:
+                r.update(patch)
+                if tbl == "user_state":
+                    r["updated_at"] = _now().isoformat()
+            self._persist(tbl, out)
+            return out
+
+    def delete(self, tbl: str, where: Callable[[Dict[str, Any]], bool]) -> List[Dict[str, Any]]:
+        with self.lock:
+            keep, gone = [], []
+            for r in self.rows(tbl):
+                (gone if where(r) else keep).append(r)
+            self.tables[tbl] = keep
+            self._persist(tbl, gone, deleted=True)
+            return gone
+
+    def select(self, tbl: str, where: Callable[[Dict[str, Any]], bool]) -> List[Dict[str, Any]]:
+        with self.lock:
+            return [r for r in self.rows(tbl) if where(r)]
+
+    def user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        for r in self.rows(self.users_table):
+            if _cmp("eq", r.get("user_id"), user_id):
+                return r
+        return None
+
+
+# ---------- Query builder ----------
+def _project(row: Dict[str, Any], cols: str) -> Dict[str, Any]:
+    cols = (cols or "*").strip()
+    if cols == "*":
+        return {k: copy.deepcopy(v) for k, v in row.items() if k != "_rid"}
+    out = {}
+    for c in cols.split(","):
+        c = c.strip()
+        if not c:
+            continue
+        if c == "*":
+            out.update({k: copy.deepcopy(v) for k, v in row.items() if k != "_rid"})
+            continue
+        alias, _, src = c.partition(":")
+        if not src:
+            alias, src = c, c
+        out[alias.strip()] = copy.deepcopy(_get_path(row, src.strip()))
+    return out
+
+
+class LocalQuery:
+    def __init__(self, store: LocalStore, table: str):
+        self._store = store
+        self._table = table
+        self._method = "select"
+        self._cols = "*"
+        self._count: Optional[str] = None
+        self._filters: List[Tuple[str, str, Any]] = []
+        self._order: List[Tuple[str, bool, Optional[bool]]] = []
+        self._limit: Optional[int] = None
+        self._offset = 0
+        self._single: Optional[str] = None
+        self._payload: Any = None
+        self._on_conflict = ""
+        self._ignore_dups = False
+
+    # --- نوع العملية ---
+    def select(self, *columns: str, count: Optional[str] = None, **_):
+        self._method = "select"
+        self._cols = ",".join(columns) if columns else "*"
+        self._count = count
+        return self
+
+    def insert(self, json_: Any, *, count: Optional[str] = None, upsert: bool = False, **_):
+        self._method = "upsert" if upsert else "insert"
+        self._payload = json_
+        self._count = count
+        return self
+
+    def upsert(self, json_: Any, *, on_conflict: str = "", ignore_duplicates: bool = False,
+               count: Optional[str] = None, **_):
+        self._method = "upsert"
+        self._payload = json_
+        self._on_conflict = on_conflict or ""
+        self._ignore_dups = ignore_duplicates
+        self._count = count
+        return self
+
+    def update(self, json_: Dict[str, Any], *, count: Optional[str] = None, **_):
+        self._method = "update"
+        self._payload = json_
+        self._count = count
+        return self
+
+    def delete(self, *, count: Optional[str] = None, **_):
+        self._method = "delete"
+        self._count = count
+        return self
+
+    # --- الفلاتر ---
+    def _f(self, col: str, op: str, val: Any):
+        self._filters.append((col, op, val))
+        return self
+
+    def eq(self, column: str, value: Any):
+        return self._f(column, "eq", value)
+
+    def neq(self, column: str, value: Any):
+        return self._f(column, "neq", value)
+
+    def lt(self, column: str, value: Any):
+        return self._f(column, "lt", value)
+
+    def lte(self, column: str, value: Any):
+        return self._f(column, "lte", value)
+
+    def gt(self, column: str, value: Any):
+        return self._f(column, "gt", value)
+
+    def gte(self, column: str, value: Any):
+        return self._f(column, "gte", value)
+
+    def is_(self, column: str, value: Any):
+        return self._f(column, "is", value)
+
+    def in_(self, column: str, values):
+        return self._f(column, "in", list(values))
+
+    def match(self, query: Dict[str, Any]):
+        for k, v in (query or {}).items():
+            self.eq(k, v)
+        return self
+
+    def filter(self, column: str, operator: str, criteria: Any):
+        op = operator.strip()
+        if op == "in" and isinstance(criteria, str):
+            criteria = [x.strip().strip('"') for x in criteria.strip("()").split(",") if x.strip()]
+        return self._f(column, op, criteria)
+
+    # --- الترتيب والحدود ---
+    def order(self, column: str, *, desc: bool = False, nullsfirst: Optional[bool] = None, **_):
+        self._order.append((column, desc, nullsfirst))
+        return self
+
+    def limit(self, size: int, **_):
+        self._limit = int(size)
+        return self
+
+    def range(self, start: int, end: int, **_):
+        self._offset = int(start)
+        self._limit = int(end) - int(start) + 1
+        return self
+
+    def single(self):
+        self._single = "single"
+        return self
+
+    def maybe_single(self):
+        self._single = "maybe"
+        return self
+
+    # --- التنفيذ ---
+    def _where(self, row: Dict[str, Any]) -> bool:
+        return all(_cmp(op, _get_path(row, col), val) for col, op, val in self._filters)
+
+    def _sorted(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        for col, desc, nullsfirst in reversed(self._order):
+            nulls = [r for r in rows if _get_path(r, col) is None]
+            vals = [r for r in rows if _get_path(r, col) is not None]
+
+            def _key(r, col=col):
+                v = _get_path(r, col)
+                d = _parse_dt(v)
+                return (0, d) if d is not None else (1, v) if isinstance(v, (int, float)) else (2, str(v))
+
+            vals.sort(key=_key, reverse=desc)
+            # Postgres: NULLS LAST تصاعديًا و NULLS FIRST تنازليًا
+            first = desc if nullsfirst is None else nullsfirst
+            rows = nulls + vals if first else vals + nulls
+        return rows
+
+    def execute(self) -> LocalResponse:
+        st = self._store
+        tbl = self._table
+        if self._method == "select":
+            rows = self._sorted(st.select(tbl, self._where))
+            total = len(rows)
+            rows = rows[self._offset:]
+            if self._limit is not None:
+                rows = rows[: self._limit]
+            data: Any = [_project(r, self._cols) for r in rows]
+        elif self._method == "insert":
+            payload = self._payload if isinstance(self._payload, list) else [self._payload]
+            data = [_project(r, "*") for r in st.insert(tbl, [dict(p) for p in payload])]
+            total = len(data)
+        elif self._method == "upsert":
+            payload = self._payload if isinstance(self._payload, list) else [self._payload]
+            data = [_project(r, "*") for r in st.upsert(tbl, [dict(p) for p in payload],
+                                                       self._on_conflict, self._ignore_dups)]
+            total = len(data)
+        elif self._method == "update":
+            data = [_project(r, "*") for r in st.update(tbl, self._where, dict(self._payload or {}))]
+            total = len(data)
+        elif self._method == "delete":
+            data = [_project(r, "*") for r in st.delete(tbl, self._where)]
+            total = len(data)
+        else:
+            raise _err(f"unknown method {self._method}", "PGRST100")
+
+        if self._single:
+            if len(data) == 1:
+                return LocalResponse(data[0], total if self._count else None)
+            if not data and self._single == "maybe":
+                return None  # type: ignore[return-value]
+            raise _err("JSON object requested, multiple (or no) rows returned", "PGRST116",
+                       details=f"The result contains {len(data)} rows")
+        return LocalResponse(data, total if self._count else None)
+
+
+class LocalRPC:
+    def __init__(self, store: LocalStore, fn: str, params: Dict[str, Any]):
+        self._store = store
+        self._fn = fn
+        self._params = params or {}
+
+    def execute(self) -> LocalResponse:
+        impl = RPCS.get(self._fn)
+        if impl is None:
+            raise _err(f"Could not find the function public.{self._fn}", "PGRST202")
+        with self._store.lock:
+            return LocalResponse(impl(self._store, **self._params))
+
+
+class LocalClient:
+    """نفس واجهة supabase.Client المستخدمة في المشروع: table/from_/rpc."""
+
+    def __init__(self, path: Optional[str] = None, users_table: str = "houssin363"):
+        self.store = LocalStore(path, users_table=users_table)
+
+    def table(self, table_name: str) -> LocalQuery:
+        return LocalQuery(self.store, table_name)
+
+    from_ = table
+
+    def rpc(self, fn: str, params: Optional[Dict[str, Any]] = None, **_) -> LocalRPC:
+        return LocalRPC(self.store, fn, params or {})
+
+
+# ---------- RPC: المحفظة ----------
+def _user_or_raise(st: LocalStore, user_id: int) -> Dict[str, Any]:
+    u = st.user(user_id)
+    if u is None:
+        raise _err("user_not_found")
+    return u
+
+
+def _available(u: Dict[str, Any]) -> int:
+    return int(u.get("balance") or 0) - int(u.get("held") or 0)
+
+
+def _rpc_create_hold(st: LocalStore, p_user_id: int, p_amount: int, p_order_id: Optional[str] = None,
+                     p_ttl_seconds: Optional[int] = 900) -> str:
+    amount = int(p_amount or 0)
+    if amount <= 0:
+        raise _err("amount must be > 0")
+    u = _user_or_raise(st, p_user_id)
+    if _available(u) < amount:
+        raise _err("insufficient_funds")
+    u["held"] = int(u.get("held") or 0) + amount
+    st._persist(st.users_table, [u])
+    expires = _now() + timedelta(seconds=int(p_ttl_seconds or 900))
+    row = st.insert("holds", [{
+        "user_id": p_user_id, "amount": amount, "order_id": p_order_id,
+        "status": "held", "expires_at": expires.isoformat(),
+    }])[0]
+    return row["id"]
+
+
+def _hold(st: LocalStore, hold_id: str) -> Optional[Dict[str, Any]]:
+    for h in st.rows("holds"):
+        if str(h.get("id")) == str(hold_id):
+            return h
+    return None
+
+
+def _rpc_capture_hold(st: LocalStore, p_hold_id: str) -> bool:
+    h = _hold(st, p_hold_id)
+    if h is None or h.get("status") != "held":
+        return False
+    u = _user_or_raise(st, h["user_id"])
+    amt = int(h.get("amount") or 0)
+    u["balance"] = int(u.get("balance") or 0) - amt
+    u["held"] = max(0, int(u.get("held") or 0) - amt)
+    h["status"] = "captured"
+    st._persist(st.users_table, [u])
+    st._persist("holds", [h])
+    return True
+
+
+def _rpc_release_hold(st: LocalStore, p_hold_id: str) -> bool:
+    h = _hold(st, p_hold_id)
+    if h is None or h.get("status") != "held":
+        return False
+    u = _user_or_raise(st, h["user_id"])
+    u["held"] = max(0, int(u.get("held") or 0) - int(h.get("amount") or 0))
+    h["status"] = "released"
+    st._persist(st.users_table, [u])
+    st._persist("holds", [h])
+    return True
+
+
+def _rpc_try_deduct(st: LocalStore, p_user_id: int, p_amount: int) -> bool:
+    amount = int(p_amount or 0)
+    if amount <= 0:
+        return False
+    u = st.user(p_user_id)
+    if u is None or _available(u) < amount:
+        return False
+    u["balance"] = int(u.get("balance") or 0) - amount
+    st._persist(st.users_table, [u])
+    return True
+
+
+def _rpc_transfer_amount(st: LocalStore, p_from_user: int, p_to_user: int, p_amount: int) -> bool:
+    amount = int(p_amount or 0)
+    if amount <= 0:
+        return False
+    src = st.user(p_from_user)
+    if src is None or _available(src) < amount:
+        return False
+    dst = st.user(p_to_user)
+    if dst is None:
+        dst = st.insert(st.users_table, [{"user_id": p_to_user, "name": "مستخدم"}])[0]
+    src["balance"] = int(src.get("balance") or 0) - amount
+    dst["balance"] = int(dst.get("balance") or 0) + amount
+    st._persist(st.users_table, [src, dst])
+    return True
+
+
+def _rpc_wallet_snapshot(st: LocalStore, p_user_id: int, p_name: Optional[str] = None) -> Dict[str, Any]:
+    st.upsert(st.users_table, [{"user_id": p_user_id, "name": p_name or "مستخدم"}],
+              "user_id", ignore_duplicates=p_name is None)
+    u = st.user(p_user_id) or {}
+    now = _now()
+    admin = referral = 0
+    for d in st.rows("discounts"):
+        if not d.get("active"):
+            continue
+        starts, ends = _parse_dt(d.get("starts_at")) or now, _parse_dt(d.get("ends_at"))
+        if starts > now or (ends is not None and ends <= now):
+            continue
+        scope = (d.get("scope") or "global").lower()
+        if scope == "user" and not _cmp("eq", d.get("user_id"), p_user_id):
+            continue
+        if scope not in ("global", "user"):
+            continue
+        pct = int(d.get("percent") or 0)
+        if (d.get("source") or "admin").lower() == "referral":
+            referral = max(referral, pct)
+        else:
+            admin = max(admin, pct)
+    ban = None
+    for b in st.rows("banned_users"):
+        if _cmp("eq", b.get("user_id"), p_user_id):
+            until = _parse_dt(b.get("banned_until"))
+            if until is None or until > now:
+                ban = b
+    balance, held = int(u.get("balance") or 0), int(u.get("held") or 0)
+    return {
+        "user_id": p_user_id, "balance": balance, "held": held, "available": balance - held,
+        "admin_percent": admin, "referral_percent": referral,
+        "discount_percent": min(100, admin + referral),
+        "banned": ban is not None,
+        "banned_until": (ban or {}).get("banned_until"),
+        "ban_reason": (ban or {}).get("reason"),
+    }
+
+
+# ---------- RPC: البطولات ----------
+def _team_size(st: LocalStore, tournament_id: str) -> Tuple[Optional[int], Optional[int]]:
+    t = next((r for r in st.rows("tournaments") if str(r.get("id")) == str(tournament_id)), None)
+    if t is None:
+        return None, None
+    tt = next((r for r in st.rows("tournament_types") if r.get("key") == t.get("type_key")), None)
+    if tt is None:
+        return None, None
+    return int(tt["team_size"]), int(tt["max_teams"])
+
+
+def _rpc_available_team_numbers(st: LocalStore, p_tournament: str) -> List[Dict[str, int]]:
+    size, max_teams = _team_size(st, p_tournament)
+    if size is None:
+        return []
+    counts: Dict[int, int] = {}
+    for e in st.rows("tournament_entries"):
+        if str(e.get("tournament_id")) == str(p_tournament):
+            n = int(e.get("team_number") or 0)
+            counts[n] = counts.get(n, 0) + 1
+    return [{"team_number": n, "slots_left": size - counts.get(n, 0)}
+            for n in range(1, max_teams + 1) if size - counts.get(n, 0) > 0]
+
+
+def _rpc_reserve_team_slot(st: LocalStore, p_tournament: str, p_user: int, p_num: int,
+                           p_join_code: Optional[str] = None) -> str:
+    size, _ = _team_size(st, p_tournament)
+    if size is None:
+        raise _err("invalid_tournament")
+    num = int(p_num)
+    count = sum(1 for e in st.rows("tournament_entries")
+                if str(e.get("tournament_id")) == str(p_tournament) and int(e.get("team_number") or 0) == num)
+    if count == 0:
+        code = p_join_code or uuid.uuid4().hex
+        st.upsert("tournament_team_codes",
+                  [{"tournament_id": p_tournament, "team_number": num, "join_code": code}],
+                  "tournament_id,team_number", ignore_duplicates=True)
+    else:
+        code = _rpc_get_team_join_code(st, p_tournament, num)
+        if code is None:
+            raise _err("team_state_error")
+        if p_join_code is None or p_join_code != code:
+            raise _err("join_code_required", hint="رمز الفريق غير صحيح")
+    if count >= size:
+        raise _err("team_full", hint="الفريق ممتلئ")
+    row = st.insert("tournament_entries", [{"tournament_id": p_tournament, "user_id": p_user, "team_number": num}])[0]
+    return row["id"]
+
+
+def _rpc_get_team_join_code(st: LocalStore, p_tournament: str, p_num: int) -> Optional[str]:
+    for r in st.rows("tournament_team_codes"):
+        if str(r.get("tournament_id")) == str(p_tournament) and int(r.get("team_number") or 0) == int(p_num):
+            return r.get("join_code")
+    return None
+
+
+# ---------- RPC: حالة المستخدم (0007_state_rpcs.sql) ----------
+def _state_row(st: LocalStore, user_id: int, state_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    key = state_key or "global"
+    for r in st.rows("user_state"):
+        if _cmp("eq", r.get("user_id"), user_id) and r.get("state_key") == key:
+            return r
+    return None
+
+
+def _rpc_state_set_keys(st: LocalStore, p_user_id: int, p_state_key: Optional[str], p_vars: Dict[str, Any],
+                        p_expires_at: Optional[str] = None, p_del: Optional[List[str]] = None,
+                        p_keep: Optional[List[str]] = None) -> Dict[str, Any]:
+    key = p_state_key or "global"
+    row = _state_row(st, p_user_id, key)
+    if row is None:
+        new_vars = dict(p_vars or {})
+        row = st.insert("user_state", [{"user_id": p_user_id, "state_key": key, "vars": new_vars,
+                                         "expires_at": p_expires_at}])[0]
+    else:
+        cur = dict(row.get("vars") or {})
+        if p_keep is not None:
+            cur = {k: v for k, v in cur.items() if k in p_keep}
+        for k in p_del or ():
+            cur.pop(k, None)
+        cur.update(p_vars or {})
+        patch = {"vars": cur}
+        if p_expires_at is not None:
+            patch["expires_at"] = p_expires_at
+        st.update("user_state", lambda r: r is row, patch)
+    if row.get("vars") == {}:
+        st.delete("user_state", lambda r: r is row)
+    return copy.deepcopy(row.get("vars") or {})
+
+
+def _rpc_state_del_keys(st: LocalStore, p_user_id: int, p_state_key: Optional[str], p_keys: List[str]) -> Dict[str, Any]:
+    row = _state_row(st, p_user_id, p_state_key)
+    if row is None:
+        return {}
+    cur = {k: v for k, v in (row.get("vars") or {}).items() if k not in (p_keys or ())}
+    st.update("user_state", lambda r: r is row, {"vars": cur})
+    if not cur:
+        st.delete("user_state", lambda r: r is row)
+    return cur
+
+
+def _rpc_state_touch(st: LocalStore, p_user_id: int, p_state_key: Optional[str], p_expires_at: str) -> Optional[bool]:
+    row = _state_row(st, p_user_id, p_state_key)
+    if row is None:
+        return None
+    cur = dict(row.get("vars") or {})
+    if "__state_exp" in cur:
+        cur["__state_exp"] = p_expires_at
+    st.update("user_state", lambda r: r is row, {"vars": cur, "expires_at": p_expires_at})
+    return True
+
+
+def _rpc_purge_expired_state(st: LocalStore, p_limit: int = 500) -> List[Dict[str, Any]]:
+    now = _now()
+    with st.lock:
+        expired = [(d, r) for r in st.rows("user_state")
+                   if (d := _parse_dt(r.get("expires_at"))) is not None and d < now]
+        expired.sort(key=lambda x: x[0])
+        doomed = {id(r) for _, r in expired[:max(int(p_limit or 500), 1)]}
+        gone = st.delete("user_state", lambda r: id(r) in doomed)
+    return [{"user_id": r["user_id"], "state_key": r["state_key"]} for r in gone]
+
+
+# ---------- RPC: أقفال طابور الإدمن (0009_queue_claim_rpcs.sql) ----------
+_LOCK_KEYS = ("locked_by", "locked_by_username", "claimed")
+
+
+def _pending_json(row: Dict[str, Any], ok: bool) -> Dict[str, Any]:
+    return {"ok": ok, "id": row.get("id"), "user_id": row.get("user_id"),
+            "request_text": row.get("request_text"), "created_at": row.get("created_at"),
+            "payload": copy.deepcopy(row.get("payload") or {})}
+
+
+def _pending_lock_patch(st: LocalStore, p_request_id: int, p_admin_id: Optional[int],
+                        build: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    with st.lock:
+        row = next((r for r in st.rows("pending_requests") if _cmp("eq", r.get("id"), p_request_id)), None)
+        if row is None:
+            return None
+        locked = (row.get("payload") or {}).get("locked_by")
+        if p_admin_id is not None and locked is not None and str(locked) != str(p_admin_id):
+            return _pending_json(row, False)
+        st.update("pending_requests", lambda r: r is row, build(dict(row.get("payload") or {})))
+        return _pending_json(row, True)
+
+
+def _rpc_claim_pending_request(st: LocalStore, p_request_id: int, p_admin_id: int,
+                               p_admin_name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    prev = []
+
+    def build(payload):
+        prev.append(payload.get("locked_by"))
+        payload.update(locked_by=p_admin_id, locked_by_username=p_admin_name, claimed=True)
+        return {"payload": payload}
+    out = _pending_lock_patch(st, p_request_id, p_admin_id, build)
+    if out is not None:
+        out["was_unlocked"] = bool(out["ok"] and prev and prev[0] is None)
+    return out
+
+
+def _rpc_release_pending_request(st: LocalStore, p_request_id: int,
+                                 p_admin_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    def build(payload):
+        return {"payload": {k: v for k, v in payload.items() if k not in _LOCK_KEYS}}
+    return _pending_lock_patch(st, p_request_id, p_admin_id, build)
+
+
+def _rpc_postpone_pending_request(st: LocalStore, p_request_id: int,
+                                  p_admin_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    def build(payload):
+        return {"payload": {k: v for k, v in payload.items() if k not in _LOCK_KEYS},
+                "created_at": _now().isoformat()}
+    return _pending_lock_patch(st, p_request_id, p_admin_id, build)
+
+
+def _rpc_patch_pending_payload(st: LocalStore, p_request_id: int, p_set: Optional[Dict[str, Any]] = None,
+                               p_del: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+    def build(payload):
+        for k in p_del or ():
+            payload.pop(k, None)
+        payload.update(p_set or {})
+        return {"payload": payload}
+    return _pending_lock_patch(st, p_request_id, None, build)
+
+
+# ---------- RPC: تجميع أحداث الطابور ساعيًا (0011_queue_events.sql) ----------
+_WAIT_BOUNDS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 21600)
+
+
+def _wait_bucket(wait_ms: Any) -> int:
+    secs = (wait_ms or 0) / 1000.0
+    return sum(1 for b in _WAIT_BOUNDS if secs >= b)  # فهرس 0..11
+
+
+def _rpc_rollup_queue_events(st: LocalStore, p_limit: int = 50000, p_keep_days: int = 30,
+                             p_lag_seconds: int = 60) -> Dict[str, Any]:
+    cutoff_lag = _now() - timedelta(seconds=max(int(p_lag_seconds or 0), 0))
+    with st.lock:
+        state = next((r for r in st.rows("queue_rollup_state") if r.get("id") == 1), None)
+        if state is None:
+            st.insert("queue_rollup_state", [{"id": 1, "last_event_id": 0}])
+            state = next(r for r in st.rows("queue_rollup_state") if r.get("id") == 1)
+        v_from = int(state.get("last_event_id") or 0)
+        pending = sorted((r for r in st.rows("queue_events") if int(r.get("id") or 0) > v_from),
+                         key=lambda r: r["id"])
+        fresh = []
+        for r in pending:  # نتوقف عند أول حدث ضمن هامش commit
+            if (_parse_dt(r.get("created_at")) or _now()) >= cutoff_lag or len(fresh) >= max(int(p_limit or 1), 1):
+                break
+            fresh.append(r)
+        v_to = fresh[-1]["id"] if fresh else v_from
+
+        groups: Dict[tuple, Dict[str, Any]] = {}
+        for e in fresh:
+            d = _parse_dt(e.get("created_at")) or _now()
+            hour = d.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0).isoformat()
+            key = (hour, e.get("event"), e.get("lane") or "", int(e.get("admin_id") or 0))
+            g = groups.setdefault(key, {"n": 0, "wait_ms_sum": 0, "wait_ms_max": 0, "wait_hist": [0] * 12})
+            w = int(e.get("wait_ms") or 0)
+            g["n"] += 1
+            g["wait_ms_sum"] += w
+            g["wait_ms_max"] = max(g["wait_ms_max"], w)
+            g["wait_hist"][_wait_bucket(w)] += 1
+
+        for (hour, event, lane, admin_id), g in groups.items():
+            def same(r, hour=hour, event=event, lane=lane, admin_id=admin_id):
+                return (r.get("hour"), r.get("event"), r.get("lane"), r.get("admin_id")) == (hour, event, lane, admin_id)
+            cur = next((r for r in st.rows("queue_stats_hourly") if same(r)), None)
+            if cur is None:
+                st.insert("queue_stats_hourly", [dict(g, hour=hour, event=event, lane=lane, admin_id=admin_id)])
+            else:
+                hist = [a + b for a, b in zip(cur.get("wait_hist") or [0] * 12, g["wait_hist"])]
+                st.update("queue_stats_hourly", same, {
+                    "n": cur["n"] + g["n"], "wait_ms_sum": cur["wait_ms_sum"] + g["wait_ms_sum"],
+                    "wait_ms_max": max(cur["wait_ms_max"], g["wait_ms_max"]), "wait_hist": hist,
+                })
+        if fresh:
+            st.update("queue_rollup_state", lambda r: r.get("id") == 1,
+                      {"last_event_id": v_to, "updated_at": _now().isoformat()})
+
+        cutoff = _now() - timedelta(days=max(int(p_keep_days or 1), 1))
+        purged = st.delete("queue_events", lambda r: int(r.get("id") or 0) <= v_to
+                           and (_parse_dt(r.get("created_at")) or _now()) < cutoff)
+    return {"rolled": len(fresh), "last_event_id": v_to, "purged": len(purged)}
+
+RPCS: Dict[str, Callable[..., Any]] = {
+    "create_hold": _rpc_create_hold,
+    "capture_hold": _rpc_capture_hold,
+    "release_hold": _rpc_release_hold,
+    "try_deduct": _rpc_try_deduct,
+    "transfer_amount": _rpc_transfer_amount,
+    "wallet_snapshot": _rpc_wallet_snapshot,
+    "available_team_numbers": _rpc_available_team_numbers,
+    "reserve_team_slot": _rpc_reserve_team_slot,
+    "get_team_join_code": _rpc_get_team_join_code,
+    "state_set_keys": _rpc_state_set_keys,
+    "state_del_keys": _rpc_state_del_keys,
+    "state_touch": _rpc_state_touch,
+    "purge_expired_state": _rpc_purge_expired_state,
+    "claim_pending_request": _rpc_claim_pending_request,
+    "release_pending_request": _rpc_release_pending_request,
+    "postpone_pending_request": _rpc_postpone_pending_request,
+    "patch_pending_payload": _rpc_patch_pending_payload,
+    "rollup_queue_events": _rpc_rollup_queue_events,
+}
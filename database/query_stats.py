@@ -0,0 +1,248 @@
+# database/query_stats.py
+# -*- coding: utf-8 -*-
+"""
+قياس زمن كل استدعاء Supabase (PostgREST/RPC) داخل العملية.
+
+- لكل (الجدول/الدالة، العملية) نحفظ: العدد، الأخطاء، الصفوف، البايتات، وهيستوغرام زمن
+  بأسلوب HDR (log-linear: 16 خانة فرعية لكل قوة 2 ⇒ دقة ~6%) بذاكرة ثابتة تقريبًا.
+- سجل الاستعلامات البطيئة: أي طلب أبطأ من SUPABASE_SLOW_QUERY_MS يُكتب في اللوج
+  ويُحفظ في حلقة بآخر SUPABASE_SLOW_QUERY_KEEP عنصرًا مع موضع الاستدعاء في الكود.
+- عدّاد لكل موضع استدعاء (ملف:دالة) لكشف أنماط N+1 (مثل cleanup_service/feature_flags).
+- dump() يرجع تقريرًا نصيًا (زر "sys:dbstats" في قائمة النظام للأدمن).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+SLOW_QUERY_MS = float(os.getenv("SUPABASE_SLOW_QUERY_MS", "500"))
+SLOW_QUERY_KEEP = int(os.getenv("SUPABASE_SLOW_QUERY_KEEP", "100"))
+QUERY_STATS_ENABLED = os.getenv("SUPABASE_QUERY_STATS", "1") == "1"
+
+_SUB_BITS = 4  # 16 خانة فرعية لكل قوة 2
+
+
+class Histogram:
+    """هيستوغرام زمن log-linear (ميكروثانية) بنمط HDR مبسّط."""
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0
+        self.min: Optional[int] = None
+        self.max = 0
+
+    @staticmethod
+    def _index(v: int) -> int:
+        if v < (1 << _SUB_BITS):
+            return v
+        shift = v.bit_length() - _SUB_BITS - 1
+        return ((shift + 1) << _SUB_BITS) + (v >> shift) - (1 << _SUB_BITS)
+
+    @staticmethod
+    def _value(idx: int) -> int:
+        # الحد الأعلى للخانة (تقدير متحفظ للنسب المئوية)
+        if idx < (1 << _SUB_BITS):
+            return idx
+        shift = (idx >> _SUB_BITS) - 1
+        mant = (idx & ((1 << _SUB_BITS) - 1)) + (1 << _SUB_BITS)
+        return ((mant + 1) << shift) - 1
+
+    def record(self, us: int) -> None:
+        us = max(0, int(us))
+        i = self._index(us)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += us
+        self.min = us if self.min is None else min(self.min, us)
+        self.max = max(self.max, us)
+
+    def percentile(self, p: float) -> int:
+        if not self.count:
+            return 0
+        target = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= target:
+                return min(self._value(i), self.max)
+        return self.max
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class _Series:
+    __slots__ = ("hist", "errors", "rows", "bytes")
+
+    def __init__(self):
+        self.hist = Histogram()
+        self.errors = 0
+        self.rows = 0
+        self.bytes = 0
+
+
+_lock = threading.Lock()
+_series: Dict[Tuple[str, str], _Series] = {}
+_sites: Dict[Tuple[str, str, str], int] = {}
+_slow: Deque[Dict[str, Any]] = deque(maxlen=SLOW_QUERY_KEEP)
+_started = time.time()
+
+_SKIP_PARTS = (
+    os.sep + "httpx" + os.sep,
+    os.sep + "httpcore" + os.sep,
+    os.sep + "postgrest" + os.sep,
+    os.sep + "supabase" + os.sep,
+    os.sep + "database" + os.sep,
+    os.sep + "threading.py",
+    os.sep + "contextlib.py",
+)
+
+
+def _call_site() -> str:
+    """أول إطار خارج طبقة قاعدة البيانات/المكتبات = مكان الاستدعاء في الكود."""
+    f = sys._getframe(1)
+    while f is not None:
+        fn = f.f_code.co_filename
+        if not any(p in fn for p in _SKIP_PARTS):
+            base = os.path.basename(os.path.dirname(fn)) + "/" + os.path.basename(fn)
+            return f"{base}:{f.f_code.co_name}"
+        f = f.f_back
+    return "?"
+
+
+def operation_of(method: str, name: str, prefer: str = "") -> str:
+    m = (method or "").upper()
+    if name.startswith("rpc/"):
+        return "rpc"
+    if m in ("GET", "HEAD"):
+        return "select"
+    if m == "POST":
+        return "upsert" if "resolution=" in (prefer or "") else "insert"
+    if m == "PATCH":
+        return "update"
+    if m == "DELETE":
+        return "delete"
+    return m.lower()
+
+
+def rows_of(response) -> int:
+    """عدد الصفوف من Content-Range إن وُجد، وإلا من طول JSON (للاستجابات الصغيرة)."""
+    try:
+        cr = response.headers.get("content-range") or ""
+        rng = cr.split("/", 1)[0]
+        if "-" in rng:
+            a, b = rng.split("-", 1)
+            return int(b) - int(a) + 1
+        body = response.content or b""
+        if body[:1] == b"[" and len(body) <= 65536:
+            data = response.json()
+            return len(data) if isinstance(data, list) else 1
+        return 1 if body and body not in (b"null", b"[]") else 0
+    except Exception:
+        return 0
+
+
+def record(name: str, op: str, elapsed_s: float, rows: int = 0, nbytes: int = 0,
+           error: bool = False, detail: str = "") -> None:
+    if not QUERY_STATS_ENABLED:
+        return
+    us = int(elapsed_s * 1_000_000)
+    site = _call_site()
+    with _lock:
+        s = _series.get((name, op))
+        if s is None:
+            s = _series[(name, op)] = _Series()
+        s.hist.record(us)
+        s.rows += int(rows or 0)
+        s.bytes += int(nbytes or 0)
+        if error:
+            s.errors += 1
+        k = (site, name, op)
+        _sites[k] = _sites.get(k, 0) + 1
+    ms = us / 1000.0
+    if ms >= SLOW_QUERY_MS:
+        entry = {
+            "ts": time.strftime("%H:%M:%S"),
+            "name": name, "op": op, "ms": round(ms, 1),
+            "rows": rows, "bytes": nbytes, "site": site, "detail": detail[:200],
+        }
+        with _lock:
+            _slow.append(entry)
+        logging.warning("[db-slow] %s %s %.0fms rows=%s bytes=%s at %s %s",
+                        op, name, ms, rows, nbytes, site, detail[:200])
+
+
+def snapshot() -> List[Dict[str, Any]]:
+    """إحصاءات لكل (اسم، عملية) مرتبة حسب مجموع الزمن."""
+    with _lock:
+        out = []
+        for (name, op), s in _series.items():
+            h = s.hist
+            out.append({
+                "name": name, "op": op, "count": h.count, "errors": s.errors,
+                "rows": s.rows, "bytes": s.bytes,
+                "total_ms": round(h.total / 1000.0, 1),
+                "mean_ms": round(h.mean() / 1000.0, 1),
+                "p50_ms": round(h.percentile(50) / 1000.0, 1),
+                "p95_ms": round(h.percentile(95) / 1000.0, 1),
+                "p99_ms": round(h.percentile(99) / 1000.0, 1),
+                "max_ms": round(h.max / 1000.0, 1),
+            })
+    out.sort(key=lambda r: r["total_ms"], reverse=True)
+    return out
+
+
+def top_sites(n: int = 10) -> List[Tuple[str, str, str, int]]:
+    with _lock:
+        items = sorted(_sites.items(), key=lambda kv: kv[1], reverse=True)[:n]
+    return [(site, name, op, cnt) for (site, name, op), cnt in items]
+
+
+def slow_queries(n: int = 20) -> List[Dict[str, Any]]:
+    with _lock:
+        return list(_slow)[-n:]
+
+
+def reset() -> None:
+    global _started
+    with _lock:
+        _series.clear()
+        _sites.clear()
+        _slow.clear()
+        _started = time.time()
+
+
+def dump(top: int = 15) -> str:
+    """تقرير نصي مختصر: أثقل الاستعلامات + أكثر مواضع الاستدعاء + آخر البطيئة."""
+    mins = (time.time() - _started) / 60.0
+    lines = [f"📊 Supabase — آخر {mins:.0f} دقيقة (بطيء ≥ {SLOW_QUERY_MS:.0f}ms)"]
+    lines.append("op name: n | p50/p95/p99 ms | rows | KB")
+    for r in snapshot()[:top]:
+        lines.append(
+            f"{r['op']} {r['name']}: {r['count']}"
+            f"{' (err ' + str(r['errors']) + ')' if r['errors'] else ''}"
+            f" | {r['p50_ms']}/{r['p95_ms']}/{r['p99_ms']}"
+            f" | {r['rows']} | {r['bytes'] // 1024}"
+        )
+    sites = top_sites(top)
+    if sites:
+        lines.append("")
+        lines.append("🔁 أكثر مواضع الاستدعاء (N+1):")
+        for site, name, op, cnt in sites:
+            lines.append(f"{cnt}× {site} → {op} {name}")
+    slow = slow_queries(10)
+    if slow:
+        lines.append("")
+        lines.append("🐢 آخر الاستعلامات البطيئة:")
+        for e in slow:
+            lines.append(f"{e['ts']} {e['ms']}ms {e['op']} {e['name']} @ {e['site']}")
+    return "\n".join(lines)
@@ -0,0 +1,84 @@
+# database/single_flight.py
+# -*- coding: utf-8 -*-
+"""
+Single-flight: الطلبات المتطابقة المتزامنة تتشارك تنفيذًا واحدًا.
+
+أول خيط (leader) ينفّذ الدالة فعليًا؛ أي خيط يصل بنفس المفتاح أثناء التنفيذ
+(follower) ينتظر ويأخذ نفس النتيجة/الاستثناء بدل رحلة شبكة جديدة.
+لا يوجد كاش: بعد انتهاء الطلب يُحذف المفتاح فورًا.
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+
+class _Call:
+    __slots__ = ("event", "value", "error", "dups")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value: Any = None
+        self.error: BaseException | None = None
+        self.dups = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.leaders = 0      # طلبات وصلت للشبكة فعلًا
+        self.hits = 0         # طلبات انضمت لطلب جارٍ (رحلات شبكة موفّرة)
+        self.errors = 0       # طلبات leader فشلت (تُنقل لكل المنتظرين)
+        self.max_dups = 0     # أعلى عدد منتظرين على طلب واحد (ذروة)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.dups += 1
+                self.hits += 1
+                if call.dups > self.max_dups:
+                    self.max_dups = call.dups
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.leaders + self.hits
+            return {
+                "leaders": self.leaders,
+                "hits": self.hits,
+                "errors": self.errors,
+                "in_flight": len(self._calls),
+                "max_dups": self.max_dups,
+                "saved_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.leaders = self.hits = self.errors = self.max_dups = 0
@@ -0,0 +1,62 @@
+-- 0006_wallet_snapshot.sql
+-- لقطة المحفظة في رحلة واحدة: upsert المستخدم إن لم يوجد + الرصيد/المحجوز/المتاح
+-- + نسبة الخصم المجمّعة (أعلى إدمن + أعلى إحالة، سقف 100%) + حالة الحظر.
+-- نفس منطق services/discount_service.apply_discount_stacked و ban_service.is_banned.
+create or replace function public.wallet_snapshot(p_user_id bigint, p_name text default null)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_balance bigint := 0;
+  v_held bigint := 0;
+  v_admin int := 0;
+  v_referral int := 0;
+  v_banned boolean := false;
+  v_until timestamptz;
+  v_reason text;
+begin
+  if p_name is null then
+    insert into public.houssin363(user_id, name)
+    values (p_user_id, 'مستخدم')
+    on conflict (user_id) do nothing;
+  else
+    insert into public.houssin363(user_id, name)
+    values (p_user_id, p_name)
+    on conflict (user_id) do update set name = excluded.name;
+  end if;
+
+  select coalesce(balance, 0), coalesce(held, 0)
+    into v_balance, v_held
+  from public.houssin363
+  where user_id = p_user_id;
+
+  select
+    coalesce(max(percent) filter (where coalesce(lower(source), 'admin') <> 'referral'), 0),
+    coalesce(max(percent) filter (where lower(source) = 'referral'), 0)
+    into v_admin, v_referral
+  from public.discounts
+  where active
+    and coalesce(starts_at, now()) <= now()
+    and (ends_at is null or ends_at > now())
+    and (scope = 'global' or (scope = 'user' and user_id = p_user_id));
+
+  select true, banned_until, reason
+    into v_banned, v_until, v_reason
+  from public.banned_users
+  where user_id = p_user_id
+    and (banned_until is null or banned_until > now());
+
+  return jsonb_build_object(
+    'user_id', p_user_id,
+    'balance', v_balance,
+    'held', v_held,
+    'available', v_balance - v_held,
+    'admin_percent', v_admin,
+    'referral_percent', v_referral,
+    'discount_percent', least(100, v_admin + v_referral),
+    'banned', coalesce(v_banned, false),
+    'banned_until', v_until,
+    'ban_reason', v_reason
+  );
+end;
+$$;
@@ -0,0 +1,90 @@
+-- 0007_state_rpcs.sql
+-- تعديل user_state.vars (JSONB) ذرّيًا في جملة واحدة بدل قراءة-تعديل-كتابة من بايثون:
+--   state_set_keys : دمج مفاتيح (||) + حذف مفاتيح (-) + الإبقاء على مفاتيح فقط (p_keep) + expires_at
+--   state_del_keys : حذف مفاتيح؛ يُحذف الصف إذا أصبحت vars فارغة
+--   state_touch    : تمديد الصلاحية (expires_at و vars.__state_exp) بلا قراءة
+-- يستخدمها services/state_service.py؛ تعتمد على UNIQUE(user_id, state_key) (0002_indexes.sql).
+
+create or replace function public.state_set_keys(
+  p_user_id bigint,
+  p_state_key text,
+  p_vars jsonb,
+  p_expires_at timestamptz default null,
+  p_del text[] default null,
+  p_keep text[] default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_key text := coalesce(p_state_key, 'global');
+  v_vars jsonb;
+begin
+  insert into public.user_state as s (user_id, state_key, vars, expires_at, updated_at)
+  values (p_user_id, v_key, coalesce(p_vars, '{}'::jsonb), p_expires_at, now())
+  on conflict (user_id, state_key) do update
+    set vars = (
+          case
+            when p_keep is null then coalesce(s.vars, '{}'::jsonb)
+            else coalesce((select jsonb_object_agg(e.key, e.value)
+                             from jsonb_each(coalesce(s.vars, '{}'::jsonb)) e
+                            where e.key = any(p_keep)), '{}'::jsonb)
+          end
+          - coalesce(p_del, '{}'::text[])
+        ) || coalesce(excluded.vars, '{}'::jsonb),
+        expires_at = coalesce(excluded.expires_at, s.expires_at),
+        updated_at = now()
+  returning s.vars into v_vars;
+
+  if v_vars = '{}'::jsonb then
+    delete from public.user_state where user_id = p_user_id and state_key = v_key;
+  end if;
+  return v_vars;
+end;
+$$;
+
+create or replace function public.state_del_keys(
+  p_user_id bigint,
+  p_state_key text,
+  p_keys text[]
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_key text := coalesce(p_state_key, 'global');
+  v_vars jsonb;
+begin
+  update public.user_state
+     set vars = coalesce(vars, '{}'::jsonb) - coalesce(p_keys, '{}'::text[]),
+         updated_at = now()
+   where user_id = p_user_id and state_key = v_key
+  returning vars into v_vars;
+
+  if v_vars is null then
+    return '{}'::jsonb;
+  end if;
+  if v_vars = '{}'::jsonb then
+    delete from public.user_state where user_id = p_user_id and state_key = v_key;
+  end if;
+  return v_vars;
+end;
+$$;
+
+create or replace function public.state_touch(
+  p_user_id bigint,
+  p_state_key text,
+  p_expires_at timestamptz
+)
+returns boolean
+language sql
+as $$
+  update public.user_state
+     set expires_at = p_expires_at,
+         vars = case when vars ? '__state_exp'
+                     then vars || jsonb_build_object('__state_exp', to_jsonb(p_expires_at))
+                     else vars end,
+         updated_at = now()
+   where user_id = p_user_id and state_key = coalesce(p_state_key, 'global')
+  returning true;
+$$;
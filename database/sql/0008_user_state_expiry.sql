@@ -0,0 +1,27 @@
+-- 0008_user_state_expiry.sql
+-- كنس الحالات المنتهية بالجملة عبر عمود expires_at بدل التنظيف الكسول في مسار القراءة:
+--   فهرس جزئي على expires_at + دالة purge_expired_state تحذف دفعة محدودة وترجع المفاتيح المحذوفة
+--   (ليُبطِل services/state_service كاشه المحلي). يستدعيها services/cleanup_service.sweep_expired_state.
+
+CREATE INDEX IF NOT EXISTS idx_user_state_expires_at
+  ON user_state(expires_at)
+  WHERE expires_at IS NOT NULL;
+
+create or replace function public.purge_expired_state(p_limit int default 500)
+returns table(user_id bigint, state_key text)
+language sql
+as $$
+  with doomed as (
+    select s.ctid
+      from public.user_state s
+     where s.expires_at is not null
+       and s.expires_at < now()
+     order by s.expires_at
+     limit greatest(coalesce(p_limit, 500), 1)
+     for update skip locked
+  )
+  delete from public.user_state s
+   using doomed
+   where s.ctid = doomed.ctid
+  returning s.user_id, s.state_key;
+$$;
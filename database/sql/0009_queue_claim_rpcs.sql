@@ -0,0 +1,135 @@
+-- 0009_queue_claim_rpcs.sql
+-- أقفال طابور الإدمن (pending_requests.payload) بجملة واحدة ذرّية بدل قراءة-فحص-كتابة من بايثون:
+--   claim_pending_request    : يحجز الطلب للأدمن إن كان غير محجوز (أو محجوزًا له أصلًا)
+--   release_pending_request  : يفك القفل (لصاحبه فقط، أو لأي أحد مع p_admin_id = null)
+--   postpone_pending_request : يفك القفل ويعيد الطلب لآخر الدور (created_at = now())
+--   patch_pending_payload    : دمج/حذف مفاتيح في payload بلا قراءة مسبقة
+-- كلها ترجع الصف {id, user_id, request_text, created_at, payload} + ok، أو null إن لم يوجد الطلب.
+-- يستخدمها services/queue_service.py (claim_request/release_request/postpone_request/_payload_update).
+
+create or replace function public._pending_row_json(r public.pending_requests, p_ok boolean)
+returns jsonb
+language sql
+immutable
+as $$
+  select jsonb_build_object(
+    'ok', p_ok,
+    'id', r.id,
+    'user_id', r.user_id,
+    'request_text', r.request_text,
+    'created_at', r.created_at,
+    'payload', coalesce(r.payload, '{}'::jsonb)
+  );
+$$;
+
+create or replace function public.claim_pending_request(
+  p_request_id bigint,
+  p_admin_id bigint,
+  p_admin_name text default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  r public.pending_requests;
+begin
+  update public.pending_requests
+     set payload = coalesce(payload, '{}'::jsonb) || jsonb_build_object(
+           'locked_by', p_admin_id,
+           'locked_by_username', p_admin_name,
+           'claimed', true)
+   where id = p_request_id
+     and (payload->>'locked_by' is null or payload->>'locked_by' = p_admin_id::text)
+  returning * into r;
+
+  if found then
+    return public._pending_row_json(r, true);
+  end if;
+
+  -- محجوز لأدمن آخر (أو غير موجود): نرجع الصف الحالي ليعرض المنادي صاحب القفل
+  select * into r from public.pending_requests where id = p_request_id;
+  if not found then
+    return null;
+  end if;
+  return public._pending_row_json(r, false);
+end;
+$$;
+
+create or replace function public.release_pending_request(
+  p_request_id bigint,
+  p_admin_id bigint default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  r public.pending_requests;
+begin
+  update public.pending_requests
+     set payload = coalesce(payload, '{}'::jsonb) - array['locked_by', 'locked_by_username', 'claimed']
+   where id = p_request_id
+     and (p_admin_id is null or payload->>'locked_by' is null or payload->>'locked_by' = p_admin_id::text)
+  returning * into r;
+
+  if found then
+    return public._pending_row_json(r, true);
+  end if;
+  select * into r from public.pending_requests where id = p_request_id;
+  if not found then
+    return null;
+  end if;
+  return public._pending_row_json(r, false);
+end;
+$$;
+
+create or replace function public.postpone_pending_request(
+  p_request_id bigint,
+  p_admin_id bigint default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  r public.pending_requests;
+begin
+  update public.pending_requests
+     set payload = coalesce(payload, '{}'::jsonb) - array['locked_by', 'locked_by_username', 'claimed'],
+         created_at = now()
+   where id = p_request_id
+     and (p_admin_id is null or payload->>'locked_by' is null or payload->>'locked_by' = p_admin_id::text)
+  returning * into r;
+
+  if found then
+    return public._pending_row_json(r, true);
+  end if;
+  select * into r from public.pending_requests where id = p_request_id;
+  if not found then
+    return null;
+  end if;
+  return public._pending_row_json(r, false);
+end;
+$$;
+
+create or replace function public.patch_pending_payload(
+  p_request_id bigint,
+  p_set jsonb default '{}'::jsonb,
+  p_del text[] default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  r public.pending_requests;
+begin
+  update public.pending_requests
+     set payload = (coalesce(payload, '{}'::jsonb) - coalesce(p_del, '{}'::text[]))
+                   || coalesce(p_set, '{}'::jsonb)
+   where id = p_request_id
+  returning * into r;
+
+  if not found then
+    return null;
+  end if;
+  return public._pending_row_json(r, true);
+end;
+$$;
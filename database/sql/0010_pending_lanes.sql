@@ -0,0 +1,22 @@
+-- 0010_pending_lanes.sql
+-- مسارات وأولويات طابور الإدمن (services/queue_lanes.py):
+--   lane     : recharge | purchase | transfers | ads (من payload.type عند الإدراج)
+--   priority : أعلى = أسبق داخل المسار (الطلبات عالية القيمة = 1)
+-- الجدولة الموزونة والتقادم في services/queue_dispatcher؛ الفهرس يخدم قراءة رأس كل مسار.
+
+alter table public.pending_requests add column if not exists lane text not null default 'purchase';
+alter table public.pending_requests add column if not exists priority smallint not null default 0;
+
+-- الطلبات الموجودة قبل الترحيل
+update public.pending_requests
+   set lane = case payload->>'type'
+                when 'recharge' then 'recharge'
+                when 'ads' then 'ads'
+                when 'cash_transfer' then 'transfers'
+                when 'companies_transfer' then 'transfers'
+                else 'purchase'
+              end
+ where lane = 'purchase';
+
+create index if not exists idx_pending_requests_lane_created
+  on public.pending_requests(lane, priority desc, created_at);
@@ -0,0 +1,170 @@
+-- 0011_queue_events.sql
+-- تحليلات طابور الإدمن (services/queue_events.py):
+--   queue_events        : حدث لكل انتقال في دورة حياة الطلب
+--                         created | dispatched | claimed | postponed | accepted | cancelled
+--                         wait_ms = الزمن منذ دخول الطلب الطابور (payload.enqueued_at) حتى الحدث
+--   queue_stats_hourly  : تجميع ساعي تراكمي (عدد، مجموع/أقصى الانتظار، مدرّج تكراري)
+--   rollup_queue_events : يضيف الأحداث الجديدة فقط (علامة آخر id في queue_rollup_state)
+--                         ويحذف الأحداث الخام الأقدم من p_keep_days. الـid يُحجز عند الإدراج
+--                         ويظهر عند commit، فلا نتجاوز أي حدث أحدث من p_lag_seconds: دفعة
+--                         تأخر commit-ها بـid أصغر لا تسقط خلف العلامة.
+--   claim_pending_request (إعادة تعريف 0009): يضيف was_unlocked = القفل انتقل من null لهذا
+--                         الأدمن الآن (لا نقرة مزدوجة من صاحبه) — أساس حدث claimed.
+-- حدود المدرّج بالثواني: 10,30,60,120,300,600,1200,1800,3600,7200,21600 → 12 خانة
+-- (الخانة 1 = أقل من 10 ثوانٍ، الخانة 12 = 6 ساعات فأكثر). p50/p95 تُقدَّر من المدرّج.
+
+create table if not exists public.queue_events (
+  id          bigserial primary key,
+  request_id  bigint not null,
+  event       text not null check (event in ('created', 'dispatched', 'claimed', 'postponed', 'accepted', 'cancelled')),
+  user_id     bigint,
+  admin_id    bigint,
+  lane        text,
+  wait_ms     bigint,
+  created_at  timestamptz not null default now()
+);
+
+create index if not exists idx_queue_events_created on public.queue_events(created_at);
+create index if not exists idx_queue_events_request on public.queue_events(request_id);
+
+create table if not exists public.queue_stats_hourly (
+  hour         timestamptz not null,
+  event        text not null,
+  lane         text not null default '',
+  admin_id     bigint not null default 0,
+  n            integer not null default 0,
+  wait_ms_sum  bigint not null default 0,
+  wait_ms_max  bigint not null default 0,
+  wait_hist    integer[] not null default array_fill(0, array[12]),
+  primary key (hour, event, lane, admin_id)
+);
+
+create index if not exists idx_queue_stats_hourly_hour on public.queue_stats_hourly(hour);
+
+create table if not exists public.queue_rollup_state (
+  id             smallint primary key default 1 check (id = 1),
+  last_event_id  bigint not null default 0,
+  updated_at     timestamptz not null default now()
+);
+
+insert into public.queue_rollup_state(id, last_event_id) values (1, 0)
+on conflict (id) do nothing;
+
+create or replace function public._int_array_add(a integer[], b integer[])
+returns integer[]
+language sql
+immutable
+as $$
+  select coalesce(array_agg(coalesce(x, 0) + coalesce(y, 0) order by i), '{}'::integer[])
+    from unnest(a, b) with ordinality as t(x, y, i);
+$$;
+
+create or replace function public.claim_pending_request(
+  p_request_id bigint,
+  p_admin_id bigint,
+  p_admin_name text default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  r public.pending_requests;
+  v_prev text;
+begin
+  -- قفل الصف: قراءة صاحب القفل السابق والتحديث بلا سباق
+  select payload->>'locked_by' into v_prev
+    from public.pending_requests where id = p_request_id for update;
+  if not found then
+    return null;
+  end if;
+
+  if v_prev is not null and v_prev <> p_admin_id::text then
+    select * into r from public.pending_requests where id = p_request_id;
+    return public._pending_row_json(r, false) || jsonb_build_object('was_unlocked', false);
+  end if;
+
+  update public.pending_requests
+     set payload = coalesce(payload, '{}'::jsonb) || jsonb_build_object(
+           'locked_by', p_admin_id,
+           'locked_by_username', p_admin_name,
+           'claimed', true)
+   where id = p_request_id
+  returning * into r;
+  return public._pending_row_json(r, true) || jsonb_build_object('was_unlocked', v_prev is null);
+end;
+$$;
+
+drop function if exists public.rollup_queue_events(integer, integer);
+
+create or replace function public.rollup_queue_events(
+  p_limit integer default 50000,
+  p_keep_days integer default 30,
+  p_lag_seconds integer default 60
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_from bigint;
+  v_to   bigint;
+  v_n    integer;
+  v_young bigint;
+  v_cutoff timestamptz := now() - make_interval(secs => greatest(p_lag_seconds, 0));
+  v_purged integer;
+begin
+  -- قفل الصف يمنع تشغيلين متزامنين من عدّ نفس الأحداث مرتين
+  select last_event_id into v_from from public.queue_rollup_state where id = 1 for update;
+  if not found then
+    insert into public.queue_rollup_state(id, last_event_id) values (1, 0);
+    v_from := 0;
+  end if;
+
+  -- أول حدث ما زال ضمن هامش commit: العلامة لا تتجاوزه ولو وُجدت أحداث أقدم بعده
+  select min(id) into v_young from public.queue_events where id > v_from and created_at >= v_cutoff;
+
+  select max(id), count(*) into v_to, v_n
+    from (select id from public.queue_events
+           where id > v_from and created_at < v_cutoff and (v_young is null or id < v_young)
+           order by id limit greatest(p_limit, 1)) s;
+
+  if v_to is not null then
+    insert into public.queue_stats_hourly as h (hour, event, lane, admin_id, n, wait_ms_sum, wait_ms_max, wait_hist)
+    select hour, event, lane, admin_id,
+           count(*),
+           coalesce(sum(wait_ms), 0),
+           coalesce(max(wait_ms), 0),
+           array[count(*) filter (where b = 1),  count(*) filter (where b = 2),
+                 count(*) filter (where b = 3),  count(*) filter (where b = 4),
+                 count(*) filter (where b = 5),  count(*) filter (where b = 6),
+                 count(*) filter (where b = 7),  count(*) filter (where b = 8),
+                 count(*) filter (where b = 9),  count(*) filter (where b = 10),
+                 count(*) filter (where b = 11), count(*) filter (where b = 12)]::integer[]
+      from (
+        select date_trunc('hour', e.created_at) as hour,
+               e.event,
+               coalesce(e.lane, '') as lane,
+               coalesce(e.admin_id, 0) as admin_id,
+               e.wait_ms,
+               width_bucket(coalesce(e.wait_ms, 0) / 1000.0,
+                            array[10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 21600]::numeric[]) + 1 as b
+          from public.queue_events e
+         where e.id > v_from and e.id <= v_to and e.created_at < v_cutoff
+      ) ev
+     group by hour, event, lane, admin_id
+    on conflict (hour, event, lane, admin_id) do update
+       set n           = h.n + excluded.n,
+           wait_ms_sum = h.wait_ms_sum + excluded.wait_ms_sum,
+           wait_ms_max = greatest(h.wait_ms_max, excluded.wait_ms_max),
+           wait_hist   = public._int_array_add(h.wait_hist, excluded.wait_hist);
+
+    update public.queue_rollup_state set last_event_id = v_to, updated_at = now() where id = 1;
+  end if;
+
+  delete from public.queue_events
+   where id <= coalesce(v_to, v_from)
+     and created_at < now() - make_interval(days => greatest(p_keep_days, 1));
+  get diagnostics v_purged = row_count;
+
+  return jsonb_build_object('rolled', coalesce(v_n, 0), 'last_event_id', coalesce(v_to, v_from), 'purged', v_purged);
+end;
+$$;
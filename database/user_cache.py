@@ -0,0 +1,121 @@
+# database/user_cache.py
+# -*- coding: utf-8 -*-
+"""
+كاش صفوف المستخدمين (houssin363) داخل العملية: user_id -> الصف كاملًا.
+
+- LRU بحد أقصى USER_CACHE_SIZE صفًا، وعمر أقصى USER_CACHE_TTL ثانية (للتغييرات التي
+  لا تمر بنا: انتهاء holds في Postgres، تعديل يدوي من لوحة Supabase...).
+- لا رصيد قديم بعد كتاباتنا: لكل مستخدم "جيل" يرتفع مع كل كتابة/RPC تخصّه؛
+  القراءة التي بدأت قبل الكتابة لا تُخزَّن نتيجتها (put يتحقق من الجيل).
+- write-through: استجابة PATCH/upsert على جدول المستخدمين (return=representation)
+  تُخزَّن مباشرة إن لم تتداخل معها كتابة أخرى، وإلا يُبطَل الصف فقط.
+- الربط بالكتابات يتم في database/db.py (_PostgrestSession) فيشمل كل المسارات.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+Gen = Tuple[int, int]
+
+
+class UserCache:
+    def __init__(self, max_size: int = 5000, ttl: float = 30.0):
+        self.max_size = max(1, int(max_size))
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self._rows: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._gen: Dict[int, int] = {}
+        self._epoch = 0  # يرتفع عند clear() (كتابة لا نعرف مستخدمها)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(user_id) -> Optional[int]:
+        try:
+            return int(user_id)
+        except (TypeError, ValueError):
+            return None
+
+    def generation(self, user_id) -> Gen:
+        k = self._key(user_id)
+        with self._lock:
+            return self._epoch, self._gen.get(k, 0)
+
+    def get(self, user_id) -> Optional[Dict[str, Any]]:
+        k = self._key(user_id)
+        with self._lock:
+            item = self._rows.get(k)
+            if item is None or time.monotonic() - item[0] > self.ttl:
+                if item is not None:
+                    del self._rows[k]
+                self.misses += 1
+                return None
+            self._rows.move_to_end(k)
+            self.hits += 1
+            return dict(item[1])
+
+    def _store(self, k: int, row: Dict[str, Any]) -> None:
+        self._rows[k] = (time.monotonic(), dict(row))
+        self._rows.move_to_end(k)
+        while len(self._rows) > self.max_size:
+            self._rows.popitem(last=False)
+            self.evictions += 1
+
+    def put(self, user_id, row: Dict[str, Any], gen: Gen) -> None:
+        """يخزّن نتيجة قراءة بدأت عند الجيل gen — فقط إن لم تحدث كتابة بعدها."""
+        k = self._key(user_id)
+        if k is None:
+            return
+        with self._lock:
+            if (self._epoch, self._gen.get(k, 0)) == gen:
+                self._store(k, row)
+
+    def write_through(self, user_id, row: Dict[str, Any], gen: Gen) -> None:
+        """صف ناتج عن كتابتنا: يُخزَّن إن لم تتداخل كتابة أخرى منذ gen، وإلا يُبطَل."""
+        k = self._key(user_id)
+        if k is None:
+            return
+        with self._lock:
+            same = (self._epoch, self._gen.get(k, 0)) == gen
+            self._gen[k] = self._gen.get(k, 0) + 1
+            if same:
+                self._store(k, row)
+            else:
+                self._rows.pop(k, None)
+                self.invalidations += 1
+
+    def invalidate(self, user_id) -> None:
+        k = self._key(user_id)
+        if k is None:
+            return
+        with self._lock:
+            self._gen[k] = self._gen.get(k, 0) + 1
+            self._rows.pop(k, None)
+            self.invalidations += 1
+            if len(self._gen) > self.max_size * 4:
+                # الأجيال القديمة لمستخدمين غير مخزَّنين لا تلزم؛ رفع epoch يُبطل القراءات الجارية
+                self._gen = {u: g for u, g in self._gen.items() if u in self._rows}
+                self._epoch += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rows.clear()
+            self._gen.clear()
+            self._epoch += 1
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._rows), "max_size": self.max_size, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "invalidations": self.invalidations, "evictions": self.evictions,
+            }
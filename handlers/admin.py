@@ -160,6 +160,7 @@ def _collect_clients_with_names():
 
     
 from services.state_service import purge_state
+from services.state_adapter import UserStateDictLike
 from services.products_admin import set_product_active, get_product_active, bulk_ensure_products
 from services.report_service import totals_deposits_and_purchases_syp, pending_queue_count, summary
 from services.discount_service import (
@@ -174,6 +175,7 @@ from services.queue_service import (
     process_queue,
     delete_pending_request,
     postpone_request,
+    claim_request,
     queue_cooldown_start,
 )
 from services.wallet_service import (
@@ -223,6 +225,7 @@ from handlers.products import PRODUCTS
 
 # لوحة المزايا (المحفظة وطرق الشحن…)
 from services.feature_flags import ensure_seed, list_features, set_feature_active, list_features_grouped
+from services import startup
 
 # محاولة استيراد منظّم الشحن لإزالة القفل المحلي بعد القبول/الإلغاء (استيراد كسول وآمن)
 from services.validators import parse_user_id, parse_duration_choice
@@ -239,7 +242,8 @@ except Exception:
 _cancel_pending = {}
 _accept_pending = {}
 _msg_pending = {}
-_broadcast_pending = {}
+# بث الأدمن متعدد الخطوات — في مخزن الحالة (services/state_backend) فلا يضيع مع restart_bot
+_broadcast_pending = UserStateDictLike(state_key="admin_broadcast", live=True)
 _msg_by_id_pending = {}
 _ban_pending = {}
 _unban_pending = {}
@@ -308,6 +312,14 @@ def _admin_mention(bot, user_id: int) -> str:
     except Exception:
         return str(user_id)
 
+def _queue_analytics_html(bot) -> str:
+    # تقرير services/queue_events (انتظار p50/p95 + إنتاجية كل أدمن) بأسماء الأدمن
+    import html as _html
+    from services.queue_events import report as queue_events_report
+    names = {aid: _admin_mention(bot, aid) for aid in {ADMIN_MAIN_ID, *ADMINS}}
+    rep = (queue_events_report(names=names) or "")[:3800]
+    return f"<pre>{_html.escape(rep)}</pre>"
+
 def _safe(v, dash="—"):
     v = ("" if v is None else str(v)).strip()
     return v if v else dash
@@ -1154,11 +1166,9 @@ def register(bot, history):
     cash_transfer.register(bot, history)
     companies_transfer.register_companies_transfer(bot, history)
 
-    # زرع مزايا افتراضية (مرة عند الإقلاع)
-    try:
-        ensure_seed()
-    except Exception:
-        pass
+    # زرع مزايا افتراضية (مرة عند الإقلاع) — مؤجّل لما بعد أول getUpdates
+    # لأنه رحلتان لكل مفتاح؛ المفاتيح الغائبة تُعامل بقيمتها الافتراضية حتى ذلك الحين
+    startup.defer("features ensure_seed", ensure_seed)
 
     # إلغاء لأي وضع إدخال للأدمن (/cancel)
     @bot.message_handler(commands=['cancel'])
@@ -1175,13 +1185,13 @@ def register(bot, history):
     @bot.message_handler(func=lambda msg: msg.text and re.match(r'/done_(\d+)', msg.text) and _is_admin_msg(msg))
     def handle_done(msg):
         req_id = int(re.match(r'/done_(\d+)', msg.text).group(1))
-        delete_pending_request(req_id)
+        delete_pending_request(req_id, "accepted", admin_id=msg.from_user.id)
         bot.reply_to(msg, f"✅ تم إنهاء الطلب {req_id}")
 
     @bot.message_handler(func=lambda msg: msg.text and re.match(r'/cancel_(\d+)', msg.text) and _is_admin_msg(msg))
     def handle_cancel(msg):
         req_id = int(re.match(r'/cancel_(\d+)', msg.text).group(1))
-        delete_pending_request(req_id)
+        delete_pending_request(req_id, "cancelled", admin_id=msg.from_user.id)
         bot.reply_to(msg, f"🚫 تم إلغاء الطلب {req_id}")
 
     # ────────────────────────────────────────────────
@@ -1239,17 +1249,27 @@ def register(bot, history):
         action     = parts[2]
         request_id = int(parts[3])
 
-        # جلب الطلب
-        res = (
-            get_table("pending_requests")
-            .select("user_id, request_text, payload")
-            .eq("id", request_id)
-            .execute()
-        )
+        u = call.from_user
+        my_mention = f"@{u.username}" if getattr(u, "username", None) else ((u.first_name or "").strip() or str(u.id))
 
-        if not getattr(res, "data", None):
+        # جلب الطلب — «📌 استلمت» يجلبه ويحجزه في استدعاء ذرّي واحد (claim_pending_request)
+        if action == 'claim':
+            try:
+                req = claim_request(request_id, call.from_user.id, my_mention)
+            except Exception as e:
+                logging.exception('[ADMIN] claim failed: %s', e)
+                return bot.answer_callback_query(call.id, "تعذّر الاستلام، حاول مجددًا.")
+        else:
+            res = (
+                get_table("pending_requests")
+                .select("user_id, request_text, payload, created_at")
+                .eq("id", request_id)
+                .execute()
+            )
+            req = res.data[0] if getattr(res, "data", None) else None
+
+        if not req:
             return bot.answer_callback_query(call.id, "❌ الطلب غير موجود.")
-        req      = res.data[0]
         user_id  = req["user_id"]
         payload  = req.get("payload") or {}
         req_text = req.get("request_text") or ""
@@ -1264,7 +1284,7 @@ def register(bot, history):
             return bot.answer_callback_query(call.id, f'🔒 محجوز بواسطة {who}')
 
         # 🛑 بوابة "لا تتجاوب الأزرار قبل استلمت"
-        if action != 'claim' and not payload.get('claimed'):
+        if action != 'claim' and not (payload.get('claimed') and locked_by):
             return bot.answer_callback_query(call.id, "👋 اضغط «📌 استلمت» أولاً لتفعيل الأزرار.")
 
 
@@ -1290,42 +1310,10 @@ def register(bot, history):
             except Exception:
                 pass
                 
-        # لو ما في قفل، فعِّل القفل (كما هو عندك)
-        if not locked_by:
-            try:
-                locked_by_username = _admin_mention(bot, call.from_user.id)
-                new_payload = dict(payload)
-                new_payload['locked_by'] = int(call.from_user.id)
-                new_payload['locked_by_username'] = locked_by_username
-
-                # 👇 تحديث ذرّي: لا ينجح إلا إذا كان القفل فارغًا حاليًا
-                res = (
-                    get_table('pending_requests')
-                    .update({'payload': new_payload})
-                    .eq('id', request_id)
-                    .filter('payload->>locked_by', 'is', 'null')
-                    .execute()
-                )
-                if not getattr(res, "data", None):
-                    return bot.answer_callback_query(call.id, "🔒 الطلب مُقفل للتو من أدمن آخر.")
-
-                _disable_others(except_aid=call.message.chat.id, except_mid=call.message.message_id)
-                _mark_locked_here()
-                payload = new_payload  # حدّث النسخة المحلية
-
-            except Exception as e:
-                logging.exception('[ADMIN] failed to set lock: %s', e)
-
-
-        # === زر الاستلام (📌 استلمت) ===
+        # === زر الاستلام (📌 استلمت) === القفل + claimed تمّا ذرّيًا في claim_request أعلاه
         if action == 'claim':
-            try:
-                # علِّم أنه "تم الاستلام" لتُفتح الأزرار لاحقًا
-                claimed_payload = dict(payload)
-                claimed_payload['claimed'] = True
-                get_table('pending_requests').update({'payload': claimed_payload}).eq('id', request_id).execute()
-            except Exception as e:
-                logging.exception('[ADMIN] failed to set claimed: %s', e)
+            _disable_others(except_aid=call.message.chat.id, except_mid=call.message.message_id)
+            _mark_locked_here()
             bot.answer_callback_query(call.id, '✅ تم الاستلام — أنت المتحكم بهذا الطلب الآن.')
             return
 
@@ -1342,16 +1330,8 @@ def register(bot, history):
                 remove_inline_keyboard(bot, call.message)
             except Exception:
                 pass
-            # ... بعد remove_inline_keyboard و قبل أو بعد postpone_request
-            new_payload = dict(payload)
-            for k in ("locked_by", "locked_by_username", "claimed"):
-                new_payload.pop(k, None)
-            try:
-                get_table('pending_requests').update({'payload': new_payload}).eq('id', request_id).execute()
-            except Exception:
-                pass
-
-            postpone_request(request_id)
+            # فك القفل + claimed + إعادة الطلب لآخر الدور في استدعاء واحد
+            postpone_request(request_id, call.from_user.id)
     
             # إبلاغ العميل برسالة اعتذار/تنظيم الدور
             try:
@@ -1389,7 +1369,7 @@ def register(bot, history):
                 if reserved > 0:
                     add_balance(user_id, reserved, "إلغاء حجز (قديم)")
 
-            delete_pending_request(request_id)
+            delete_pending_request(request_id, "cancelled", admin_id=call.from_user.id, req=req)
             if reserved > 0:
                 bot.send_message(user_id, f"🚫 تم إلغاء طلبك.\n🔁 رجّعنا {_fmt_syp(reserved)} من المبلغ المحجوز لمحفظتك — كله تمام 😎")
             else:
@@ -1462,7 +1442,7 @@ def register(bot, history):
                 except Exception:
                     pass
 
-                delete_pending_request(request_id)
+                delete_pending_request(request_id, "accepted", admin_id=call.from_user.id, req=req)
                 # ✅ أرسل للعميل تفاصيل السعر قبل/بعد الخصم (إن وُجد خصم)
                 try:
                     before = int(payload.get("price_before") or amt)
@@ -1511,7 +1491,7 @@ def register(bot, history):
                 except Exception:
                     pass
 
-                delete_pending_request(request_id)
+                delete_pending_request(request_id, "accepted", admin_id=call.from_user.id, req=req)
 
                 # NEW: أنشئ إعلانًا فعّالًا لبدء النشر الآلي ضمن نافذة 9→22 بتوقيت دمشق
                 try:
@@ -1550,7 +1530,7 @@ def register(bot, history):
                 except Exception:
                     pass
 
-                delete_pending_request(request_id)
+                delete_pending_request(request_id, "accepted", admin_id=call.from_user.id, req=req)
                 bot.send_message(
                     user_id,
                     f"{BAND}\n✅ تمام يا {_h(name)}! تم تحويل {_h(unit_name)} للرقم «{_h(_safe(num))}» "
@@ -1578,7 +1558,7 @@ def register(bot, history):
                 except Exception:
                     pass
 
-                delete_pending_request(request_id)
+                delete_pending_request(request_id, "accepted", admin_id=call.from_user.id, req=req)
                 bot.send_message(
                     user_id,
                     f"{BAND}\n🧾 تمام يا {_h(name)}! تم دفع {_h(label)} للرقم «{_h(_safe(num))}» "
@@ -1607,7 +1587,7 @@ def register(bot, history):
                 except Exception:
                     pass
 
-                delete_pending_request(request_id)
+                delete_pending_request(request_id, "accepted", admin_id=call.from_user.id, req=req)
                 bot.send_message(
                     user_id,
                     f"{BAND}\n🌐 تمام يا {_h(name)}! تم دفع فاتورة الإنترنت ({_h(name_lbl)}) للرقم «{_h(_safe(phone))}» "
@@ -1630,7 +1610,7 @@ def register(bot, history):
                 except Exception:
                     pass
 
-                delete_pending_request(request_id)
+                delete_pending_request(request_id, "accepted", admin_id=call.from_user.id, req=req)
                 bot.send_message(
                     user_id,
                     f"{BAND}\n💸 تمام يا {_h(name)}! تم تنفيذ {_h(name_lbl)} للرقم «{_h(_safe(number))}» "
@@ -1658,7 +1638,7 @@ def register(bot, history):
                 except Exception:
                     pass
 
-                delete_pending_request(request_id)
+                delete_pending_request(request_id, "accepted", admin_id=call.from_user.id, req=req)
                 bot.send_message(
                     user_id,
                     f"{BAND}\n🏢 تمام يا {_h(name)}! تم تنفيذ {_h(name_lbl)} للمستفيد «{_h(_safe(beneficiary_number))}» "
@@ -1686,7 +1666,7 @@ def register(bot, history):
                 except Exception:
                     pass
 
-                delete_pending_request(request_id)
+                delete_pending_request(request_id, "accepted", admin_id=call.from_user.id, req=req)
                 bot.send_message(
                     user_id,
                     f"{BAND}\n🎓 تمام يا {_h(name)}! تم دفع {_h(name_lbl)} للرقم الجامعي «{_h(_safe(university_id))}» "
@@ -1740,7 +1720,7 @@ def register(bot, history):
                     logging.exception("[ADMIN_LEDGER] deposit log failed: %s", _e)
 
                 # نظّف الطلب من الطابور وأبلغ العميل
-                delete_pending_request(request_id)
+                delete_pending_request(request_id, "accepted", admin_id=call.from_user.id, req=req)
                 bot.send_message(
                     user_id,
                     f"{BAND}\n⚡ يا {_h(name)}، تم شحن محفظتك بمبلغ {_fmt_syp(amount)} بنجاح.\n{BAND}",
@@ -1783,6 +1763,23 @@ def register(bot, history):
             bot.send_message(msg.chat.id, "❌ نوع الرسالة غير مدعوم. ابعت نص أو صورة، أو /skip للتخطي.")
         _accept_pending.pop(msg.from_user.id, None)
 
+    # ===== ذاكرة العملية (services/mem_profiler) =====
+    @bot.message_handler(commands=['mem'])
+    def __mem_cmd(m):
+        if not _is_admin_msg(m):
+            return bot.reply_to(m, "صلاحية الأدمن فقط.")
+        import html as _html
+        from services.mem_profiler import report as mem_report
+        rep = (mem_report() or "")[:3800]
+        bot.send_message(m.chat.id, f"<pre>{_html.escape(rep)}</pre>", parse_mode="HTML")
+
+    # ===== تحليلات الطابور (services/queue_events) =====
+    @bot.message_handler(commands=['queue'])
+    def __queue_cmd(m):
+        if not _is_admin_msg(m):
+            return bot.reply_to(m, "صلاحية الأدمن فقط.")
+        bot.send_message(m.chat.id, _queue_analytics_html(bot), parse_mode="HTML")
+
     # ===== قائمة الأدمن =====
     @bot.message_handler(commands=['admin'])
     def __admin_cmd(m):
@@ -1911,7 +1908,7 @@ def register(bot, history):
                         "• خصم 20% على باقات كذا\n• توصيل فوري\n• ينتهي اليوم ⏳",
                      parse_mode="Markdown")
 
-    @bot.message_handler(func=lambda m: _broadcast_pending.get(m.from_user.id, {}).get("mode") == "deal_wait", content_types=["text"])
+    @bot.message_handler(func=lambda m: (m.from_user.id in ADMINS or m.from_user.id == ADMIN_MAIN_ID) and _broadcast_pending.get(m.from_user.id, {}).get("mode") == "deal_wait", content_types=["text"])
     def _deal_collect(m):
         body = (m.text or "").strip()
         if not body:
@@ -2005,7 +2002,7 @@ def register(bot, history):
                         "الخيار 1\nالخيار 2\nالخيار 3\nالخيار 4",
                      parse_mode="Markdown")
 
-    @bot.message_handler(func=lambda m: _broadcast_pending.get(m.from_user.id, {}).get("mode") == "poll_wait", content_types=["text"])
+    @bot.message_handler(func=lambda m: (m.from_user.id in ADMINS or m.from_user.id == ADMIN_MAIN_ID) and _broadcast_pending.get(m.from_user.id, {}).get("mode") == "poll_wait", content_types=["text"])
     def _poll_collect(m):
         lines = [l.strip() for l in (m.text or "").splitlines() if l.strip()]
         if len(lines) < 3:
@@ -2106,7 +2103,7 @@ def register(bot, history):
         _broadcast_pending[m.from_user.id] = {"mode": "free_wait"}
         bot.reply_to(m, "📝 أرسل النص الآن.")
 
-    @bot.message_handler(func=lambda m: _broadcast_pending.get(m.from_user.id, {}).get("mode") == "free_wait", content_types=["text"])
+    @bot.message_handler(func=lambda m: (m.from_user.id in ADMINS or m.from_user.id == ADMIN_MAIN_ID) and _broadcast_pending.get(m.from_user.id, {}).get("mode") == "free_wait", content_types=["text"])
     def _free_collect(m):
         text = (m.text or "").strip()
         if not text:
@@ -2481,6 +2478,11 @@ def _register_admin_roles(bot):
             types.InlineKeyboardButton("🔁 إعادة فحص الإشتراك الإجباري", callback_data="sys:forcesub"),
             types.InlineKeyboardButton("📜 آخر السجلات", callback_data="sys:logs"),
         )
+        kb.add(
+            types.InlineKeyboardButton("🐢 أداء قاعدة البيانات", callback_data="sys:dbstats"),
+            types.InlineKeyboardButton("🧠 الذاكرة", callback_data="sys:mem"),
+        )
+        kb.add(types.InlineKeyboardButton("📈 تحليلات الطابور", callback_data="sys:queue"))
         kb.add(types.InlineKeyboardButton("⬅️ رجوع", callback_data="admin:home"))
         bot.send_message(m.chat.id, "قائمة النظام:", reply_markup=kb)
         
@@ -2517,6 +2519,35 @@ def _register_admin_roles(bot):
                 tail = (get_logs_tail(900) or "")[:3500]
                 bot.send_message(c.message.chat.id, f"آخر السجلات:\n<code>{tail}</code>", parse_mode="HTML")
                 bot.answer_callback_query(c.id)
+            elif act == "mem":
+                import html as _html
+                from services.mem_profiler import report as mem_report
+                rep = (mem_report() or "")[:3800]
+                bot.send_message(c.message.chat.id, f"<pre>{_html.escape(rep)}</pre>", parse_mode="HTML")
+                bot.answer_callback_query(c.id)
+            elif act == "queue":
+                bot.send_message(c.message.chat.id, _queue_analytics_html(bot), parse_mode="HTML")
+                bot.answer_callback_query(c.id)
+            elif act == "dbstats":
+                import html as _html
+                from database.db import query_report
+                from services.state_service import state_cache_stats
+                from services.chat_lanes import lane_report
+                from services.prefetch import prefetch_stats
+                from services.queue_dispatcher import report as queue_report
+                sc = state_cache_stats()
+                pf = prefetch_stats()
+                rep = (
+                    (query_report() or "")
+                    + f"\n🗂️ كاش الحالة: {sc['size']}/{sc['max_size']} | {sc['bytes'] // 1024}KB"
+                    + f" | إصابة {sc['hit_ratio'] * 100:.0f}% ({sc['hits']}/{sc['hits'] + sc['misses']})"
+                    + f" | طرد {sc['evictions']} | منتهي {sc['expired']} | كتابات متخطّاة {sc['noop_skipped']}"
+                    + f"\n🔥 تسخين: {pf['users']} مستخدم | متخطّى {pf['skipped']} | قراءات {pf['reads']} (فشل {pf['failed']})"
+                    + "\n" + lane_report()
+                    + "\n" + queue_report()
+                )[:3800]
+                bot.send_message(c.message.chat.id, f"<pre>{_html.escape(rep)}</pre>", parse_mode="HTML")
+                bot.answer_callback_query(c.id)
         except Exception as e:
             logging.exception("[ADMIN] system action failed: %s", e)
             try:
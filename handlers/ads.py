@@ -13,6 +13,7 @@ import html
 from services.wallet_service import (
     get_balance,
     get_available_balance,
+    get_wallet_snapshot,
     create_hold,
     register_user_if_not_exist,
 )
@@ -94,6 +95,7 @@ def publish_channel_ad(bot, ad_row) -> bool:
 
 # صيانة + أعلام المزايا
 from services.system_service import is_maintenance, maintenance_message
+from services.state_adapter import UserStateDictLike
 from services.feature_flags import block_if_disabled  # requires flag key: "ads"
 
 # حارس التأكيد الموحّد (يحذف الكيبورد + يمنع الدبل-كليك)
@@ -114,7 +116,21 @@ AD_OPTIONS = [
     ("🏆 إعلان 10 مرات (100000 ل.س)", 10, 100000),
 ]
 
-user_ads_state: dict[int, dict] = {}
+# حالة مسار الإعلان لكل مستخدم — في مخزن الحالة (services/state_backend) فتبقى بعد إعادة التشغيل
+user_ads_state = UserStateDictLike(state_key="ads", live=True)
+
+# أزرار القائمة الرئيسية (handlers/keyboards.main_menu) — ليست إدخالًا لمسار الإعلان
+_MENU_TEXTS = frozenset({
+    "🛒 المنتجات", "➕ إضافة خصم", "🏆 البطولة", "💳 شحن محفظتي", "💰 محفظتي",
+    "📢 إعلاناتك", "🌐 صفحتنا", "🛠️ الدعم الفني", "⬅️ رجوع", "Menu",
+})
+
+def _in_step(msg, step: str) -> bool:
+    """فلتر هاندلرات المسار: الشروط الرخيصة أولًا، وقراءة مخزن الحالة آخرًا."""
+    text = msg.text
+    if text is not None and (not text.strip() or text.startswith("/") or text in _MENU_TEXTS):
+        return False
+    return user_ads_state.get(msg.from_user.id, {}).get("step") == step
 
 # ==== Helpers للرسائل ====
 BAND = "━━━━━━━━━━━━━━━━"
@@ -306,7 +322,7 @@ def register(bot, _history):
     # ----------------------------------------------------------------
     @bot.message_handler(
         content_types=["text"],
-        func=lambda msg: user_ads_state.get(msg.from_user.id, {}).get("step") == "contact"
+        func=lambda msg: _in_step(msg, "contact")
     )
     def receive_contact(msg):
         # لو تعطّلت الخدمة أثناء المسار
@@ -357,7 +373,7 @@ def register(bot, _history):
     # ----------------------------------------------------------------
     @bot.message_handler(
         content_types=["text"],
-        func=lambda msg: user_ads_state.get(msg.from_user.id, {}).get("step") == "ad_text"
+        func=lambda msg: _in_step(msg, "ad_text")
     )
     def receive_ad_text(msg):
         if _ads_guard_msg(bot, msg.chat.id):
@@ -401,7 +417,7 @@ def register(bot, _history):
     # ----------------------------------------------------------------
     @bot.message_handler(
         content_types=["photo", "document"],
-        func=lambda msg: user_ads_state.get(msg.from_user.id, {}).get("step") == "wait_images"
+        func=lambda msg: _in_step(msg, "wait_images")
     )
     def receive_images(msg):
         if _ads_guard_msg(bot, msg.chat.id):
@@ -425,7 +441,8 @@ def register(bot, _history):
             bot.send_message(msg.chat.id, "❌ الملف ده مش صورة صالحة.")
             return
 
-        state.setdefault("images", []).append(file_id)
+        # القيم المتداخلة نسخ: نعيد إسناد القائمة لتُحفظ
+        state["images"] = list(state.get("images") or []) + [file_id]
 
         if len(state["images"]) >= state["expect_images"]:
             state["step"] = "confirm"
@@ -546,8 +563,9 @@ def register(bot, _history):
         times = int(data["times"])
         name = _name_from_user(call.from_user)
 
-        # ✅ الرصيد المتاح (balance - held)
-        available = int(get_available_balance(user_id) or 0)
+        # ✅ الرصيد المتاح (balance - held) + الرصيد الكامل برحلة واحدة
+        snap = get_wallet_snapshot(user_id)
+        available = int(snap.get("available") or 0)
         if available < price:
             missing = price - available
             bot.send_message(
@@ -570,7 +588,7 @@ def register(bot, _history):
             return
 
         # ===== رسالة الأدمن بالقالب الموحّد =====
-        balance_now = int(get_balance(user_id) or 0)
+        balance_now = int(snap.get("balance") or 0)
         id_value = (data.get("contact") or "").strip() or "—"
         admin_msg = (
             f"💰 رصيد المستخدم: {balance_now:,} ل.س\n"
@@ -606,7 +606,7 @@ def register_companies_transfer(bot, history):
 
             # احذف الطلب من الطابور
             from services.queue_service import delete_pending_request
-            delete_pending_request(row.get("id"))
+            delete_pending_request(row.get("id"), "accepted", admin_id=call.from_user.id, req=row)
             user_states.pop(user_id, None)
         except Exception as e:
             logging.error(f"[COMPANY][ADMIN] خطأ أثناء القبول: {e}", exc_info=True)
@@ -5,10 +5,12 @@ import math
 from database.db import get_table
 from telebot import types
 from services.system_service import is_maintenance, maintenance_message
+from services.state_adapter import UserStateDictLike
 
 # ✅ استيراد مرن مع fallback
 try:
     from services.discount_service import apply_discount_stacked as apply_discount
+    from services.discount_service import apply_discount_from_snapshot
 except Exception:
     def apply_discount(user_id: int, amount: int):
         # يرجع المبلغ كما هو بدون خصم إذا تعذّر الاستيراد
@@ -18,6 +20,9 @@ except Exception:
             pass
         return int(amount), None
 
+    def apply_discount_from_snapshot(amount: int, snap: dict):
+        return int(amount), None
+
 # (اختياري) توافق عكسي لو في أماكن لسه تنادي الاسم القديم
 apply_discount_stacked = apply_discount
 
@@ -26,6 +31,7 @@ from services.wallet_service import (
     register_user_if_not_exist,
     get_balance,
     get_available_balance,
+    get_wallet_snapshot,   # ✅ الرصيد/المتاح/الخصم/الحظر برحلة واحدة
     create_hold,   # ✅ حجز ذرّي
 )
 from config import BOT_NAME
@@ -228,7 +234,19 @@ def require_option_or_alert(bot, chat_id: int, category: str, product_name: str)
     return True
 
 # حالة الطلبات لكل مستخدم (للخطوات فقط، مش منع تعدد الطلبات)
-user_orders = {}
+# طلب المنتج الجاري لكل مستخدم — في مخزن الحالة (services/state_backend) فيبقى بعد إعادة التشغيل.
+# القيم JSON: المنتج يُحفظ برقمه (product_id) ويُستعاد من PRODUCTS عبر _order_product.
+user_orders = UserStateDictLike(state_key="products_order", live=True)
+
+def _order_product(order):
+    pid = (order or {}).get("product_id")
+    if pid is None:
+        return None
+    for items in PRODUCTS.values():
+        for p in items:
+            if p.product_id == pid:
+                return p
+    return None
 
 def has_pending_request(user_id: int) -> bool:
     """ترجع True إذا كان لدى المستخدم طلب قيد الانتظار (موجودة للتوافق؛ مش بنمنع تعدد الطلبات)."""
@@ -598,11 +616,11 @@ def handle_player_id(message, bot):
     name      = _name_from_user(message.from_user)
 
     order = user_orders.get(user_id)
-    if not order or "product" not in order:
+    product = _order_product(order)
+    if not order or product is None:
         bot.send_message(user_id, f"❌ {name}، ما عندنا طلب شغّال دلوقتي. اختار المنتج من القائمة.")
         return
 
-    product = order["product"]
 
     # 🔒 تحقّق سريع: قد يكون الإدمن أوقف خيار الكمية بعد ما اخترته
     if require_option_or_alert(bot, user_id, order.get("category", ""), product.name):
@@ -837,7 +855,7 @@ def setup_inline_handlers(bot, admin_ids):
 
         # ⚠️ احفظ subset السابق (لو كان المستخدم داخل تصنيف فرعي من MixedApps)
         prev = user_orders.get(user_id, {})
-        user_orders[user_id] = {"category": selected_category or selected.category, "product": selected, "subset": prev.get("subset")}
+        user_orders[user_id] = {"category": selected_category or selected.category, "product_id": selected.product_id, "subset": prev.get("subset")}
 
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("⬅️ رجوع", callback_data="back_to_products"))
@@ -1074,10 +1092,10 @@ def setup_inline_handlers(bot, admin_ids):
 
         name = _name_from_user(call.from_user)
         order = user_orders.get(user_id)
-        if not order or "product" not in order or "player_id" not in order:
+        product = _order_product(order)
+        if not order or product is None or "player_id" not in order:
             return bot.answer_callback_query(call.id, f"❌ {name}، الطلب مش كامل. كمّل البيانات الأول.")
 
-        product   = order["product"]
         player_id = order["player_id"]
         price_syp = convert_price_usd_to_syp(product.price)
         # استثناء زاکن / YallaGO: السعر مخزّن ل.س ولا يحتاج تحويل
@@ -1103,8 +1121,13 @@ def setup_inline_handlers(bot, admin_ids):
         # لو كانت الصفحة السابقة خزّنت price_before نستخدمه لتطابق السعر
         price_before = int(order.get("price_before", price_syp))
 
+        # لقطة واحدة: الرصيد + المتاح + نسب الخصم + الحظر (بدل 4 استعلامات)
+        snap = get_wallet_snapshot(user_id)
+        if snap.get("banned"):
+            return bot.answer_callback_query(call.id, "⛔ حسابك موقوف حاليًا.", show_alert=True)
+
         # خصم مجمّع: أعلى إدمن + أعلى إحالة (سقف 100%)
-        price_syp, applied_disc = apply_discount(user_id, price_before)
+        price_syp, applied_disc = apply_discount_from_snapshot(price_before, snap)
 
         # خزّن القيم لضمان تطابق الرسائل (للإدمن وللعميل)
         order["price_before"] = price_before
@@ -1128,7 +1151,7 @@ def setup_inline_handlers(bot, admin_ids):
             return bot.answer_callback_query(call.id)
 
         # تحقق الرصيد (المتاح فقط)
-        available = get_available_balance(user_id)
+        available = int(snap.get("available") or 0)
         if available < price_syp:
             kb = types.InlineKeyboardMarkup()
             kb.add(types.InlineKeyboardButton("💳 طرق الدفع/الشحن", callback_data="show_recharge_methods"))
@@ -1183,8 +1206,8 @@ def setup_inline_handlers(bot, admin_ids):
             bot.send_message(user_id, f"❌ يا {name}، حصلت مشكلة أثناء الحجز. حاول بعد شوية.")
             return
 
-        # عرض الرصيد الحالي في رسالة الأدمن
-        balance = get_balance(user_id)
+        # عرض الرصيد الحالي في رسالة الأدمن (الحجز يمس held فقط، فالرصيد من اللقطة ما زال صحيحًا)
+        balance = int(snap.get("balance") or 0)
 
         # تهيئة سطر السعر (قبل/بعد الخصم) للأدمن
         _pb = int(order.get('price_before', price_syp))
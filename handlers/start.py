@@ -4,6 +4,8 @@ from telebot import types
 from handlers import keyboards
 from config import BOT_NAME, FORCE_SUB_CHANNEL_USERNAME
 from services.wallet_service import register_user_if_not_exist
+from services import prefetch
+from services.ttl_dict import TTLDict
 
 START_BTN_TEXT = "✨ ستارت"
 START_BTN_TEXT_SUB = "✅ تم الاشتراك"
@@ -12,10 +14,10 @@ SUB_BTN_TEXT = "🔔 اشترك الآن في القناة"
 CB_START = "cb_start_main"
 CB_CHECK_SUB = "cb_check_sub"
 
-_sub_status_cache = {}
 _sub_status_ttl = 3
-_user_start_limit = {}
+_sub_status_cache = TTLDict(ttl=_sub_status_ttl, max_size=20000)
 _rate_limit_seconds = 5
+_user_start_limit = TTLDict(ttl=_rate_limit_seconds, max_size=20000)
 
 def _reset_user_flows(user_id: int):
     try:
@@ -90,6 +92,10 @@ def register(bot, user_history):
             return
         _user_start_limit[user_id] = now
 
+        # تسخين الكاشات بالتوازي؛ فحص الاشتراك يجري في الخلفية أثناء تصفير المسارات والإحالة
+        extra = {"subscribed": lambda: is_user_subscribed(bot, user_id)} if FORCE_SUB_CHANNEL_USERNAME else None
+        warm = prefetch.prefetch_user(user_id, extra)
+
         _reset_user_flows(user_id)
         
         # --- التقاط رابط الإحالة /start ref-<referrer_id>-<token> ---
@@ -117,7 +123,7 @@ def register(bot, user_history):
 
         # تحقق الاشتراك فقط هنا
         if FORCE_SUB_CHANNEL_USERNAME:
-            if not is_user_subscribed(bot, user_id):
+            if not prefetch.result(warm, "subscribed", lambda: is_user_subscribed(bot, user_id)):
                 try:
                     bot.send_message(
                         message.chat.id,
@@ -174,6 +180,7 @@ def register(bot, user_history):
     def cb_start_main(call):
         user_id = call.from_user.id
         name = getattr(call.from_user, "full_name", None) or call.from_user.first_name
+        prefetch.prefetch_user(user_id)
         _reset_user_flows(user_id)
         try:
             register_user_if_not_exist(user_id, name)
@@ -210,6 +217,7 @@ def register(bot, user_history):
 
     @bot.message_handler(func=lambda msg: msg.text == "⬅️ رجوع")
     def back_to_main_menu(message):
+        prefetch.prefetch_user(message.from_user.id)
         bot.send_message(
             message.chat.id,
             "تم الرجوع إلى القائمة الرئيسية.",
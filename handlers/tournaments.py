@@ -4,6 +4,7 @@ from __future__ import annotations
 from telebot import types
 from services.state_adapter import UserStateDictLike
 from services.feature_flags import ensure_feature, is_feature_enabled, require_feature_or_alert
+from services import startup
 from services.tournament_service import (
     get_or_create_open_tournament, count_verified_invites, numbers_available,
     reserve_slot, get_join_code, save_player_info, finalize_and_charge, cancel_and_cleanup
@@ -39,11 +40,13 @@ def _msg_intro():
             "انضم الآن وجهّز فريقك أو العب سولو.")
 
 def register(bot, history):
-    # ضمان وجود المفاتيح (تظهر في لوحة الأدمن)
-    ensure_feature("menu:tournaments", "القائمة: البطولة", True)
-    ensure_feature("tournaments:solo",  "بطولة سولو 1vs100", True)
-    ensure_feature("tournaments:duo",   "بطولة دو 2vs100",   True)
-    ensure_feature("tournaments:squad", "بطولة سكواد 4vs100",True)
+    # ضمان وجود المفاتيح (تظهر في لوحة الأدمن) — مؤجّل لما بعد بدء الاستقبال
+    def _ensure_keys():
+        ensure_feature("menu:tournaments", "القائمة: البطولة", True)
+        ensure_feature("tournaments:solo",  "بطولة سولو 1vs100", True)
+        ensure_feature("tournaments:duo",   "بطولة دو 2vs100",   True)
+        ensure_feature("tournaments:squad", "بطولة سكواد 4vs100",True)
+    startup.defer("tournaments features", _ensure_keys)
 
     @bot.message_handler(func=lambda m: m.text == BTN_TOUR)
     def open_home(m):
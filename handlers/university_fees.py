@@ -446,7 +446,7 @@ def register_university_fees(bot, history):
             bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
 
             # حذف الطلب من الطابور
-            delete_pending_request(row.get("id"))
+            delete_pending_request(row.get("id"), "accepted", admin_id=call.from_user.id, req=row)
             user_uni_state.pop(user_id, None)
 
         except Exception as e:
@@ -479,7 +479,7 @@ def register_university_fees(bot, history):
                 bot.answer_callback_query(call.id, "❌ تم رفض الطلب")
                 bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
                 if row:
-                    delete_pending_request(row.get("id"))
+                    delete_pending_request(row.get("id"), "cancelled", admin_id=call.from_user.id, req=row)
                 user_uni_state.pop(user_id, None)
 
             bot.send_message(call.message.chat.id, "📝 اكتب سبب الرفض أو ابعت صورة (اختياري):")
@@ -21,6 +21,7 @@ from services.wallet_service import (
     get_wholesale_purchases,
     user_has_admin_approval,
     get_available_balance,       # ✅ المتاح = balance - held
+    get_wallet_snapshot,         # ✅ لقطة المحفظة برحلة واحدة
 )
 try:
     from services.queue_service import add_pending_request
@@ -118,12 +119,10 @@ def _mk_table(headers, rows):
 def show_wallet(bot, message, history=None):
     user_id = message.from_user.id
     name = _name_from_msg(message)
-    register_user_if_not_exist(user_id, name)
-    balance = get_balance(user_id)
-    try:
-        available = get_available_balance(user_id)
-    except Exception:
-        available = None
+    # رحلة واحدة: تسجيل المستخدم + الرصيد + المتاح
+    snap = get_wallet_snapshot(user_id, name)
+    balance = int(snap.get("balance") or 0)
+    available = snap.get("available")
 
     if history is not None:
         history.setdefault(user_id, []).append("wallet")
@@ -1,7 +1,11 @@
+from services import startup  # أول استيراد: بداية قياس زمن الإقلاع
+from services import mem_profiler
+mem_profiler.start()  # MEM_PROFILE=1 فقط: tracemalloc من قبل استيراد الباقي
 import os
 import sys
 import logging
 import telebot
+from concurrent.futures import ThreadPoolExecutor
 from config import API_TOKEN, ADMINS
 from telebot import types
 import threading
@@ -10,12 +14,16 @@ import socketserver
 from handlers import referrals  # <-- جديد
 from services.scheduled_tasks import post_ads_task
 from services.error_log_setup import install_global_error_logging
-from services.state_adapter import UserStateDictLike
+from services.state_adapter import UserStateDictLike, StateSessionMiddleware
+from services import chat_lanes
+from services import prefetch
+from services.ttl_dict import BoundedHistory
 from services.commands_setup import setup_bot_commands
 
 # NEW: عُمّال الإشعارات والصيانة
 from services.outbox_worker import start_outbox_worker
-from services.maintenance_worker import start_housekeeping
+from services.maintenance_worker import start_housekeeping, start_state_sweeper, start_queue_rollup
+startup.mark("imports (config + db + services)")
 
 # ✅ تعديل بسيط ليتوافق مع ويندوز: تشغيل الخادم الوهمي يصبح اختياريًا
 ENABLE_DUMMY_SERVER = os.environ.get("ENABLE_DUMMY_SERVER", "0") == "1"
@@ -52,58 +60,89 @@ def _unhandled_exception_hook(exc_type, exc_value, exc_tb):
 
 sys.excepthook = _unhandled_exception_hook
 
+# SIGTERM (إيقاف Render): فرّغ الكتابات المؤجّلة هنا مباشرة ثم اخرج — لا نعتمد على atexit
+# لأنه لا يعمل إلا بعد انضمام الخيوط غير الـdaemon، و SIGKILL قد يسبقه.
+import signal
+
+def _on_sigterm(*_):
+    try:
+        from database.batch_writer import shutdown as _drain_writes
+        _drain_writes()
+    except Exception as e:
+        logging.warning(f"⚠️ فشل تفريغ الكتابات المؤجّلة عند SIGTERM: {e}")
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, _on_sigterm)
+
 # ---------------------------------------------------------
-# التحقق من صحة التوكن وجلب هوية البوت قبل التشغيل
+# إنشاء كائن البوت (نسخة واحدة) ثم التحقق من التوكن وحذف أي Webhook سابق
+# بالتوازي لتجنب خطأ 409 دون رحلتين متتاليتين
 # ---------------------------------------------------------
-def check_api_token(token):
+# BOT_NUM_THREADS يحدد أيضًا حجم pool اتصالات Supabase (database/db.py)
+bot = telebot.TeleBot(
+    API_TOKEN,
+    parse_mode="HTML",
+    num_threads=int(os.getenv("BOT_NUM_THREADS", "2")),
+    use_class_middlewares=True,
+)
+
+def check_api_token(bot):
     try:
-        test_bot = telebot.TeleBot(token)
-        me = test_bot.get_me()
+        me = bot.get_me()
         print(f"✅ التوكن سليم. هوية البوت: @{me.username} (ID: {me.id})")
         return True
     except Exception as e:
         logging.critical(f"❌ التوكن غير صالح أو لا يمكن الاتصال بـ Telegram API: {e}")
         sys.exit(1)
 
-if not check_api_token(API_TOKEN):
-    sys.exit(1)
+def _delete_webhook():
+    try:
+        bot.delete_webhook(drop_pending_updates=True)
+    except Exception as e:
+        logging.warning(f"⚠️ لم يتم حذف Webhook بنجاح: {e}")
 
-# ---------------------------------------------------------
-# إنشاء كائن البوت وحذف أي Webhook سابق لتجنب خطأ 409
-# ---------------------------------------------------------
-bot = telebot.TeleBot(API_TOKEN, parse_mode="HTML")
-try:
-    bot.delete_webhook(drop_pending_updates=True)
-except Exception as e:
-    logging.warning(f"⚠️ لم يتم حذف Webhook بنجاح: {e}")
+with ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup") as _ex:
+    _token_ok = _ex.submit(check_api_token, bot)
+    _ex.submit(_delete_webhook)
+if not _token_ok.result():
+    sys.exit(1)
+startup.mark("getMe + deleteWebhook")
 
 # ---------------------------------------------------------
 # تسجيل حالة المستخدم (تخزين في Supabase عبر الـ adapter)
 # ---------------------------------------------------------
 user_state = UserStateDictLike()
-history: dict[int, list] = {}
+# سجل التنقل: قوائم حلقية (آخر HISTORY_MAXLEN خطوة) تنتهي بعد خمول HISTORY_TTL_HOURS
+history = BoundedHistory(
+    maxlen=int(os.getenv("HISTORY_MAXLEN", "20")),
+    ttl=float(os.getenv("HISTORY_TTL_HOURS", "6")) * 3600,
+)
+# جلسة حالة لكل تحديث: قراءة واحدة + كتابة واحدة على الأكثر لـ user_state
+bot.setup_middleware(StateSessionMiddleware())
+# تحديثات نفس المحادثة بالترتيب على مسار واحد، والمحادثات المختلفة بالتوازي (CHAT_LANES)
+chat_lanes.install(bot)
 
 # ---------------------------------------------------------
 # استيراد جميع الهاندلرز بعد تهيئة البوت
 # ---------------------------------------------------------
-from handlers import (start,
-    wallet,
-    support,
-    admin,
-    ads,
-    recharge,
-    cash_transfer,
-    companies_transfer,
-    products,
-    media_services,
-    wholesale,
-    university_fees,
-    internet_providers,
-    bill_and_units,
-    links as links_handler, 
-    tournaments,
-    tournament_invite_start,
-)
+# كل وحدة عبر startup.timed_import: زمن استيراد كل هاندلر يظهر في تقرير الإقلاع
+start = startup.timed_import("handlers.start")
+wallet = startup.timed_import("handlers.wallet")
+support = startup.timed_import("handlers.support")
+admin = startup.timed_import("handlers.admin")
+ads = startup.timed_import("handlers.ads")
+recharge = startup.timed_import("handlers.recharge")
+cash_transfer = startup.timed_import("handlers.cash_transfer")
+companies_transfer = startup.timed_import("handlers.companies_transfer")
+products = startup.timed_import("handlers.products")
+media_services = startup.timed_import("handlers.media_services")
+wholesale = startup.timed_import("handlers.wholesale")
+university_fees = startup.timed_import("handlers.university_fees")
+internet_providers = startup.timed_import("handlers.internet_providers")
+bill_and_units = startup.timed_import("handlers.bill_and_units")
+links_handler = startup.timed_import("handlers.links")
+tournaments = startup.timed_import("handlers.tournaments")
+tournament_invite_start = startup.timed_import("handlers.tournament_invite_start")
 from handlers.keyboards import (
     main_menu,
     products_menu,
@@ -119,7 +158,8 @@ from handlers.keyboards import (
     transfers_menu,
 )
 # هاندلر الإلغاء المركزي
-from handlers import cancel as cancel_handler
+cancel_handler = startup.timed_import("handlers.cancel")
+startup.mark("import handlers")
 
 # ---------------------------------------------------------
 # تسجيل جميع الهاندلرز (تمرير user_state أو history حسب الحاجة)
@@ -146,6 +186,7 @@ internet_providers.register(bot)
 
 # ✅ تسجيل هاندلر /cancel بعد تعريف bot و history
 cancel_handler.register(bot, history)
+startup.mark("register handlers")
 
 CHANNEL_USERNAME = "@shop100sho"
 def notify_channel_on_start(bot):
@@ -155,7 +196,8 @@ def notify_channel_on_start(bot):
 notify_channel_on_start(bot)
 # تفعيل سجل الأخطاء + قائمة الأوامر الثابتة
 install_global_error_logging()
-setup_bot_commands(bot, list(ADMINS))
+# أوامر القائمة لا يحتاجها أول تحديث: تُضبط بالتوازي بعد بدء الاستقبال
+startup.defer("set_my_commands", lambda: setup_bot_commands(bot, list(ADMINS)))
 
 # بعد اكتمال التسجيل وتشغيل البوت، شغّل مهمة الإعلانات المجدولة
 post_ads_task(bot)
@@ -163,6 +205,9 @@ post_ads_task(bot)
 # NEW: تشغيل عامل الإشعارات من outbox وعامل الصيانة (بديل pg_cron داخل التطبيق)
 start_outbox_worker(bot)   # يمرّ على notifications_outbox ويُرسل الرسائل
 start_housekeeping(bot)    # تنظيف 14 ساعة + تنبيهات/حذف المحافظ بعد 33 يوم خمول
+start_state_sweeper(int(os.getenv("STATE_SWEEP_SECONDS", "300")))  # حذف user_state المنتهية عبر expires_at
+start_queue_rollup(int(os.getenv("QUEUE_ROLLUP_SECONDS", "300")))  # queue_events → queue_stats_hourly
+startup.mark("background workers")
 
 # ---------------------------------------------------------
 # زر الرجوع الذكي (بدون تعديل)
@@ -170,6 +215,7 @@ start_housekeeping(bot)    # تنظيف 14 ساعة + تنبيهات/حذف ال
 @bot.message_handler(func=lambda msg: msg.text == "⬅️ رجوع")
 def handle_back(msg):
     user_id = msg.from_user.id
+    prefetch.prefetch_user(user_id)
     state = user_state.get(user_id, {}).get("step", "main_menu")
 
     if state == "products_menu":
@@ -279,12 +325,10 @@ def handle_shakhashir(msg):
 # تشغيل نظام الطابور (QUEUE)
 # ---------------------------------------------------------
 try:
-    from services.queue_service import process_queue
-except Exception:
-    def process_queue(*args, **kwargs):
-        return None
-
-threading.Thread(target=process_queue, args=(bot,), daemon=True).start()
+    from services import queue_dispatcher
+    queue_dispatcher.start(bot)
+except Exception as e:
+    logging.error(f"[queue] dispatcher start failed: {e}")
 
 # ---------------------------------------------------------
 # ✅ ربط معالجات لعبة الجوائز بعد إنشاء البوت وتسجيل الهاندلرز
@@ -294,6 +338,7 @@ threading.Thread(target=process_queue, args=(bot,), daemon=True).start()
 # ---------------------------------------------------------
 @bot.message_handler(func=lambda msg: msg.text in ["❌ إلغاء"])
 def global_cancel_text(msg):
+    prefetch.prefetch_user(msg.from_user.id)
     try:
         from services.state_service import clear_state
         clear_state(msg.from_user.id)
@@ -310,13 +355,22 @@ def global_cancel_text(msg):
 # ---------------------------------------------------------
 import time
 
+RESTART_DELAY = float(os.getenv("RESTART_DELAY_SECONDS", "10"))
+
 def restart_bot():
-    logging.warning("🔄 إعادة تشغيل البوت بعد 10 ثوانٍ…")
-    time.sleep(10)
+    logging.warning(f"🔄 إعادة تشغيل البوت بعد {RESTART_DELAY:.0f} ثوانٍ…")
+    time.sleep(RESTART_DELAY)
+    # execv لا يشغّل atexit: فرّغ الكتابات المؤجّلة يدويًا قبل الاستبدال
+    try:
+        from database.batch_writer import shutdown as _drain_writes
+        _drain_writes()
+    except Exception as e:
+        logging.warning(f"⚠️ فشل تفريغ الكتابات المؤجّلة: {e}")
     os.execv(sys.executable, [sys.executable] + sys.argv)
 
 def start_polling():
     print("🤖 البوت يعمل الآن…")
+    startup.watch_first_poll(bot)  # تقرير زمن الإقلاع + تشغيل الأعمال المؤجّلة
     while True:
         try:
             bot.infinity_polling(
@@ -5,6 +5,7 @@ from typing import Dict, Any, List
 import logging
 from postgrest.exceptions import APIError
 from database.db import get_table, DEFAULT_TABLE
+from database.batch_writer import insert_row
 from config import ADMINS, ADMIN_MAIN_ID
 
 LEDGER_TABLE = "admin_ledger"
@@ -31,7 +32,7 @@ def log_admin_deposit(admin_id: int, user_id: int, amount: int, note: str = "")
     }
 
     try:
-        get_table(LEDGER_TABLE).insert(payload).execute()
+        insert_row(LEDGER_TABLE, payload, durability="commit")
     except APIError as e:
         logging.exception("[ADMIN_LEDGER] deposit insert failed: %s", e)
         raise
@@ -52,7 +53,7 @@ def log_admin_spend(admin_id: int, user_id: int, amount: int, note: str = "") ->
     }
 
     try:
-        get_table(LEDGER_TABLE).insert(payload).execute()
+        insert_row(LEDGER_TABLE, payload, durability="commit")
     except APIError as e:
         logging.exception("[ADMIN_LEDGER] spend insert failed: %s", e)
         raise
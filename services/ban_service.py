@@ -1,36 +1,69 @@
 # -*- coding: utf-8 -*-
 # services/ban_service.py — حظر/فكّ الحظر + فحص الحالة
 from __future__ import annotations
+import os
 from datetime import datetime, timezone
 from typing import Optional, Tuple
 from database.db import get_table
+from services.ttl_dict import TTLDict
 
 TABLE = "banned_users"
 
+# كاش قصير لنتيجة الفحص (يُسخَّن من services/prefetch عند /start والقائمة الرئيسية)،
+# ويُبطَل عند ban_user/unban_user. BAN_CACHE_TTL=0 يعطّله.
+BAN_CACHE_TTL = float(os.getenv("BAN_CACHE_TTL", "30"))
+_ban_cache = TTLDict(ttl=max(BAN_CACHE_TTL, 0.001), max_size=20000)
+_ban_gen = TTLDict(ttl=600, max_size=20000)
+
+def _invalidate(user_id: int) -> None:
+    uid = int(user_id)
+    _ban_gen[uid] = _ban_gen.get(uid, 0) + 1
+    _ban_cache.pop(uid, None)
+
 def _now_utc() -> datetime:
     return datetime.now(timezone.utc)
 
 def is_banned(user_id: int) -> Tuple[bool, Optional[str], Optional[str]]:
     """يرجع (محظور؟, banned_until_iso or None, reason)"""
+    cached = cached_ban(user_id)
+    if cached is not None:
+        return cached
+    gen = _ban_gen.get(int(user_id), 0)
     try:
-        res = get_table(TABLE).select("reason, banned_until").eq("user_id", int(user_id)).limit(1).execute()
-        row = (getattr(res, "data", None) or [None])[0]
-        if not row:
-            return (False, None, None)
-        until = row.get("banned_until")
-        if until:
-            try:
-                # Supabase يرجع توقيت ISO — نقارنه الآن
-                dt = datetime.fromisoformat(until.replace("Z","+00:00"))
-                if dt <= _now_utc():
-                    # انتهى الحظر — اعتبره غير محظور (يمكن تنظيف السجل لاحقًا)
-                    return (False, None, None)
-            except Exception:
-                pass
-        return (True, until, row.get("reason"))
+        result = _query_ban(user_id)
     except Exception:
-        # في حال فشل الاستعلام، لا نمنع المستخدم (سلوك متسامح)
+        # في حال فشل الاستعلام، لا نمنع المستخدم (سلوك متسامح) — ولا نخزّن النتيجة
+        return (False, None, None)
+    if BAN_CACHE_TTL > 0 and _ban_gen.get(int(user_id), 0) == gen:
+        # لا نخزّن قراءة تداخلت مع ban_user/unban_user
+        _ban_cache[int(user_id)] = result
+    return result
+
+def cached_ban(user_id: int) -> Optional[Tuple[bool, Optional[str], Optional[str]]]:
+    """نتيجة is_banned من الكاش فقط (None إن لم تكن مخزّنة)."""
+    if BAN_CACHE_TTL <= 0:
+        return None
+    try:
+        return _ban_cache.get(int(user_id))
+    except (TypeError, ValueError):
+        return None
+
+def _query_ban(user_id: int) -> Tuple[bool, Optional[str], Optional[str]]:
+    res = get_table(TABLE).select("reason, banned_until").eq("user_id", int(user_id)).limit(1).execute()
+    row = (getattr(res, "data", None) or [None])[0]
+    if not row:
         return (False, None, None)
+    until = row.get("banned_until")
+    if until:
+        try:
+            # Supabase يرجع توقيت ISO — نقارنه الآن
+            dt = datetime.fromisoformat(until.replace("Z","+00:00"))
+            if dt <= _now_utc():
+                # انتهى الحظر — اعتبره غير محظور (يمكن تنظيف السجل لاحقًا)
+                return (False, None, None)
+        except Exception:
+            pass
+    return (True, until, row.get("reason"))
 
 def ban_user(user_id: int, by_admin: int, reason: str, banned_until_iso: Optional[str] = None):
     payload = {
@@ -41,8 +74,14 @@ def ban_user(user_id: int, by_admin: int, reason: str, banned_until_iso: Optiona
         "created_at": _now_utc().isoformat(),
     }
     # upsert على user_id
-    return get_table(TABLE).upsert(payload, on_conflict="user_id").execute()
+    try:
+        return get_table(TABLE).upsert(payload, on_conflict="user_id").execute()
+    finally:
+        _invalidate(user_id)
 
 def unban_user(user_id: int, by_admin: int):
     # إزالة السجل بالكامل
-    return get_table(TABLE).delete().eq("user_id", int(user_id)).execute()
+    try:
+        return get_table(TABLE).delete().eq("user_id", int(user_id)).execute()
+    finally:
+        _invalidate(user_id)
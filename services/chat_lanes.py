@@ -0,0 +1,172 @@
+# services/chat_lanes.py
+# -*- coding: utf-8 -*-
+"""
+منفّذ تحديثات بمسار مرتّب لكل محادثة بدل ThreadPool المشترك في telebot.
+
+- كل تحديث يذهب إلى مسار ثابت: chat_id % CHAT_LANES. لكل مسار طابور وخيط واحد،
+  فتحديثات نفس المحادثة تُنفَّذ بالترتيب (لا سباق بين ضغطتي تأكيد أو بين رسالة وcallback
+  على user_orders/صف الحالة/الحجز)، والمحادثات المختلفة تتوازى عبر المسارات.
+- يطابق واجهة telebot.util.ThreadPool (put/raise_exceptions/clear_exceptions/close/
+  exception_event) فيُركَّب مكانه: install(bot).
+- lane_stats(): عمق الطابور الحالي/الأقصى وزمن الانتظار (متوسط/أقصى) لكل مسار.
+"""
+
+from __future__ import annotations
+
+import itertools
+import logging
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from database.db import CHAT_LANES
+
+
+def _chat_key(obj: Any) -> Optional[int]:
+    """chat_id (أو user_id) من Message/CallbackQuery/ChatMemberUpdated/...؛ None إن تعذّر."""
+    chat = getattr(obj, "chat", None)
+    if chat is None:
+        msg = getattr(obj, "message", None)  # CallbackQuery
+        chat = getattr(msg, "chat", None)
+    cid = getattr(chat, "id", None)
+    if cid is None:
+        cid = getattr(getattr(obj, "from_user", None), "id", None)
+    try:
+        return int(cid) if cid is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class _Lane:
+    __slots__ = ("idx", "tasks", "thread", "done", "max_depth", "wait_total", "wait_max", "busy")
+
+    def __init__(self, idx: int):
+        self.idx = idx
+        self.tasks: "queue.Queue" = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+        self.done = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.busy = False
+
+
+class ChatLanePool:
+    def __init__(self, telebot, num_lanes: int = CHAT_LANES):
+        self.telebot = telebot
+        self.num_threads = max(1, int(num_lanes))
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self._running = True
+        self._rr = itertools.count()
+        self.lanes: List[_Lane] = [_Lane(i) for i in range(self.num_threads)]
+        for lane in self.lanes:
+            lane.thread = threading.Thread(target=self._run, args=(lane,), name=f"ChatLane{lane.idx}", daemon=True)
+            lane.thread.start()
+
+    def _lane_for(self, args) -> _Lane:
+        key = _chat_key(args[0]) if args else None
+        if key is None:
+            key = next(self._rr)  # تحديثات بلا محادثة (update_listener...) توزَّع بالتناوب
+        return self.lanes[key % self.num_threads]
+
+    def put(self, func, *args, **kwargs):
+        lane = self._lane_for(args)
+        lane.tasks.put((time.monotonic(), func, args, kwargs))
+        depth = lane.tasks.qsize()
+        if depth > lane.max_depth:
+            lane.max_depth = depth
+
+    def _run(self, lane: _Lane) -> None:
+        while self._running:
+            try:
+                enqueued, func, args, kwargs = lane.tasks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            waited = time.monotonic() - enqueued
+            lane.wait_total += waited
+            if waited > lane.wait_max:
+                lane.wait_max = waited
+            lane.busy = True
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self._on_exception(e)
+            finally:
+                lane.busy = False
+                lane.done += 1
+                lane.tasks.task_done()
+
+    def _on_exception(self, e: Exception) -> None:
+        handler = getattr(self.telebot, "exception_handler", None)
+        handled = False
+        if handler is not None:
+            try:
+                handled = handler.handle(e)
+            except Exception:
+                handled = False
+        if not handled:
+            # مثل ThreadPool: يُعاد رفعه في خيط الاستقبال (raise_exceptions)
+            logging.error("[chat_lanes] handler error: %s", e, exc_info=True)
+            self.exception_info = e
+            self.exception_event.set()
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        self._running = False
+        for lane in self.lanes:
+            if lane.thread is not None and lane.thread is not threading.current_thread():
+                lane.thread.join()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        out = []
+        for lane in self.lanes:
+            n = lane.done
+            out.append({
+                "lane": lane.idx, "depth": lane.tasks.qsize(), "max_depth": lane.max_depth,
+                "busy": lane.busy, "done": n,
+                "wait_avg_ms": round(lane.wait_total / n * 1000, 1) if n else 0.0,
+                "wait_max_ms": round(lane.wait_max * 1000, 1),
+            })
+        return out
+
+
+_pool: Optional[ChatLanePool] = None
+
+
+def install(bot, num_lanes: int = CHAT_LANES) -> Optional[ChatLanePool]:
+    """يستبدل worker_pool في telebot بمسارات المحادثات (CHAT_LANES=0 يُبقي pool المكتبة)."""
+    global _pool
+    if num_lanes <= 0 or not getattr(bot, "threaded", False):
+        return None
+    old = bot.worker_pool
+    _pool = bot.worker_pool = ChatLanePool(bot, num_lanes)
+    if old is not None:
+        # إيقاف عمّال المكتبة يستغرق حتى 0.5s (مهلة الطابور) — في الخلفية
+        threading.Thread(target=old.close, name="close-default-pool", daemon=True).start()
+    return _pool
+
+
+def lane_stats() -> List[Dict[str, Any]]:
+    return _pool.stats() if _pool is not None else []
+
+
+def lane_report() -> str:
+    rows = lane_stats()
+    if not rows:
+        return "🛣️ مسارات المحادثات: غير مفعّلة"
+    busy = sum(1 for r in rows if r["busy"])
+    depth = sum(r["depth"] for r in rows)
+    worst = max(rows, key=lambda r: r["wait_max_ms"])
+    return (
+        f"🛣️ مسارات المحادثات: {len(rows)} | مشغول {busy} | بالطابور {depth}"
+        f" | أقصى عمق {max(r['max_depth'] for r in rows)}"
+        f" | أسوأ انتظار {worst['wait_max_ms']:.0f}ms (مسار {worst['lane']})"
+    )
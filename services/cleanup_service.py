@@ -7,7 +7,7 @@ import logging
 from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Any, Optional
 import os
-from database.db import get_table, DEFAULT_TABLE
+from database.db import get_table, DEFAULT_TABLE, with_retry as _with_retry
 
 # الجداول التي تُحذف تلقائيًا بعد 14 ساعة (مع استثناء USERS_TABLE كليًا)
 USERS_TABLE = (os.getenv('SUPABASE_TABLE_NAME') or DEFAULT_TABLE or 'houssin363')
@@ -43,23 +43,8 @@ ACTIVITY_TABLES = {
     "purchases": "created_at",
 }
 
-# ====== منطق إعادة المحاولة (backoff خفيف) للتعامل مع أخطاء الشبكة/HTTP2 ======
-_RETRIES = 3
-_BACKOFF = 0.8  # ثوانٍ
-
-def _with_retry(op, *args, **kwargs):
-    for i in range(_RETRIES):
-        try:
-            return op(*args, **kwargs)
-        except Exception as e:
-            # أخطاء المخطط (كالعمود غير الموجود) ليست مؤقتة: لا نعيد المحاولة عليها
-            msg = str(e)
-            if "42703" in msg or "does not exist" in msg.lower():
-                raise
-            if i == _RETRIES - 1:
-                raise
-            logging.warning("cleanup_service retry %s/%s: %s", i + 1, _RETRIES, e)
-            time.sleep(_BACKOFF * (i + 1))
+# ====== إعادة المحاولة: السياسة الموحّدة في database/db.py (with_retry + قاطع الدائرة) ======
+# أخطاء المخطط (كالعمود غير الموجود 42703) ليست مؤقتة فلا يُعاد عليها.
 
 def _utc_now() -> datetime:
     return datetime.now(timezone.utc)
@@ -146,6 +131,21 @@ def purge_ephemeral_after(hours: int = 14) -> Dict[str, int]:
         res[tbl] = max(count, 0)
     return res
 
+# ====== كنس user_state المنتهية عبر expires_at (services/state_backend.purge_expired) ======
+STATE_SWEEP_BATCH = int(os.getenv("STATE_SWEEP_BATCH", "500"))
+STATE_SWEEP_MAX_BATCHES = int(os.getenv("STATE_SWEEP_MAX_BATCHES", "20"))
+
+def sweep_expired_state(batch_size: int = STATE_SWEEP_BATCH, max_batches: int = STATE_SWEEP_MAX_BATCHES) -> int:
+    """يحذف صفوف user_state التي تجاوزت expires_at بدفعات محدودة؛ يرجع عدد المحذوف."""
+    from services.state_service import purge_expired_batch
+    total = 0
+    for _ in range(max(1, max_batches)):
+        rows = purge_expired_batch(batch_size)
+        total += len(rows)
+        if len(rows) < batch_size:
+            break
+    return total
+
 def _has_activity_since(user_id: int, since_iso: str) -> bool:
     for tbl, col in ACTIVITY_TABLES.items():
         # إذا كان عمود النشاط غير موجود في الجدول، نتخطّاه
@@ -224,5 +224,9 @@ def schedule_housekeeping(bot=None, every_seconds: int = 3600):
     """يشغّل التنظيف كل ساعة بخيط منفصل."""
     def _loop():
         _housekeeping_tick(bot)
-        threading.Timer(every_seconds, _loop).start()
-    threading.Timer(60, _loop).start()
+        t = threading.Timer(every_seconds, _loop)
+        t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+        t.start()
+    t = threading.Timer(60, _loop)
+    t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+    t.start()
@@ -3,8 +3,12 @@ from __future__ import annotations
 from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta, timezone
 import logging
+import os
+import threading
+import time
 
 from database.db import get_table
+from database.batch_writer import insert_row
 
 # محاولة استخدام ساعة المشروع، وإلا فـ fallback
 try:
@@ -16,6 +20,12 @@ except Exception:
 DISCOUNTS_TABLE = "discounts"
 USES_TABLE      = "discount_uses"
 
+# كاش قصير لصفوف الخصومات الفعّالة (جدول صغير تقرؤه كل عملية شراء)؛
+# يُبطَل عند أي إنشاء/تعديل/حذف من هنا. DISCOUNT_CACHE_TTL=0 يعطّله.
+DISCOUNT_CACHE_TTL = float(os.getenv("DISCOUNT_CACHE_TTL", "30"))
+_active_lock = threading.Lock()
+_active_cache: Dict[str, Any] = {"ts": 0.0, "rows": None, "gen": 0}
+
 
 def _parse_dt(val) -> Optional[datetime]:
     if not val:
@@ -31,6 +41,39 @@ def _parse_dt(val) -> Optional[datetime]:
     return None
 
 
+def invalidate_active_cache() -> None:
+    with _active_lock:
+        _active_cache["rows"] = None
+        _active_cache["gen"] += 1
+
+
+def active_cache_warm() -> bool:
+    with _active_lock:
+        rows = _active_cache["rows"]
+        return rows is not None and time.monotonic() - _active_cache["ts"] < DISCOUNT_CACHE_TTL
+
+
+def _active_rows() -> List[Dict[str, Any]]:
+    """صفوف active=True (قبل فلترة الوقت) — من الكاش أو من القاعدة. يرفع عند فشل الاستعلام."""
+    with _active_lock:
+        rows = _active_cache["rows"]
+        if rows is not None and time.monotonic() - _active_cache["ts"] < DISCOUNT_CACHE_TTL:
+            return [dict(r) for r in rows]
+        gen = _active_cache["gen"]
+    res = get_table(DISCOUNTS_TABLE).select("*").eq("active", True).execute()
+    rows = getattr(res, "data", []) or []
+    if DISCOUNT_CACHE_TTL > 0:
+        with _active_lock:
+            if _active_cache["gen"] == gen:
+                _active_cache.update(ts=time.monotonic(), rows=[dict(r) for r in rows])
+    return rows
+
+
+def warm_active_cache() -> int:
+    """يملأ كاش الخصومات الفعّالة (services/prefetch) ويرجع عدد الصفوف."""
+    return len(_active_rows())
+
+
 def list_discounts(limit: int = 100) -> List[Dict[str, Any]]:
     """
     ترجع آخر الخصومات مع حقل computed: effective_active = active and not expired (حتى الآن).
@@ -93,7 +136,10 @@ def create_discount(scope: str,
     if meta:
         row["meta"] = meta
 
-    res = get_table(DISCOUNTS_TABLE).insert(row).execute()
+    try:
+        res = get_table(DISCOUNTS_TABLE).insert(row).execute()
+    finally:
+        invalidate_active_cache()
     return res.data[0] if hasattr(res, "data") and res.data else None
 
 
@@ -103,6 +149,7 @@ def end_discount_now(did: str) -> bool:
         get_table(DISCOUNTS_TABLE).update(
             {"active": False, "ends_at": _now().isoformat()}
         ).eq("id", did).execute()
+        invalidate_active_cache()
         return True
     except Exception as e:
         logging.exception("[discounts] end now failed: %s", e)
@@ -112,6 +159,7 @@ def end_discount_now(did: str) -> bool:
 def delete_discount(did: str) -> bool:
     try:
         get_table(DISCOUNTS_TABLE).delete().eq("id", did).execute()
+        invalidate_active_cache()
         return True
     except Exception as e:
         logging.exception("[discounts] delete failed: %s", e)
@@ -121,6 +169,7 @@ def delete_discount(did: str) -> bool:
 def set_discount_active(did: str, active: bool) -> bool:
     try:
         get_table(DISCOUNTS_TABLE).update({"active": bool(active)}).eq("id", did).execute()
+        invalidate_active_cache()
         return True
     except Exception as e:
         logging.exception("[discounts] toggle failed: %s", e)
@@ -143,8 +192,7 @@ def _list_active_for_user(user_id: int):
     ترجّع كل الخصومات الفعّالة زمنيًا لهذا المستخدم (global + user) بدون تجميع.
     """
     try:
-        res = get_table(DISCOUNTS_TABLE).select("*").eq("active", True).execute()
-        rows = getattr(res, "data", []) or []
+        rows = _active_rows()
     except Exception:
         rows = []
 
@@ -166,13 +214,7 @@ def get_active_for_user(user_id: int) -> Optional[Dict[str, Any]]:
     - لا يراكِم خصمين؛ نختار الأعلى فقط.
     """
     try:
-        res = (
-            get_table(DISCOUNTS_TABLE)
-            .select("*")
-            .eq("active", True)
-            .execute()
-        )
-        rows: List[Dict[str, Any]] = getattr(res, "data", []) or []
+        rows: List[Dict[str, Any]] = _active_rows()
     except Exception as e:
         logging.exception("[discounts] get_active_for_user failed: %s", e)
         return None
@@ -233,6 +275,10 @@ def apply_discount_stacked(user_id: int, amount_syp: int):
         if (r.get("source") or "").lower() == "referral":
             referral_pct = max(referral_pct, int(r.get("percent") or 0))
 
+    return _stacked_result(amount_syp, admin_pct, referral_pct)
+
+
+def _stacked_result(amount_syp: int, admin_pct: int, referral_pct: int):
     total_pct = min(100, admin_pct + referral_pct)  # سقف 100%
     after = int(round(amount_syp * (100 - total_pct) / 100.0))
 
@@ -245,15 +291,24 @@ def apply_discount_stacked(user_id: int, amount_syp: int):
     return after, {"percent": total_pct, "breakdown": breakdown, "id": None}
 
 
+def apply_discount_from_snapshot(amount_syp: int, snap: Dict[str, Any]):
+    """
+    مثل apply_discount_stacked لكن بنسب جاهزة من wallet_snapshot (بدون استعلام discounts).
+    """
+    admin_pct = int((snap or {}).get("admin_percent") or 0)
+    referral_pct = int((snap or {}).get("referral_percent") or 0)
+    return _stacked_result(amount_syp, admin_pct, referral_pct)
+
+
 def record_discount_use(discount_id: str, user_id: int, amount_before: int, amount_after: int, purchase_id: Optional[int] = None) -> None:
     try:
-        get_table(USES_TABLE).insert({
+        insert_row(USES_TABLE, {
             "discount_id": discount_id,
             "user_id": user_id,
             "amount_before": int(amount_before),
             "amount_after":  int(amount_after),
             "purchase_id": purchase_id
-        }).execute()
+        })
     except Exception as e:
         logging.exception("[discounts] record use failed: %s", e)
 
@@ -5,7 +5,7 @@ import threading
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Any, List
 from database.db import get_table
-from services.cleanup_service import purge_ephemeral_after, preview_inactive_users, delete_inactive_users
+from services.cleanup_service import purge_ephemeral_after, preview_inactive_users, delete_inactive_users, sweep_expired_state
 from services.ads_service import purge_expired_ads  # ✅ جديد
 
 OUTBOX_TABLE = "notifications_outbox"
@@ -138,6 +138,44 @@ def start_housekeeping(bot=None, every_seconds: int = 3600):
     """
     def loop():
         _housekeeping_once(bot)
-        threading.Timer(every_seconds, loop).start()
+        t = threading.Timer(every_seconds, loop)
+        t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+        t.start()
     # التشغيل الأول بعد دقيقة من الإقلاع
-    threading.Timer(60, loop).start()
+    t = threading.Timer(60, loop)
+    t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+    t.start()
+
+def start_state_sweeper(every_seconds: int = 300):
+    """كنس دوري لـ user_state المنتهية (expires_at) بدفعات محدودة — بدل الحذف في مسار القراءة."""
+    def loop():
+        try:
+            n = sweep_expired_state()
+            if n:
+                print(f"[maintenance] swept expired user_state: {n}")
+        except Exception as e:
+            print(f"[maintenance] sweep_expired_state error: {e}")
+        t = threading.Timer(every_seconds, loop)
+        t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+        t.start()
+    t = threading.Timer(90, loop)
+    t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+    t.start()
+
+def start_queue_rollup(every_seconds: int = 300):
+    """تجميع ساعي تزايدي لأحداث طابور الإدمن (queue_events → queue_stats_hourly)."""
+    from services.queue_events import rollup
+
+    def loop():
+        try:
+            out = rollup()
+            if out and (out.get("rolled") or out.get("purged")):
+                print(f"[maintenance] queue events rolled up: {out.get('rolled')} (purged {out.get('purged')})")
+        except Exception as e:
+            print(f"[maintenance] rollup_queue_events error: {e}")
+        t = threading.Timer(every_seconds, loop)
+        t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+        t.start()
+    t = threading.Timer(120, loop)
+    t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+    t.start()
@@ -0,0 +1,188 @@
+# services/mem_profiler.py
+# -*- coding: utf-8 -*-
+"""
+قياس ذاكرة عملية البوت (اختياري: MEM_PROFILE=1).
+
+- tracemalloc يبدأ مع الإقلاع (MEM_PROFILE_FRAMES إطار لكل تخصيص) ولقطة كل
+  MEM_PROFILE_INTERVAL ثانية؛ نحتفظ بآخر لقطتين فقط.
+- report(): RSS الحالي + أكبر مواضع التخصيص نموًا بين آخر لقطتين + أحجام الكاشات
+  والقواميس المعروفة (كاش الحالة، كاش المزايا، كاش الاشتراك، history، مخزن الحالة...).
+- أمر الأدمن /mem (handlers/admin.py) يعرض التقرير.
+
+tracemalloc يضيف عبئًا على كل تخصيص (~10-30%) لذا هو معطّل افتراضيًا؛ بدونه يعرض
+التقرير RSS وأحجام الكاشات فقط.
+"""
+
+from __future__ import annotations
+
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+MEM_PROFILE = os.getenv("MEM_PROFILE", "0") == "1"
+MEM_PROFILE_INTERVAL = float(os.getenv("MEM_PROFILE_INTERVAL", "600"))
+MEM_PROFILE_FRAMES = int(os.getenv("MEM_PROFILE_FRAMES", "5"))
+
+_snapshots: "deque[Tuple[float, tracemalloc.Snapshot]]" = deque(maxlen=2)
+_lock = threading.Lock()
+_started = False
+
+_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def rss_mb() -> Optional[float]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except Exception:
+        pass
+    return None
+
+
+def take_snapshot() -> Optional[tracemalloc.Snapshot]:
+    if not tracemalloc.is_tracing():
+        return None
+    snap = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+    with _lock:
+        _snapshots.append((time.time(), snap))
+    return snap
+
+
+def start(interval: float = MEM_PROFILE_INTERVAL) -> bool:
+    """يبدأ tracemalloc واللقطات الدورية إن كان MEM_PROFILE=1 (مرة واحدة)."""
+    global _started
+    if not MEM_PROFILE or _started:
+        return False
+    _started = True
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(MEM_PROFILE_FRAMES)
+
+    def _loop():
+        while True:
+            try:
+                take_snapshot()
+            except Exception as e:
+                logging.warning("[mem] snapshot failed: %s", e)
+            time.sleep(interval)
+
+    threading.Thread(target=_loop, name="mem-profiler", daemon=True).start()
+    logging.info("[mem] tracemalloc on (frames=%s, every %ss)", MEM_PROFILE_FRAMES, interval)
+    return True
+
+
+# ---------- أحجام الكاشات والقواميس المعروفة ----------
+# لا نستورد وحدات غير محمّلة: نقرأ من sys.modules فقط
+
+def _mod_attr(mod: str, attr: str) -> Any:
+    m = sys.modules.get(mod)
+    return getattr(m, attr, None) if m is not None else None
+
+
+def _len(obj: Any) -> Optional[int]:
+    try:
+        return len(obj) if obj is not None else None
+    except Exception:
+        return None
+
+
+def _known_sizes() -> List[Tuple[str, str]]:
+    out: List[Tuple[str, str]] = []
+
+    def add(label: str, fn: Callable[[], Any]) -> None:
+        try:
+            v = fn()
+        except Exception as e:
+            v = f"? ({e.__class__.__name__})"
+        if v is not None:
+            out.append((label, str(v)))
+
+    def _state_cache():
+        st = _mod_attr("services.state_service", "state_cache_stats")
+        if st is None:
+            return None
+        s = st()
+        return f"{s['size']}/{s['max_size']} ({s['bytes'] // 1024}KB)"
+
+    def _history():
+        h = _mod_attr("__main__", "history") or _mod_attr("main", "history")
+        if h is None:
+            return None
+        steps = sum(len(v) for v in list(h.values()) if isinstance(v, list))
+        return f"{len(h)} مستخدم / {steps} خطوة"
+
+    def _state_backend():
+        b = _mod_attr("services.state_backend", "_backend")
+        if b is None:
+            return None
+        rows = getattr(b, "_rows", None)
+        if rows is not None:
+            return f"{b.name}: {len(rows)} صف"
+        return b.name
+
+    def _user_cache():
+        f = _mod_attr("database.db", "user_cache_stats")
+        if f is None:
+            return None
+        s = f()
+        return f"{s['size']}/{s['max_size']}"
+
+    add("كاش الحالة", _state_cache)
+    add("مخزن الحالة", _state_backend)
+    add("كاش المستخدمين", _user_cache)
+    add("كاش المزايا", lambda: _len(_mod_attr("services.feature_flags", "__cache_map")))
+    add("كاش الاشتراك", lambda: _len(_mod_attr("handlers.start", "_sub_status_cache")))
+    add("history", _history)
+    add("anti_spam", lambda: _len(_mod_attr("anti_spam", "_last_actions")))
+    add("queue المُرسَل", lambda: _len(_mod_attr("services.queue_service", "_recently_sent")))
+    return out
+
+
+def report(top: int = 15) -> str:
+    """RSS + أحجام الكاشات + فرق آخر لقطتين (أكبر top مواضع نموًا)."""
+    lines: List[str] = []
+    rss = rss_mb()
+    lines.append(f"🧠 RSS: {rss:.1f}MB" if rss is not None else "🧠 RSS: غير متاح")
+    lines.append(f"gc: {gc.get_count()} | كائنات متتبَّعة {len(gc.get_objects())}")
+    for label, val in _known_sizes():
+        lines.append(f"• {label}: {val}")
+
+    if not tracemalloc.is_tracing():
+        lines.append("\ntracemalloc معطّل (MEM_PROFILE=1 لتفعيله).")
+        return "\n".join(lines)
+
+    take_snapshot()
+    with _lock:
+        snaps = list(_snapshots)
+    cur, peak = tracemalloc.get_traced_memory()
+    lines.append(f"\ntracemalloc: الحالي {cur / 1048576:.1f}MB | الذروة {peak / 1048576:.1f}MB")
+    if len(snaps) < 2:
+        lines.append("لقطة واحدة فقط — أعد الطلب لاحقًا لرؤية الفرق.")
+        return "\n".join(lines)
+
+    (t0, old), (t1, new) = snaps
+    lines.append(f"الفرق خلال {(t1 - t0) / 60:.1f} دقيقة (أكبر {top}):")
+    for stat in new.compare_to(old, "lineno")[:top]:
+        frame = stat.traceback[0]
+        fname = frame.filename
+        for root in sys.path:
+            if root and fname.startswith(root):
+                fname = fname[len(root):].lstrip("/")
+                break
+        lines.append(
+            f"{stat.size_diff / 1024:+9.1f}KB {stat.count_diff:+7d}  {fname}:{frame.lineno}"
+            f"  (={stat.size / 1024:.0f}KB)"
+        )
+    return "\n".join(lines)
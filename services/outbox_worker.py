@@ -58,7 +58,11 @@ def start_outbox_worker(bot, every_seconds: int = 30):
     """
     def loop():
         _tick(bot)
-        threading.Timer(every_seconds, loop).start()
+        t = threading.Timer(every_seconds, loop)
+        t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+        t.start()
     # تأخير بسيط لضمان اكتمال تهيئة البوت
-    threading.Timer(5, loop).start()
+    t = threading.Timer(5, loop)
+    t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+    t.start()
 
@@ -0,0 +1,102 @@
+# services/prefetch.py
+# -*- coding: utf-8 -*-
+"""
+تسخين كاشات المستخدم في الخلفية عند /start والرجوع للقائمة الرئيسية.
+
+الضغطة التالية بعد القائمة الرئيسية تحتاج غالبًا: صف الحالة، صف المحفظة، حالة الحظر،
+والخصومات الفعّالة (وحالة الاشتراك في مسار /start). prefetch_user() يطلقها كلها
+بالتوازي على منفّذ صغير (PREFETCH_WORKERS) ويعود فورًا؛ كل قراءة تملأ كاشها:
+  - state      → services.state_service (كاش الحالة)
+  - wallet     → database.db.get_user_row (كاش المستخدمين: الرصيد/المحجوز)
+  - ban        → services.ban_service (BAN_CACHE_TTL)
+  - discounts  → services.discount_service (DISCOUNT_CACHE_TTL)
+ومع الثلاثة الأخيرة ساخنة تُبنى wallet_service.get_wallet_snapshot محليًا بلا رحلة.
+
+نفس المستخدم لا يُعاد تسخينه قبل PREFETCH_COOLDOWN ثانية. extra={"اسم": دالة} لقراءات
+يحتاجها المنادي نفسه (مثل فحص الاشتراك في /start): تعمل دائمًا، ونتيجتها عبر result().
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from services.ttl_dict import TTLDict
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "4"))
+PREFETCH_COOLDOWN = float(os.getenv("PREFETCH_COOLDOWN", "20"))
+
+_executor = ThreadPoolExecutor(max_workers=max(1, PREFETCH_WORKERS), thread_name_prefix="prefetch")
+_recent = TTLDict(ttl=PREFETCH_COOLDOWN, max_size=20000)
+_stats = {"users": 0, "skipped": 0, "reads": 0, "failed": 0}
+
+
+def _readers(user_id: int) -> Dict[str, Callable[[], Any]]:
+    from database.db import get_user_row
+    from services.ban_service import is_banned
+    from services.discount_service import warm_active_cache
+    from services.state_service import prefetch_state
+
+    return {
+        "state": lambda: prefetch_state(user_id),
+        "wallet": lambda: get_user_row(user_id),
+        "ban": lambda: is_banned(user_id),
+        "discounts": warm_active_cache,
+    }
+
+
+def _run(label: str, fn: Callable[[], Any]) -> Any:
+    _stats["reads"] += 1
+    try:
+        return fn()
+    except Exception as e:
+        _stats["failed"] += 1
+        logging.warning("[prefetch] %s failed: %s", label, e)
+        raise
+
+
+def prefetch_user(user_id: int, extra: Optional[Dict[str, Callable[[], Any]]] = None) -> Dict[str, Future]:
+    """يطلق قراءات المستخدم بالتوازي في الخلفية ويرجع {اسم: Future} فورًا."""
+    # extra أولًا: المنادي ينتظر نتيجتها، فلا تقف خلف قراءات التسخين في الطابور
+    jobs: Dict[str, Callable[[], Any]] = dict(extra or {})
+    if PREFETCH_ENABLED:
+        try:
+            uid = int(user_id)
+        except (TypeError, ValueError):
+            uid = None
+        if uid is not None and uid not in _recent:
+            _recent[uid] = True
+            _stats["users"] += 1
+            try:
+                for label, fn in _readers(uid).items():
+                    jobs.setdefault(label, fn)
+            except Exception as e:
+                logging.warning("[prefetch] readers import failed: %s", e)
+        elif uid is not None:
+            _stats["skipped"] += 1
+    futures: Dict[str, Future] = {}
+    for label, fn in jobs.items():
+        try:
+            futures[label] = _executor.submit(_run, label, fn)
+        except RuntimeError:
+            # المنفّذ أُغلق (إيقاف البوت)
+            break
+    return futures
+
+
+def result(futures: Dict[str, Future], label: str, fallback: Callable[[], Any], timeout: float = 10.0) -> Any:
+    """نتيجة قراءة extra أطلقها prefetch_user؛ fallback() متزامنًا إن لم تُطلق أو فشلت."""
+    fut = futures.get(label)
+    if fut is None:
+        return fallback()
+    try:
+        return fut.result(timeout=timeout)
+    except Exception:
+        return fallback()
+
+
+def prefetch_stats() -> Dict[str, Any]:
+    return dict(_stats, cooling=len(_recent))
@@ -0,0 +1,257 @@
+# services/queue_dispatcher.py
+# -*- coding: utf-8 -*-
+"""
+مُرسِل مستمر لطابور الإدمن (pending_requests) بدل process_queue المنفّذ مرة واحدة.
+
+- خيط واحد طويل العمر يستيقظ عند: إدراج طلب جديد (add_pending_request)، تحرر مكان
+  (تأكيد/إلغاء/تأجيل ← queue_cooldown_start)، أو كل QUEUE_POLL_SECONDS كاحتياط.
+- حتى QUEUE_IN_FLIGHT طلبات معروضة على الأدمن في آن؛ كل مكان فارغ يُملأ بالطلب التالي
+  حسب services/queue_lanes.schedule (مسارات موزونة + أولوية + تقادم SLA) من بين أقدم
+  QUEUE_SCAN_LIMIT طلبًا، ويُرسل عبر queue_service.dispatch_request. دون أعمدة
+  lane/priority (0010_pending_lanes.sql) يبقى الترتيب created_at فقط.
+- الطلب المؤجَّل لا يُعاد إرساله قبل QUEUE_POSTPONE_SECONDS، والإرسال الفاشل يُعاد
+  بعد QUEUE_RETRY_SECONDS. QUEUE_DISPATCH_GAP فاصل اختياري بين إرسالين متتاليين.
+- stats()/report(): عمق الطابور، المعروض حاليًا، وزمن أول عرض للأدمن (p50/p95 منذ الإنشاء)،
+  ولكل مسار: عدد المنتظر و p50/p95 للانتظار الحالي وزمن أول عرض.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from database.db import get_table
+from services import queue_events, queue_lanes, queue_service
+from services.queue_lanes import percentile, wait_seconds
+from services.ttl_dict import TTLDict
+
+QUEUE_IN_FLIGHT = int(os.getenv("QUEUE_IN_FLIGHT", "3"))
+QUEUE_POLL_SECONDS = float(os.getenv("QUEUE_POLL_SECONDS", "15"))
+QUEUE_POSTPONE_SECONDS = float(os.getenv("QUEUE_POSTPONE_SECONDS", "30"))
+QUEUE_RETRY_SECONDS = float(os.getenv("QUEUE_RETRY_SECONDS", "60"))
+QUEUE_DISPATCH_GAP = float(os.getenv("QUEUE_DISPATCH_GAP", "0"))
+QUEUE_SCAN_LIMIT = int(os.getenv("QUEUE_SCAN_LIMIT", "200"))
+
+# {request_id: monotonic حتى يُسمح بإرساله}
+_not_before = TTLDict(ttl=max(QUEUE_POSTPONE_SECONDS, QUEUE_RETRY_SECONDS, 1.0), max_size=5000)
+
+
+class QueueDispatcher:
+    def __init__(self, bot, in_flight: int = QUEUE_IN_FLIGHT, poll_seconds: float = QUEUE_POLL_SECONDS):
+        self.bot = bot
+        self.in_flight = max(1, int(in_flight))
+        self.poll_seconds = max(1.0, float(poll_seconds))
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.depth: Optional[int] = None
+        self.showing: List[int] = []
+        self.dispatched = 0
+        self.failed = 0
+        self.wakeups = 0
+        self.ticks = 0
+        self.last_tick: Optional[float] = None
+        self._first_view: "deque[float]" = deque(maxlen=500)  # ثوانٍ من الإنشاء حتى أول عرض
+        self._lane_view: Dict[str, "deque[float]"] = {}
+        self.lane_waits: Dict[str, Dict[str, Any]] = {}
+        self._viewed = TTLDict(ttl=24 * 3600, max_size=20000)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="queue-dispatcher", daemon=True)
+            self._thread.start()
+            self._wake.set()  # دورة أولى فورًا (طلبات بقيت من قبل إعادة التشغيل)
+
+    def wake(self) -> None:
+        self.wakeups += 1
+        self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            try:
+                self.tick()
+            except Exception as e:
+                logging.warning("[QUEUE] dispatcher tick failed: %s", e)
+
+    def tick(self) -> int:
+        """دورة واحدة: يملأ الأماكن الفارغة من المعروض على الأدمن. يرجع عدد المُرسَل."""
+        self.ticks += 1
+        self.last_tick = time.time()
+        if queue_service.lanes_enabled():
+            try:
+                picked = self._pick_scheduled()
+            except Exception as e:
+                if str(getattr(e, "code", "") or "") not in queue_service._MISSING_COLUMN:
+                    raise
+                queue_service._lanes_missing()
+                picked = self._pick_fifo()
+        else:
+            picked = self._pick_fifo()
+
+        sent = 0
+        for req in picked:
+            if sent and QUEUE_DISPATCH_GAP > 0:
+                time.sleep(QUEUE_DISPATCH_GAP)
+            if self._dispatch(req):
+                sent += 1
+        return sent
+
+    @staticmethod
+    def _is_showing(row: Dict[str, Any]) -> bool:
+        # معروض على الأدمن بالفعل في دوره الحالي (التأجيل يغيّر created_at)
+        return queue_service._recently_sent.get(row.get("id")) == str(row.get("created_at"))
+
+    @staticmethod
+    def _ready(row: Dict[str, Any], now: float) -> bool:
+        return now >= _not_before.get(row.get("id"), 0)
+
+    def _pick_fifo(self) -> List[Dict[str, Any]]:
+        res = (
+            get_table(queue_service.QUEUE_TABLE)
+            .select("*", count="exact")
+            .order("created_at")
+            .limit(self.in_flight)
+            .execute()
+        )
+        rows = getattr(res, "data", None) or []
+        count = getattr(res, "count", None)
+        self.depth = int(count) if count is not None else len(rows)
+        self.showing = [r.get("id") for r in rows]
+        now = time.monotonic()
+        return [r for r in rows if not self._is_showing(r) and self._ready(r, now)]
+
+    def _pick_scheduled(self) -> List[Dict[str, Any]]:
+        res = (
+            get_table(queue_service.QUEUE_TABLE)
+            .select("id, lane, priority, created_at, enqueued_at:payload->>enqueued_at", count="exact")
+            .order("created_at")
+            .limit(QUEUE_SCAN_LIMIT)
+            .execute()
+        )
+        rows = getattr(res, "data", None) or []
+        count = getattr(res, "count", None)
+        self.depth = int(count) if count is not None else len(rows)
+        self.lane_waits = queue_lanes.lane_waits(rows)
+
+        showing = [r for r in rows if self._is_showing(r)]
+        free = self.in_flight - len(showing)
+        now = time.monotonic()
+        chosen = []
+        if free > 0:
+            # المعروض حاليًا خُدم فعلًا (ساعة مساره تقدمت) — لا يُحسب مرة ثانية في الجدولة
+            waiting = [r for r in rows if not self._is_showing(r)]
+            chosen = [r for r in queue_lanes.schedule(waiting) if self._ready(r, now)][:free]
+        self.showing = [r.get("id") for r in showing + chosen]
+        if not chosen:
+            return []
+        ids = [r["id"] for r in chosen]
+        full = get_table(queue_service.QUEUE_TABLE).select("*").in_("id", ids).execute()
+        by_id = {r.get("id"): r for r in (getattr(full, "data", None) or [])}
+        return [by_id[i] for i in ids if i in by_id]  # حُذف بين القراءتين = تم التعامل معه
+
+    def _dispatch(self, req: Dict[str, Any]) -> bool:
+        rid = req.get("id")
+        created = str(req.get("created_at"))
+        try:
+            pairs = queue_service.dispatch_request(self.bot, req)
+        except Exception as e:
+            self.failed += 1
+            _not_before[rid] = time.monotonic() + QUEUE_RETRY_SECONDS
+            logging.exception("[QUEUE] dispatch failed for request %s: %s", rid, e)
+            return False
+        queue_service._recently_sent[rid] = created
+        self.dispatched += 1
+        if queue_service.lanes_enabled():
+            queue_lanes.served(req.get("lane"))  # تقدّم ساعة WFQ للمسار المخدوم
+        if pairs and rid not in self._viewed:
+            self._viewed[rid] = True
+            age = wait_seconds((req.get("payload") or {}).get("enqueued_at") or created)
+            if age is not None:
+                self._first_view.append(age)
+                lane = req.get("lane") or queue_lanes.lane_for(req.get("payload"))
+                self._lane_view.setdefault(lane, deque(maxlen=200)).append(age)
+            queue_events.record("dispatched", rid, req=req)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        views = list(self._first_view)
+        return {
+            "depth": self.depth, "showing": list(self.showing), "in_flight": self.in_flight,
+            "dispatched": self.dispatched, "failed": self.failed, "wakeups": self.wakeups,
+            "ticks": self.ticks, "last_tick": self.last_tick,
+            "first_view_p50": percentile(views, 0.5), "first_view_p95": percentile(views, 0.95),
+            "first_view_n": len(views),
+            "lanes": {
+                lane: dict(self.lane_waits.get(lane) or {"n": 0, "p50": None, "p95": None,
+                                                         "sla": queue_lanes.LANE_SLA.get(lane)},
+                           view_p50=percentile(list(self._lane_view.get(lane) or ()), 0.5),
+                           view_p95=percentile(list(self._lane_view.get(lane) or ()), 0.95))
+                for lane in queue_lanes.LANES
+            },
+        }
+
+
+_dispatcher: Optional[QueueDispatcher] = None
+_start_lock = threading.Lock()
+
+
+def start(bot) -> QueueDispatcher:
+    """يشغّل المُرسِل مرة واحدة (main.py)."""
+    global _dispatcher
+    with _start_lock:
+        if _dispatcher is None:
+            _dispatcher = QueueDispatcher(bot)
+            _dispatcher.start()
+            logging.info("[QUEUE] dispatcher on (in_flight=%s, poll=%ss)",
+                         _dispatcher.in_flight, _dispatcher.poll_seconds)
+    return _dispatcher
+
+
+def wake(bot=None) -> None:
+    """يوقظ المُرسِل (ويشغّله إن مُرّر bot ولم يكن يعمل بعد)."""
+    d = _dispatcher
+    if d is None:
+        if bot is None:
+            return
+        d = start(bot)
+    d.wake()
+
+
+def defer(request_id: int, seconds: float = QUEUE_POSTPONE_SECONDS) -> None:
+    """لا يُعاد إرسال الطلب قبل seconds ثانية (بعد التأجيل)."""
+    _not_before[request_id] = time.monotonic() + max(0.0, seconds)
+
+
+def stats() -> Dict[str, Any]:
+    return _dispatcher.stats() if _dispatcher is not None else {}
+
+
+def report() -> str:
+    s = stats()
+    if not s:
+        return "📬 مُرسِل الطابور: غير مفعّل"
+    p50, p95 = s["first_view_p50"], s["first_view_p95"]
+    view = f"{p50:.0f}s / {p95:.0f}s (n={s['first_view_n']})" if p50 is not None else "—"
+    depth = s["depth"] if s["depth"] is not None else "?"
+    return (
+        f"📬 الطابور: {depth} طلب | معروض {len(s['showing'])}/{s['in_flight']}"
+        f" | أُرسل {s['dispatched']} (فشل {s['failed']})"
+        f"\n⏱️ أول عرض للأدمن p50/p95: {view}"
+        + "".join(_lane_line(lane, ls) for lane, ls in s["lanes"].items())
+    )
+
+
+def _secs(v: Optional[float]) -> str:
+    return "—" if v is None else f"{v:.0f}s"
+
+
+def _lane_line(lane: str, ls: Dict[str, Any]) -> str:
+    return (
+        f"\n  • {lane}: ينتظر {ls.get('n', 0)} | انتظار p50/p95 {_secs(ls.get('p50'))}/{_secs(ls.get('p95'))}"
+        f" (SLA {_secs(ls.get('sla'))}) | أول عرض p50/p95 {_secs(ls.get('view_p50'))}/{_secs(ls.get('view_p95'))}"
+    )
@@ -0,0 +1,244 @@
+# services/queue_events.py
+# -*- coding: utf-8 -*-
+"""
+تحليلات طابور الإدمن: أحداث دورة حياة الطلب + تجميع ساعي + تقرير (0011_queue_events.sql).
+
+- record(event, request_id, ...): صف في queue_events عند كل انتقال:
+    created (الإدراج) → dispatched (أول عرض للأدمن) → claimed (📌 استلمت)
+    → postponed (تأجيل) → accepted | cancelled (حذف الطلب من الطابور).
+  wait_ms = الزمن منذ دخول الطلب الطابور: payload.enqueued_at (يبقى ثابتًا رغم التأجيل
+  الذي يعيد كتابة created_at)، وإلا created_at. الكتابة عبر الكاتب المؤجّل (batch_writer)
+  فلا تضيف رحلة لمسار الأدمن، وأي فشل يُسجَّل فقط.
+- rollup(): يستدعي rollup_queue_events — يضيف الأحداث الجديدة فقط إلى queue_stats_hourly
+  (maintenance_worker.start_queue_rollup كل QUEUE_ROLLUP_SECONDS، وقبل كل تقرير)، عدا آخر
+  QUEUE_ROLLUP_LAG_SECONDS ثانية: هامش commit حتى لا تسقط دفعة متأخرة خلف العلامة.
+- report(): p50/p95 للانتظار حتى العرض/الاستلام/الإنجاز (إجمالًا ولكل مسار) مقدّرة من
+  مدرّج الساعات، وإنتاجية كل أدمن (منجز/ملغى، لكل ساعة نشطة، الذروة).
+QUEUE_EVENTS_ENABLED=0 يوقف التسجيل.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from database.db import get_table, client, with_retry
+from services.queue_lanes import lane_for, wait_seconds
+
+QUEUE_EVENTS_ENABLED = os.getenv("QUEUE_EVENTS_ENABLED", "1") == "1"
+QUEUE_EVENTS_KEEP_DAYS = int(os.getenv("QUEUE_EVENTS_KEEP_DAYS", "30"))
+# أحداث أحدث من هذا الهامش تنتظر الدورة التالية (commit متأخر لـid أصغر لا يُتجاوز)
+QUEUE_ROLLUP_LAG_SECONDS = int(os.getenv("QUEUE_ROLLUP_LAG_SECONDS", "60"))
+
+EVENTS_TABLE = "queue_events"
+HOURLY_TABLE = "queue_stats_hourly"
+EVENTS = ("created", "dispatched", "claimed", "postponed", "accepted", "cancelled")
+
+# حدود خانات المدرّج بالثواني (مطابقة لـ rollup_queue_events)
+WAIT_BOUNDS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 21600)
+
+_rollup_available = True
+_stats = {"recorded": 0, "failed": 0, "rollups": 0, "rolled": 0}
+
+
+def record(event: str, request_id: Optional[int], *, req: Optional[Dict[str, Any]] = None,
+           payload: Optional[Dict[str, Any]] = None, user_id: Optional[int] = None,
+           admin_id: Optional[int] = None, lane: Optional[str] = None) -> None:
+    """يسجّل حدثًا لطلب؛ req صف pending_requests إن توفّر (user_id/lane/payload/created_at)."""
+    if not QUEUE_EVENTS_ENABLED or request_id is None or event not in EVENTS:
+        return
+    try:
+        req = req or {}
+        payload = payload if payload is not None else (req.get("payload") or {})
+        since = payload.get("enqueued_at") or req.get("created_at")
+        wait = wait_seconds(since) if since and event != "created" else None
+        row = {
+            "request_id": int(request_id),
+            "event": event,
+            "user_id": user_id if user_id is not None else req.get("user_id"),
+            "admin_id": int(admin_id) if admin_id is not None else None,
+            "lane": lane or req.get("lane") or lane_for(payload),
+            "wait_ms": int(wait * 1000) if wait is not None else 0,
+        }
+        from database.batch_writer import insert_row
+        insert_row(EVENTS_TABLE, row, durability="async")
+        _stats["recorded"] += 1
+    except Exception as e:
+        _stats["failed"] += 1
+        logging.warning("[QUEUE] event %s for request %s not recorded: %s", event, request_id, e)
+
+
+def rollup() -> Optional[Dict[str, Any]]:
+    """تجميع تزايدي للأحداث الجديدة في queue_stats_hourly."""
+    global _rollup_available
+    if not _rollup_available:
+        return None
+    try:
+        from database.batch_writer import flush
+        flush(EVENTS_TABLE)
+    except Exception:
+        pass
+    try:
+        res = with_retry(client().rpc("rollup_queue_events", {
+            "p_keep_days": QUEUE_EVENTS_KEEP_DAYS, "p_lag_seconds": QUEUE_ROLLUP_LAG_SECONDS,
+        }).execute)
+    except Exception as e:
+        if str(getattr(e, "code", "") or "") in ("PGRST202", "42883"):
+            _rollup_available = False
+            logging.warning("[QUEUE] rollup_queue_events غير موجودة (طبّق 0011_queue_events.sql)")
+            return None
+        raise
+    out = getattr(res, "data", None) or {}
+    if isinstance(out, list):
+        out = out[0] if out else {}
+    _stats["rollups"] += 1
+    _stats["rolled"] += int(out.get("rolled") or 0)
+    return out
+
+
+def stats() -> Dict[str, Any]:
+    return dict(_stats, rollup_available=_rollup_available)
+
+
+# ===== التقرير =====
+def _hist_percentile(hist: List[int], q: float, max_ms: int) -> Optional[float]:
+    """تقدير نسبة مئوية بالثواني من المدرّج (استيفاء خطي داخل الخانة)."""
+    total = sum(hist)
+    if total <= 0:
+        return None
+    target = q * total
+    seen = 0
+    for i, c in enumerate(hist):
+        if c and seen + c >= target:
+            lo = WAIT_BOUNDS[i - 1] if i > 0 else 0
+            hi = WAIT_BOUNDS[i] if i < len(WAIT_BOUNDS) else max(max_ms / 1000.0, lo)
+            hi = min(hi, max(max_ms / 1000.0, lo))  # لا نتجاوز أقصى انتظار رُصد
+            return lo + (hi - lo) * ((target - seen) / c)
+        seen += c
+    return max_ms / 1000.0
+
+
+def _merge(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    hist = [0] * (len(WAIT_BOUNDS) + 1)
+    n = total = mx = 0
+    for r in rows:
+        n += int(r.get("n") or 0)
+        total += int(r.get("wait_ms_sum") or 0)
+        mx = max(mx, int(r.get("wait_ms_max") or 0))
+        for i, c in enumerate(r.get("wait_hist") or []):
+            if i < len(hist):
+                hist[i] += int(c or 0)
+    return {
+        "n": n,
+        "avg": (total / n / 1000.0) if n else None,
+        "p50": _hist_percentile(hist, 0.5, mx),
+        "p95": _hist_percentile(hist, 0.95, mx),
+        "max": mx / 1000.0 if n else None,
+    }
+
+
+def _hourly_since(since: datetime) -> List[Dict[str, Any]]:
+    res = (
+        get_table(HOURLY_TABLE)
+        .select("hour, event, lane, admin_id, n, wait_ms_sum, wait_ms_max, wait_hist")
+        .gte("hour", since.isoformat())
+        .execute()
+    )
+    return getattr(res, "data", None) or []
+
+
+def summary(hours: int = 24, days: int = 7) -> Dict[str, Any]:
+    """الأرقام خلف report(): انتظار آخر hours ساعة، وإنتاجية الأدمن لآخر days يوم."""
+    now = datetime.now(timezone.utc)
+    rows = _hourly_since(now - timedelta(days=max(days, 1), hours=1))
+    recent_from = (now - timedelta(hours=hours)).replace(minute=0, second=0, microsecond=0)
+
+    def _recent(r):
+        try:
+            return datetime.fromisoformat(str(r["hour"]).replace("Z", "+00:00")) >= recent_from
+        except Exception:
+            return False
+
+    recent = [r for r in rows if _recent(r)]
+    waits = {ev: _merge([r for r in recent if r.get("event") == ev]) for ev in ("dispatched", "claimed", "accepted")}
+    lanes: Dict[str, List[Dict[str, Any]]] = {}
+    for r in recent:
+        if r.get("event") == "accepted":
+            lanes.setdefault(r.get("lane") or "?", []).append(r)
+    counts = {ev: sum(int(r.get("n") or 0) for r in recent if r.get("event") == ev) for ev in EVENTS}
+
+    admins: Dict[int, Dict[str, Any]] = {}
+    for r in rows:
+        if r.get("event") not in ("accepted", "cancelled") or not r.get("admin_id"):
+            continue
+        a = admins.setdefault(int(r["admin_id"]), {"accepted": 0, "cancelled": 0, "hours": {}})
+        n = int(r.get("n") or 0)
+        a[r["event"]] += n
+        a["hours"][r["hour"]] = a["hours"].get(r["hour"], 0) + n
+    throughput = {
+        aid: {
+            "accepted": a["accepted"], "cancelled": a["cancelled"],
+            "total": a["accepted"] + a["cancelled"],
+            "active_hours": len(a["hours"]),
+            "per_hour": (a["accepted"] + a["cancelled"]) / len(a["hours"]) if a["hours"] else 0.0,
+            "peak": max(a["hours"].values()) if a["hours"] else 0,
+        }
+        for aid, a in admins.items()
+    }
+    return {
+        "hours": hours, "days": days, "counts": counts, "waits": waits,
+        "lanes": {lane: _merge(v) for lane, v in lanes.items()},
+        "admins": dict(sorted(throughput.items(), key=lambda kv: -kv[1]["total"])),
+    }
+
+
+def _dur(v: Optional[float]) -> str:
+    if v is None:
+        return "—"
+    if v < 120:
+        return f"{v:.0f}s"
+    if v < 7200:
+        return f"{v / 60:.0f}m"
+    return f"{v / 3600:.1f}h"
+
+
+def report(hours: int = 24, days: int = 7, names: Optional[Dict[int, str]] = None) -> str:
+    """تقرير نصي للأدمن (handlers/admin.py: /queue و sys:queue)."""
+    try:
+        rollup()
+    except Exception as e:
+        logging.warning("[QUEUE] rollup before report failed: %s", e)
+    try:
+        s = summary(hours, days)
+    except Exception as e:
+        logging.warning("[QUEUE] queue analytics unavailable: %s", e)
+        return "📈 تحليلات الطابور غير متاحة (طبّق 0011_queue_events.sql)"
+
+    names = names or {}
+    c = s["counts"]
+    labels = {"dispatched": "حتى العرض", "claimed": "حتى الاستلام", "accepted": "حتى الإنجاز"}
+    lines = [
+        f"📈 الطابور — آخر {hours} ساعة",
+        f"📥 دخل {c['created']} | 📤 عُرض {c['dispatched']} | 📌 استُلم {c['claimed']}"
+        f" | ⏸️ أُجّل {c['postponed']} | ✅ {c['accepted']} | 🚫 {c['cancelled']}",
+        "⏱️ الانتظار p50 / p95 (أقصى):",
+    ]
+    for ev, label in labels.items():
+        w = s["waits"][ev]
+        lines.append(f"  • {label}: {_dur(w['p50'])} / {_dur(w['p95'])} ({_dur(w['max'])}) n={w['n']}")
+    if s["lanes"]:
+        lines.append("🛣️ حتى الإنجاز حسب المسار:")
+        for lane, w in sorted(s["lanes"].items()):
+            lines.append(f"  • {lane}: {_dur(w['p50'])} / {_dur(w['p95'])} n={w['n']}")
+    lines.append(f"👮 إنتاجية الأدمن — آخر {days} يوم:")
+    if not s["admins"]:
+        lines.append("  —")
+    for aid, a in s["admins"].items():
+        who = names.get(aid) or str(aid)
+        lines.append(
+            f"  • {who}: {a['total']} (✅{a['accepted']} / 🚫{a['cancelled']})"
+            f" | {a['per_hour']:.1f}/ساعة نشطة ({a['active_hours']}س) | ذروة {a['peak']}/ساعة"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,175 @@
+# services/queue_lanes.py
+# -*- coding: utf-8 -*-
+"""
+مسارات وأولويات طابور الإدمن (pending_requests.lane / priority — 0010_pending_lanes.sql).
+
+- lane_for(payload): recharge | purchase | transfers | ads حسب payload.type.
+- priority_for(payload): payload.priority صراحةً، وإلا 1 للطلبات عالية القيمة
+  (المبلغ ≥ QUEUE_HIGH_VALUE_SYP)، وإلا 0.
+- schedule(rows): ترتيب العرض على الأدمن:
+    1) المتأخر عن SLA مساره أولًا (الأكثر تأخرًا نسبةً للـSLA) — التقادم يمنع تجويع أي مسار؛
+       العمر من enqueued_at (payload.enqueued_at) لأن التأجيل يعيد كتابة created_at؛
+    2) الباقي بجدولة عادلة موزونة (WFQ) بساعة افتراضية دائمة بين الدورات (LaneClock):
+       لكل مسار زمن إنهاء افتراضي يتقدم 1/w كلما خُدم (served)، ويبدأ من الساعة العامة
+       حين يعود المسار من الخمول — فالأماكن التي تتحرر واحدًا واحدًا تتوزع بنسبة الأوزان.
+       العنصر k في المسار زمنه الافتراضي finish + (k+1)/w، وداخل المسار: الأولوية الأعلى ثم الأقدم.
+  الأوزان QUEUE_LANE_WEIGHTS و SLA بالثواني QUEUE_LANE_SLA (بصيغة "lane:value,...").
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+LANES = ("recharge", "purchase", "transfers", "ads")
+DEFAULT_LANE = "purchase"
+
+_TYPE_LANES = {
+    "recharge": "recharge",
+    "ads": "ads",
+    "cash_transfer": "transfers",
+    "companies_transfer": "transfers",
+}
+
+
+def _parse_map(raw: str, default: Dict[str, float]) -> Dict[str, float]:
+    out = dict(default)
+    for part in (raw or "").split(","):
+        if ":" not in part:
+            continue
+        k, v = part.split(":", 1)
+        try:
+            out[k.strip()] = float(v)
+        except ValueError:
+            pass
+    return out
+
+
+LANE_WEIGHTS = _parse_map(os.getenv("QUEUE_LANE_WEIGHTS", ""),
+                          {"recharge": 4, "purchase": 3, "transfers": 3, "ads": 1})
+LANE_SLA = _parse_map(os.getenv("QUEUE_LANE_SLA", ""),
+                      {"recharge": 300, "purchase": 600, "transfers": 600, "ads": 3600})
+QUEUE_HIGH_VALUE_SYP = int(os.getenv("QUEUE_HIGH_VALUE_SYP", "500000"))
+
+
+def lane_for(payload: Optional[Dict[str, Any]]) -> str:
+    typ = str((payload or {}).get("type") or "").strip()
+    return _TYPE_LANES.get(typ, DEFAULT_LANE)
+
+
+def priority_for(payload: Optional[Dict[str, Any]]) -> int:
+    payload = payload or {}
+    try:
+        if payload.get("priority") is not None:
+            return int(payload["priority"])
+    except (TypeError, ValueError):
+        pass
+    if QUEUE_HIGH_VALUE_SYP > 0:
+        for k in ("reserved", "total", "price", "amount"):
+            v = payload.get(k)
+            if isinstance(v, (int, float)) and v > 0:
+                return 1 if v >= QUEUE_HIGH_VALUE_SYP else 0
+    return 0
+
+
+def wait_seconds(created_at: Any, now: Optional[datetime] = None) -> Optional[float]:
+    try:
+        s = str(created_at)
+        d = datetime.fromisoformat(s[:-1] + "+00:00" if s.endswith("Z") else s)
+        if d.tzinfo is None:
+            d = d.replace(tzinfo=timezone.utc)  # created_at يُكتب utcnow() بلا منطقة
+        return max(0.0, ((now or datetime.now(timezone.utc)) - d).total_seconds())
+    except Exception:
+        return None
+
+
+def _weight(lane: str) -> float:
+    return max(LANE_WEIGHTS.get(lane) or 1.0, 0.01)
+
+
+def enqueued_at(row: Dict[str, Any]) -> Any:
+    """لحظة دخول الطابور: enqueued_at (عمود مُسقط أو داخل payload)، وإلا created_at."""
+    return row.get("enqueued_at") or (row.get("payload") or {}).get("enqueued_at") or row.get("created_at")
+
+
+class LaneClock:
+    """ساعة WFQ الافتراضية: زمن إنهاء لكل مسار يبقى بين دورات المُرسِل."""
+
+    def __init__(self):
+        self.vtime = 0.0
+        self.finish: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def base(self, backlogged) -> Dict[str, float]:
+        """زمن إنهاء كل مسار مُنتظِر؛ المسار العائد من الخمول يبدأ من الساعة العامة."""
+        with self._lock:
+            for lane in list(self.finish):
+                if lane not in backlogged:
+                    del self.finish[lane]  # خامل: لا يدّخر رصيدًا
+            for lane in backlogged:
+                self.finish.setdefault(lane, self.vtime)
+            return dict(self.finish)
+
+    def served(self, lane: Optional[str]) -> None:
+        lane = lane or DEFAULT_LANE
+        with self._lock:
+            start = self.finish.get(lane, self.vtime)
+            self.vtime = max(self.vtime, start)
+            self.finish[lane] = start + 1.0 / _weight(lane)
+
+
+_clock = LaneClock()
+
+
+def served(lane: Optional[str]) -> None:
+    """يُستدعى بعد إرسال طلب من المسار للأدمن (queue_dispatcher)."""
+    _clock.served(lane)
+
+
+def schedule(rows: List[Dict[str, Any]], now: Optional[datetime] = None,
+             clock: Optional[LaneClock] = None) -> List[Dict[str, Any]]:
+    """يرتب الصفوف (id, lane, priority, created_at, enqueued_at) بترتيب العرض."""
+    now = now or datetime.now(timezone.utc)
+    clock = clock or _clock
+    overdue = []
+    lanes: Dict[str, List[Dict[str, Any]]] = {}
+    for r in rows:
+        lane = r.get("lane") or DEFAULT_LANE
+        sla = LANE_SLA.get(lane) or LANE_SLA[DEFAULT_LANE]
+        wait = wait_seconds(enqueued_at(r), now) or 0.0
+        if sla > 0 and wait >= sla:
+            overdue.append((wait / sla, r))
+        else:
+            lanes.setdefault(lane, []).append(r)
+    overdue.sort(key=lambda t: -t[0])
+
+    base = clock.base({(r.get("lane") or DEFAULT_LANE) for r in rows})
+    tagged = []
+    for lane, items in lanes.items():
+        items.sort(key=lambda r: (-int(r.get("priority") or 0), str(r.get("created_at"))))
+        w = _weight(lane)
+        for k, r in enumerate(items):
+            tagged.append((base[lane] + (k + 1) / w, -w, str(r.get("created_at")), r))
+    tagged.sort(key=lambda t: t[:3])
+    return [r for _, r in overdue] + [t[3] for t in tagged]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    vals = sorted(values)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+
+def lane_waits(rows: List[Dict[str, Any]], now: Optional[datetime] = None) -> Dict[str, Dict[str, Any]]:
+    """الانتظار الحالي لكل مسار: العدد و p50/p95 بالثواني."""
+    now = now or datetime.now(timezone.utc)
+    waits: Dict[str, List[float]] = {lane: [] for lane in LANES}
+    for r in rows:
+        w = wait_seconds(enqueued_at(r), now)
+        if w is not None:
+            waits.setdefault(r.get("lane") or DEFAULT_LANE, []).append(w)
+    return {lane: {"n": len(v), "p50": percentile(v, 0.5), "p95": percentile(v, 0.95), "sla": LANE_SLA.get(lane)}
+            for lane, v in waits.items()}
@@ -1,25 +1,41 @@
 # -*- coding: utf-8 -*-
 # services/queue_service.py
 
-import time
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import httpx
-import threading
 
-from database.db import get_table
+from database.db import get_table, client, with_retry, SupabaseUnavailable
+from services.ttl_dict import TTLDict
+from services.queue_lanes import lane_for, priority_for, schedule
+from services.queue_events import record as record_event
 from config import ADMIN_MAIN_ID, ADMINS
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from telebot.apihelper import ApiTelegramException
 from postgrest.exceptions import APIError  # ← لالتقاط 23505 وقت السباق
 
 QUEUE_TABLE = "pending_requests"
 
-_queue_lock = threading.Lock()
-_queue_cooldown = False
+# الطلبات المُرسلة للأدمن: {request_id: created_at وقت الإرسال} — تأجيل الطلب يغيّر created_at
+# فيُعاد إرساله في دوره الجديد (services/queue_dispatcher)
+_DISPATCHED_TTL = 24 * 3600
+_recently_sent = TTLDict(ttl=_DISPATCHED_TTL, max_size=5000)
+
+# أعمدة المسار/الأولوية (0010_pending_lanes.sql)؛ تُعطَّل تلقائيًا إن لم تكن موجودة
+_MISSING_COLUMN = ("PGRST204", "42703")
+_lane_columns = True
 
-# منع التكرار ضمن نافذة قصيرة (حماية إضافية من تعدد الاستدعاءات)
-_recently_sent = {}        # {request_id: last_ts}
-_RECENT_TTL     = 40       # ثوانٍ
+def _lanes_missing():
+    global _lane_columns
+    if _lane_columns:
+        _lane_columns = False
+        logging.warning("[QUEUE] pending_requests.lane/priority غير موجودة (0010_pending_lanes.sql) — ترتيب created_at فقط")
+
+def lanes_enabled() -> bool:
+    return _lane_columns
 
 def _admin_targets():
     # إرجاع قائمة الإداريين (ADMINS + ADMIN_MAIN_ID) بدون تكرار، مع الحفاظ على الترتيب.
@@ -68,40 +84,55 @@ def _add_pending_request_text(user_id: int, username: str, request_text: str, pa
         "request_text": request_text,
         "created_at": datetime.utcnow().isoformat()
     }
-    if payload is not None:
-        data["payload"] = payload
-
-    for attempt in range(1, 4):
+    # enqueued_at ثابت رغم التأجيل (الذي يعيد كتابة created_at) — أساس زمن الانتظار في queue_events
+    payload = dict(payload or {}, enqueued_at=data["created_at"])
+    data["payload"] = payload
+    if _lane_columns:
+        data["lane"] = lane_for(payload)
+        data["priority"] = priority_for(payload)
+
+    # insert آمن للتكرار هنا: قيد UNIQUE(user_id) يحوّل التكرار إلى 23505 ⇒ duplicate
+    try:
         try:
-            r = get_table(QUEUE_TABLE).insert(data).execute()
-            rid = (r.data or [{}])[0].get("id")
-            return {"status": "created", "request_id": rid}
+            r = with_retry(get_table(QUEUE_TABLE).insert(data).execute)
         except APIError as e:
-            # لو حدث سباق وأرجعت القاعدة 23505 نرجع duplicate بهدوء
-            code = getattr(e, "code", None)
-            if code == "23505":
-                try:
-                    ex = (
-                        get_table(QUEUE_TABLE)
-                        .select("id")
-                        .eq("user_id", user_id)
-                        .limit(1)
-                        .execute()
-                    )
-                    if ex.data:
-                        return {"status": "duplicate", "request_id": ex.data[0]["id"]}
-                except Exception:
-                    pass
-                return {"status": "duplicate", "request_id": None}
-            # غير ذلك: خطأ من PostgREST — لا نعيد رفعه حتى لا ينهار الworker
-            logging.exception("[QUEUE] APIError on insert: %s", e)
-            return {"status": "error"}
-        except httpx.ReadError as e:
-            logging.warning(f"Attempt {attempt}: ReadError in add_pending_request: {e}")
-            time.sleep(0.5)
-
-    logging.error(f"Failed to add pending request for user {user_id} after 3 attempts.")
-    return {"status": "error"}
+            # lane/priority غير موجودة بعد (0010_pending_lanes.sql لم تُطبَّق)
+            if getattr(e, "code", None) not in _MISSING_COLUMN or "lane" not in data:
+                raise
+            _lanes_missing()
+            data.pop("lane", None)
+            data.pop("priority", None)
+            r = with_retry(get_table(QUEUE_TABLE).insert(data).execute)
+        rid = (r.data or [{}])[0].get("id")
+        record_event("created", rid, req=data)
+        _wake_dispatcher()
+        return {"status": "created", "request_id": rid}
+    except APIError as e:
+        # لو حدث سباق وأرجعت القاعدة 23505 نرجع duplicate بهدوء
+        code = getattr(e, "code", None)
+        if code == "23505":
+            try:
+                ex = (
+                    get_table(QUEUE_TABLE)
+                    .select("id")
+                    .eq("user_id", user_id)
+                    .limit(1)
+                    .execute()
+                )
+                if ex.data:
+                    return {"status": "duplicate", "request_id": ex.data[0]["id"]}
+            except Exception:
+                pass
+            return {"status": "duplicate", "request_id": None}
+        # غير ذلك: خطأ من PostgREST — لا نعيد رفعه حتى لا ينهار الworker
+        logging.exception("[QUEUE] APIError on insert: %s", e)
+        return {"status": "error"}
+    except SupabaseUnavailable as e:
+        logging.warning("[QUEUE] add_pending_request rejected (circuit open): %s", e)
+        return {"status": "error"}
+    except httpx.TransportError as e:
+        logging.error(f"Failed to add pending request for user {user_id}: {e}")
+        return {"status": "error"}
 
 def add_pending_request(*args, **kwargs):
     """
@@ -131,14 +162,34 @@ def add_pending_request(*args, **kwargs):
     raise TypeError("add_pending_request: استخدم النمط القديم (user_id, username, request_text, payload) أو الجديد (user_id=.., action=.., payload=..).")
 
 
-def delete_pending_request(request_id: int):
+def delete_pending_request(request_id: int, outcome: str = None, *, admin_id: int = None, req: dict = None):
+    # outcome: "accepted" | "cancelled" ⇒ حدث في queue_events (req = صف الطلب إن كان بيد المنادي)
     try:
-        get_table(QUEUE_TABLE).delete().eq("id", request_id).execute()
+        res = get_table(QUEUE_TABLE).delete().eq("id", request_id).execute()
     except Exception:
         logging.exception(f"Error deleting pending request {request_id}")
+        return
+    if outcome:
+        # الصف المحذوف (PostgREST يرجعه) يكفي عند غياب req
+        gone = getattr(res, "data", None) or []
+        record_event(outcome, request_id, req=req or (gone[0] if gone else None), admin_id=admin_id)
 
 def get_next_request():
+    # الطلب التالي حسب المسارات/الأولوية (services/queue_lanes.schedule) أو الأقدم دونها
     try:
+        if _lane_columns:
+            res = (
+                get_table(QUEUE_TABLE)
+                .select("id, lane, priority, created_at, enqueued_at:payload->>enqueued_at")
+                .order("created_at")
+                .limit(200)
+                .execute()
+            )
+            order = schedule(res.data or [])
+            if not order:
+                return None
+            full = get_table(QUEUE_TABLE).select("*").eq("id", order[0]["id"]).limit(1).execute()
+            return (full.data or [None])[0]
         res = (
             get_table(QUEUE_TABLE)
             .select("*")
@@ -158,6 +209,82 @@ def get_next_request():
 def update_request_admin_message_id(request_id: int, message_id: int):
     logging.debug(f"Skipping update_request_admin_message_id for request {request_id}")
 
+# ===== أقفال/payload ذرّية عبر RPC (database/sql/0009_queue_claim_rpcs.sql) =====
+# كل دالة ترجع {ok, id, user_id, request_text, created_at, payload} أو None إن لم يوجد الطلب.
+# إن لم تكن الدوال منشورة (PGRST202/42883) نرجع للطريقة القديمة (قراءة ثم تحديث مشروط).
+_LOCK_KEYS = ("locked_by", "locked_by_username", "claimed")
+_queue_rpc_available = True
+
+def _queue_rpc(fn: str, params: dict):
+    global _queue_rpc_available
+    try:
+        data = with_retry(client().rpc(fn, params).execute).data
+    except Exception as e:
+        if str(getattr(e, "code", "") or "") in ("PGRST202", "42883"):
+            _queue_rpc_available = False
+            logging.warning("[QUEUE] %s غير منشورة (0009_queue_claim_rpcs.sql) — رجوع للطريقة القديمة", fn)
+        raise
+    if isinstance(data, list):
+        data = data[0] if data else None
+    return data if isinstance(data, dict) else None
+
+def _legacy_row(request_id: int):
+    r = get_table(QUEUE_TABLE).select("id, user_id, request_text, created_at, payload").eq("id", request_id).limit(1).execute()
+    row = (r.data or [None])[0]
+    if row is not None:
+        row["payload"] = row.get("payload") or {}
+    return row
+
+def _legacy_lock_update(request_id: int, admin_id, patch_fn, extra=None):
+    # مسار قديم: قراءة ثم تحديث مشروط بقيمة القفل المقروءة (لا يفوز أدمنان معًا)
+    row = _legacy_row(request_id)
+    if row is None:
+        return None
+    payload = row["payload"]
+    locked = payload.get("locked_by")
+    if admin_id is not None and locked is not None and str(locked) != str(admin_id):
+        return dict(row, ok=False)
+    newp = patch_fn(dict(payload))
+    q = get_table(QUEUE_TABLE).update(dict(extra or {}, payload=newp)).eq("id", request_id)
+    q = q.filter("payload->>locked_by", "is", "null") if locked is None else q.filter("payload->>locked_by", "eq", str(locked))
+    res = q.execute()
+    if not getattr(res, "data", None):
+        fresh = _legacy_row(request_id)
+        return dict(fresh, ok=False) if fresh else None
+    return dict(row, payload=newp, ok=True, was_unlocked=locked is None, **(extra or {}))
+
+def claim_request(request_id: int, admin_id: int, admin_name: str = None):
+    """يحجز الطلب للأدمن (ok=False إن كان محجوزًا لغيره؛ payload يبيّن صاحب القفل)."""
+    row = None
+    if _queue_rpc_available:
+        try:
+            row = _queue_rpc("claim_pending_request", {
+                "p_request_id": request_id, "p_admin_id": int(admin_id), "p_admin_name": admin_name,
+            })
+        except Exception:
+            if _queue_rpc_available:
+                raise
+
+    def patch(p):
+        p.update(locked_by=int(admin_id), locked_by_username=admin_name, claimed=True)
+        return p
+    if not _queue_rpc_available:
+        row = _legacy_lock_update(request_id, admin_id, patch)
+    if row and row.get("ok") and row.get("was_unlocked"):
+        # فقط انتقال القفل من null لهذا الأدمن — لا النقر المزدوج من صاحبه
+        record_event("claimed", request_id, req=row, admin_id=admin_id)
+    return row
+
+def release_request(request_id: int, admin_id: int = None):
+    """يفك قفل الطلب (لصاحبه فقط، أو دون شرط مع admin_id=None)."""
+    if _queue_rpc_available:
+        try:
+            return _queue_rpc("release_pending_request", {"p_request_id": request_id, "p_admin_id": admin_id})
+        except Exception:
+            if _queue_rpc_available:
+                raise
+    return _legacy_lock_update(request_id, admin_id, lambda p: {k: v for k, v in p.items() if k not in _LOCK_KEYS})
+
 def _payload_get(request_id: int):
     try:
         r = get_table(QUEUE_TABLE).select("payload").eq("id", request_id).single().execute()
@@ -165,159 +292,173 @@ def _payload_get(request_id: int):
     except Exception:
         return {}
 
-def _payload_update(request_id: int, patch: dict):
+def _payload_update(request_id: int, patch: dict, delete=None):
+    # دمج patch وحذف مفاتيح delete من payload في رحلة واحدة (patch_pending_payload)
     try:
+        if _queue_rpc_available:
+            try:
+                _queue_rpc("patch_pending_payload", {
+                    "p_request_id": request_id, "p_set": patch or {}, "p_del": list(delete or []),
+                })
+                return
+            except Exception:
+                if _queue_rpc_available:
+                    raise
         old = _payload_get(request_id)
-        newp = dict(old)
+        newp = {k: v for k, v in old.items() if k not in (delete or ())}
         newp.update(patch or {})
         get_table(QUEUE_TABLE).update({"payload": newp}).eq("id", request_id).execute()
     except Exception:
         logging.exception("payload update failed for request %s", request_id)
 
-def postpone_request(request_id: int):
-    # إرجاع الطلب لآخر الدور بتحديث created_at + إزالة القفل + مسح كاش التكرار.
+def postpone_request(request_id: int, admin_id: int = None):
+    # إرجاع الطلب لآخر الدور (created_at = الآن) + إزالة القفل في استدعاء واحد + مسح كاش التكرار.
+    # admin_id: لا يُؤجَّل طلب محجوز لأدمن آخر (ok=False).
+    row = None
     try:
-        now = datetime.utcnow().isoformat()
-        get_table(QUEUE_TABLE).update({"created_at": now}).eq("id", request_id).execute()
-        _payload_update(request_id, {"locked_by": None, "locked_by_username": None})
+        if _queue_rpc_available:
+            try:
+                row = _queue_rpc("postpone_pending_request", {"p_request_id": request_id, "p_admin_id": admin_id})
+            except Exception:
+                if _queue_rpc_available:
+                    raise
+        if not _queue_rpc_available:
+            now = datetime.utcnow().isoformat()
+            row = _legacy_lock_update(request_id, admin_id,
+                                      lambda p: {k: v for k, v in p.items() if k not in _LOCK_KEYS},
+                                      extra={"created_at": now})
         reset_recent_silently(request_id)  # مهم: السماح بإعادة الإرسال بعد التأجيل
+        if row and row.get("ok"):
+            from services.queue_dispatcher import defer
+            defer(request_id)  # ...لكن ليس فورًا: مهلة QUEUE_POSTPONE_SECONDS
+            record_event("postponed", request_id, req=row, admin_id=admin_id)
     except Exception:
         logging.exception(f"Error postponing request {request_id}")
+    return row
 
 
-def _send_admin_with_photo(bot, photo_id: str, text: str, keyboard: InlineKeyboardMarkup):
-    # يرسل صورة/رسالة لكل الأدمن ويُعيد قائمة [(admin_id, message_id)] للرسائل ذات الأزرار.
-    sent = []
+# ===== إرسال متوازٍ للأدمن =====
+# كل أدمن مهمة مستقلة على منفّذ محدود (QUEUE_FANOUT_WORKERS)؛ زمن الإرسال = أبطأ أدمن
+# لا مجموع الكل. تيليغرام يسمح ~30 رسالة/ثانية للبوت ورسالة/ثانية لكل محادثة — كل
+# أدمن محادثة مختلفة، و429 يُحترم بانتظار retry_after ثم محاولة واحدة.
+QUEUE_FANOUT_WORKERS = int(os.getenv("QUEUE_FANOUT_WORKERS", "8"))
+_RETRY_AFTER_CAP = 30
+_fanout_pool = ThreadPoolExecutor(max_workers=max(1, QUEUE_FANOUT_WORKERS), thread_name_prefix="queue-fanout")
+
+def _tg(fn, *args, **kwargs):
     try:
-        if text and len(text) <= _MAX_CAPTION:
-            for admin_id in _admin_targets():
-                m = bot.send_photo(admin_id, photo_id, caption=text, parse_mode="HTML", reply_markup=keyboard)
-                try:
-                    sent.append((admin_id, m.message_id))
-                except Exception:
-                    pass
-        else:
-            for admin_id in _admin_targets():
-                bot.send_photo(admin_id, photo_id, caption="🖼️ تفاصيل الطلب في الرسالة التالية ⬇️", parse_mode="HTML")
-                m = bot.send_message(admin_id, text or "طلب جديد", parse_mode="HTML", reply_markup=keyboard)
-                try:
-                    sent.append((admin_id, m.message_id))
-                except Exception:
-                    pass
-    except Exception:
-        logging.exception("Failed sending admin photo/message; falling back to text-only")
-        for admin_id in _admin_targets():
-            m = bot.send_message(admin_id, text or "طلب جديد", parse_mode="HTML", reply_markup=keyboard)
-            try:
-                sent.append((admin_id, m.message_id))
-            except Exception:
-                pass
+        return fn(*args, **kwargs)
+    except ApiTelegramException as e:
+        if getattr(e, "error_code", None) != 429:
+            raise
+        wait = ((e.result_json or {}).get("parameters") or {}).get("retry_after") or 1
+        time.sleep(min(float(wait), _RETRY_AFTER_CAP))
+        return fn(*args, **kwargs)
+
+def _fanout(send_one):
+    """send_one(admin_id) -> Message لكل أدمن بالتوازي؛ يرجع [(admin_id, message_id)] بترتيب الأدمن.
+    يرفع أول خطأ فقط إن فشل الكل (ليعيد المُرسِل المحاولة)."""
+    targets = _admin_targets()
+    futures = [(aid, _fanout_pool.submit(send_one, aid)) for aid in targets]
+    sent, errors = [], []
+    for aid, fut in futures:
+        try:
+            m = fut.result()
+        except Exception as e:
+            logging.warning("[QUEUE] send to admin %s failed: %s", aid, e)
+            errors.append(e)
+            continue
+        mid = getattr(m, "message_id", None)
+        if mid:
+            sent.append((aid, mid))
+    if errors and not sent:
+        raise errors[0]
     return sent
 
-def process_queue(bot):
-    global _queue_cooldown
-    if _queue_cooldown:
-        return
-
-    with _queue_lock:
-        req = get_next_request()
-        if not req:
-            return
-
-        request_id = req.get("id")
-
-        # منع تكرار إرسال نفس الطلب ضمن نافذة قصيرة
+def _send_admin_with_photo(bot, photo_id: str, text: str, keyboard: InlineKeyboardMarkup):
+    # يرسل صورة/رسالة لكل الأدمن ويُعيد قائمة [(admin_id, message_id)] للرسائل ذات الأزرار.
+    def one(admin_id):
         try:
-            now_ts = int(time.time())
-            last   = _recently_sent.get(request_id)
-            if last and (now_ts - last) < _RECENT_TTL:
-                return
-            _recently_sent[request_id] = now_ts
+            if text and len(text) <= _MAX_CAPTION:
+                return _tg(bot.send_photo, admin_id, photo_id, caption=text, parse_mode="HTML", reply_markup=keyboard)
+            _tg(bot.send_photo, admin_id, photo_id, caption="🖼️ تفاصيل الطلب في الرسالة التالية ⬇️", parse_mode="HTML")
+            return _tg(bot.send_message, admin_id, text or "طلب جديد", parse_mode="HTML", reply_markup=keyboard)
         except Exception:
-            pass
-
-        text = req.get("request_text", "") or "طلب جديد"
-        keyboard = InlineKeyboardMarkup(row_width=2)
-        keyboard.add(
-            InlineKeyboardButton("📌 استلمت", callback_data=f"admin_queue_claim_{request_id}"),
-            InlineKeyboardButton("🔁 تأجيل",  callback_data=f"admin_queue_postpone_{request_id}"),
-            InlineKeyboardButton("✅ تأكيد",   callback_data=f"admin_queue_accept_{request_id}"),
-            InlineKeyboardButton("🚫 إلغاء",  callback_data=f"admin_queue_cancel_{request_id}"),
-            InlineKeyboardButton("✉️ رسالة للعميل", callback_data=f"admin_queue_message_{request_id}"),
-            InlineKeyboardButton("🖼️ صورة للعميل", callback_data=f"admin_queue_photo_{request_id}")
-        )
+            logging.exception("Failed sending admin photo/message to %s; falling back to text-only", admin_id)
+            return _tg(bot.send_message, admin_id, text or "طلب جديد", parse_mode="HTML", reply_markup=keyboard)
+    return _fanout(one)
+
+def _send_admin_text(bot, text: str, keyboard: InlineKeyboardMarkup, media=None):
+    # رسالة نصية بالأزرار لكل الأدمن (مسبوقة بألبوم الصور media إن وُجد).
+    def one(admin_id):
+        if media:
+            try:
+                _tg(bot.send_media_group, admin_id, media)
+            except Exception:
+                logging.exception("Failed to send media group to %s, fallback to message only", admin_id)
+        return _tg(bot.send_message, admin_id, text, parse_mode="HTML", reply_markup=keyboard)
+    return _fanout(one)
+
+def _queue_keyboard(request_id) -> InlineKeyboardMarkup:
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("📌 استلمت", callback_data=f"admin_queue_claim_{request_id}"),
+        InlineKeyboardButton("🔁 تأجيل",  callback_data=f"admin_queue_postpone_{request_id}"),
+        InlineKeyboardButton("✅ تأكيد",   callback_data=f"admin_queue_accept_{request_id}"),
+        InlineKeyboardButton("🚫 إلغاء",  callback_data=f"admin_queue_cancel_{request_id}"),
+        InlineKeyboardButton("✉️ رسالة للعميل", callback_data=f"admin_queue_message_{request_id}"),
+        InlineKeyboardButton("🖼️ صورة للعميل", callback_data=f"admin_queue_photo_{request_id}")
+    )
+    return keyboard
+
+def dispatch_request(bot, req: dict):
+    """يرسل طلبًا واحدًا لكل الأدمن ويحفظ admin_msgs (يُستدعى من services/queue_dispatcher)."""
+    request_id = req.get("id")
+    text = req.get("request_text", "") or "طلب جديد"
+    keyboard = _queue_keyboard(request_id)
+
+    payload  = req.get("payload") or {}
+    typ      = payload.get("type")
+    photo_id = payload.get("photo")
+
+    # [(admin_id, message_id)]
+    # =========== فرع شحن المحفظة ===========
+    if typ == "recharge" and photo_id:
+        sent_pairs = _send_admin_with_photo(bot, photo_id, text, keyboard)
+
+    # =========== فرع إعلانات القناة ===========
+    elif typ == "ads" and len(payload.get("images") or []) == 1:
+        sent_pairs = _send_admin_with_photo(bot, payload["images"][0], text, keyboard)
+    elif typ == "ads" and payload.get("images"):
+        media = [InputMediaPhoto(fid) for fid in payload["images"]]
+        sent_pairs = _send_admin_text(bot, text, keyboard, media=media)
+
+    # =========== الأنواع الأخرى ===========
+    else:
+        sent_pairs = _send_admin_text(bot, text, keyboard)
+
+    # حفظ admin_msgs فقط — تحديث واحد لكل الأدمن (patch_pending_payload).
+    # لا نلمس القفل: قد يكون أدمن استلم من أول رسالة وصلت بينما بقية الإرسال جارٍ،
+    # أو الطلب مستلَم أصلًا وأُعيد إرساله بعد إعادة التشغيل. التأجيل/الفك يفرّغانه.
+    entries = [{'admin_id': aid, 'message_id': mid} for (aid, mid) in sent_pairs if aid and mid]
+    _payload_update(request_id, {'admin_msgs': entries})
+    return sent_pairs
+
+def _wake_dispatcher(bot=None):
+    try:
+        from services.queue_dispatcher import wake
+        wake(bot)
+    except Exception:
+        logging.exception("[QUEUE] dispatcher wake failed")
 
-        payload  = req.get("payload") or {}
-        typ      = payload.get("type")
-        photo_id = payload.get("photo")
-
-        sent_pairs = []  # [(admin_id, message_id)]
-
-        # =========== فرع شحن المحفظة ===========
-        if typ == "recharge" and photo_id:
-            sent_pairs = _send_admin_with_photo(bot, photo_id, text, keyboard)
-
-        # =========== فرع إعلانات القناة ===========
-        elif typ == "ads":
-            images = payload.get("images", [])
-            if images:
-                if len(images) == 1:
-                    sent_pairs = _send_admin_with_photo(bot, images[0], text, keyboard)
-                else:
-                    try:
-                        media = [InputMediaPhoto(fid) for fid in images]
-                        for admin_id in _admin_targets():
-                            bot.send_media_group(admin_id, media)
-                    except Exception:
-                        logging.exception("Failed to send media group, fallback to message only")
-                    for admin_id in _admin_targets():
-                        m = bot.send_message(admin_id, text, parse_mode="HTML", reply_markup=keyboard)
-                        try:
-                            sent_pairs.append((admin_id, m.message_id))
-                        except Exception:
-                            pass
-            else:
-                for admin_id in _admin_targets():
-                    m = bot.send_message(admin_id, text, parse_mode="HTML", reply_markup=keyboard)
-                    try:
-                        sent_pairs.append((admin_id, m.message_id))
-                    except Exception:
-                        pass
-
-        # =========== الأنواع الأخرى ===========
-        else:
-            for admin_id in _admin_targets():
-                m = bot.send_message(admin_id, text, reply_markup=keyboard, parse_mode="HTML")
-                try:
-                    sent_pairs.append((admin_id, m.message_id))
-                except Exception:
-                    pass
-
-        # حفظ admin_msgs مع تفريغ القفل
-        try:
-            entries = [{'admin_id': aid, 'message_id': mid} for (aid, mid) in sent_pairs if aid and mid]
-            # لاحظ: نبقي payload الأخرى كما هي ونضيف/نحدث admin_msgs والقفل
-            old = _payload_get(request_id)
-            old['admin_msgs'] = entries
-            old['locked_by'] = None
-            old['locked_by_username'] = None
-            get_table(QUEUE_TABLE).update({"payload": old}).eq("id", request_id).execute()
-        except Exception:
-            logging.exception("Failed to persist admin message IDs for request %s", request_id)
+def process_queue(bot):
+    # واجهة متوافقة: الإرسال صار خدمة مستمرة (services/queue_dispatcher) — هذا يوقظها فقط.
+    _wake_dispatcher(bot)
 
 def queue_cooldown_start(bot=None):
-    # إطلاق فترة خمول قصيرة ثم إعادة تشغيل الطابور.
-    global _queue_cooldown
-    _queue_cooldown = True
-
-    def release():
-        global _queue_cooldown
-        time.sleep(30)           # نصف دقيقة
-        _queue_cooldown = False
-        if bot is not None:
-            process_queue(bot)
-
-    threading.Thread(target=release, daemon=True).start()
+    # واجهة متوافقة: بعد تأكيد/إلغاء/تأجيل طلب يتحرر مكان في الطلبات المعروضة فنوقظ المُرسِل.
+    # (كانت تُوقف الطابور 30 ثانية؛ الفاصل الآن QUEUE_DISPATCH_GAP في queue_dispatcher)
+    _wake_dispatcher(bot)
 
 
 def reset_recent_silently(request_id: int):
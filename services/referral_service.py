@@ -282,6 +282,8 @@ def revalidate_user_discount(bot, user_id: int) -> bool:
             if not ok:
                 try:
                     get_table(DISCOUNTS_TBL).update({"active": False}).eq("id", did).execute()
+                    from services.discount_service import invalidate_active_cache
+                    invalidate_active_cache()
                 except Exception:
                     pass
     return ok
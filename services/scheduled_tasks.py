@@ -99,6 +99,7 @@ def _pick_due_ad(now_utc: datetime, ads: List[Dict[str, Any]]) -> Optional[Dict[
 # ----- تنظيف خصومات الإحالة المنتهية -----
 
 from database.db import get_table
+from services.discount_service import invalidate_active_cache
 
 def expire_old_discounts():
     """تعطيل الخصومات التي انتهى وقتها (active=True && ends_at <= now)."""
@@ -113,6 +114,8 @@ def expire_old_discounts():
         )
     except Exception as e:
         print(f"[ads_task] expire_old_discounts error: {e}")
+    finally:
+        invalidate_active_cache()  # لا تبقى خصومات منتهية في كاش الشراء حتى DISCOUNT_CACHE_TTL
 
 
 def purge_old_discounts(days: int = 2):
@@ -128,6 +131,8 @@ def purge_old_discounts(days: int = 2):
         )
     except Exception as e:
         print(f"[ads_task] purge_old_discounts error: {e}")
+    finally:
+        invalidate_active_cache()
 
 
 def post_ads_task(bot=None, every_seconds: int = 60):
@@ -194,7 +199,11 @@ def post_ads_task(bot=None, every_seconds: int = 60):
         purge_old_discounts(2)
 
         # إعادة الجدولة
-        threading.Timer(every_seconds, _tick).start()
+        t = threading.Timer(every_seconds, _tick)
+        t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+        t.start()
 
     # أول تشغيل بعد 10 ثواني لإتاحة تهيئة البوت
-    threading.Timer(10, _tick).start()
+    t = threading.Timer(10, _tick)
+    t.daemon = True  # لا يمنع خروج العملية (SIGTERM/atexit)
+    t.start()
@@ -0,0 +1,120 @@
+# services/startup.py
+# -*- coding: utf-8 -*-
+"""
+قياس مسار الإقلاع حتى أول getUpdates + تأجيل أعمال الإقلاع غير الضرورية.
+
+- mark(label): يسجّل زمن المرحلة منذ العلامة السابقة ومنذ بدء العملية.
+- timed_import(name): استيراد وحدة مع تسجيل زمنه (تقرير زمن الاستيراد لكل handler).
+- defer(label, fn): أعمال لا يحتاجها أول تحديث (زرع مفاتيح المزايا، أوامر البوت...)
+  تُنفَّذ في خيط خلفي بعد أول getUpdates بدل أن تؤخر بدء الاستقبال.
+- watch_first_poll(bot): يلتقط أول getUpdates، يطبع التقرير، ثم يشغّل المؤجَّل.
+
+لتفصيل أعمق للاستيراد: python -X importtime main.py 2> importtime.log
+"""
+
+from __future__ import annotations
+
+import importlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, List, Tuple
+
+_T0 = time.perf_counter()
+_last = _T0
+_marks: List[Tuple[str, float, float]] = []
+_deferred: List[Tuple[str, Callable[[], Any]]] = []
+_lock = threading.Lock()
+_started = False
+
+
+def _process_uptime() -> float:
+    """عمر العملية فعليًا (يشمل إقلاع المفسّر قبل استيراد هذه الوحدة) — لينكس فقط."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except Exception:
+        return time.perf_counter() - _T0
+
+
+_PRE_T0 = max(0.0, _process_uptime() - (time.perf_counter() - _T0))
+
+
+def mark(label: str) -> float:
+    """يسجّل نهاية مرحلة؛ يرجع مدتها بالثواني."""
+    global _last
+    now = time.perf_counter()
+    with _lock:
+        took = now - _last
+        _marks.append((label, took, now - _T0))
+        _last = now
+    return took
+
+
+def timed_import(name: str):
+    """يستورد الوحدة ويسجّل زمن استيرادها كسطر مستقل في التقرير (لا يحرّك علامة المرحلة)."""
+    t0 = time.perf_counter()
+    mod = importlib.import_module(name)
+    with _lock:
+        _marks.append((f"import {name}", time.perf_counter() - t0, time.perf_counter() - _T0))
+    return mod
+
+
+def defer(label: str, fn: Callable[[], Any]) -> None:
+    """يؤجّل fn إلى ما بعد أول getUpdates (أو ينفّذها فورًا في الخلفية إن بدأ الاستقبال)."""
+    with _lock:
+        if not _started:
+            _deferred.append((label, fn))
+            return
+    threading.Thread(target=_run_one, args=(label, fn), name="startup-deferred", daemon=True).start()
+
+
+def _run_one(label: str, fn: Callable[[], Any]) -> None:
+    t0 = time.perf_counter()
+    try:
+        fn()
+    except Exception as e:
+        logging.warning("[startup] deferred %s failed: %s", label, e)
+    logging.info("[startup] deferred %s: %.0fms", label, (time.perf_counter() - t0) * 1000)
+
+
+def run_deferred() -> None:
+    global _started
+    with _lock:
+        _started = True
+        jobs = list(_deferred)
+        _deferred.clear()
+
+    def _loop():
+        for label, fn in jobs:
+            _run_one(label, fn)
+
+    if jobs:
+        threading.Thread(target=_loop, name="startup-deferred", daemon=True).start()
+
+
+def report() -> str:
+    with _lock:
+        marks = list(_marks)
+    lines = [f"⏱️ الإقلاع: المفسّر قبل main {_PRE_T0 * 1000:.0f}ms"]
+    for label, took, at in marks:
+        lines.append(f"{at * 1000:8.0f}ms  +{took * 1000:6.0f}ms  {label}")
+    return "\n".join(lines)
+
+
+def watch_first_poll(bot) -> None:
+    """يلفّ bot.get_updates مرة واحدة: أول استدعاء = نهاية الإقلاع."""
+    original = bot.get_updates
+
+    def _first(*args, **kwargs):
+        bot.get_updates = original
+        mark("first getUpdates")
+        logging.info("[startup]\n%s", report())
+        run_deferred()
+        return original(*args, **kwargs)
+
+    bot.get_updates = _first
@@ -1,38 +1,42 @@
 # services/state_adapter.py
-from collections.abc import MutableMapping
-from .state_service import get_data, set_data, set_kv, get_kv, clear_state
+from collections.abc import Mapping, MutableMapping
+from telebot.handler_backends import BaseMiddleware
+from .state_service import (
+    get_data, set_data, set_kv, get_kv, clear_state, purge_state, begin_session, end_session,
+    DEFAULT_STATE_KEY,
+)
 
 class _DictProxy(MutableMapping):
-    def __init__(self, user_id: int, ttl_minutes: int = 120):
+    def __init__(self, user_id: int, ttl_minutes: int = 120, state_key: str = DEFAULT_STATE_KEY):
         self.user_id = user_id
         self.ttl = ttl_minutes
+        self.state_key = state_key
 
     def __getitem__(self, key):
-        data = get_data(self.user_id)
+        data = get_data(self.user_id, state_key=self.state_key)
         if key in data:
             return data[key]
         raise KeyError(key)
 
     def __setitem__(self, key, value):
-        set_kv(self.user_id, key, value, ttl_minutes=self.ttl)
+        set_kv(self.user_id, key, value, state_key=self.state_key, ttl_minutes=self.ttl)
 
     def __delitem__(self, key):
-        data = get_data(self.user_id)
+        data = get_data(self.user_id, state_key=self.state_key)
         if key in data:
-            data.pop(key, None)
-            set_data(self.user_id, data, ttl_minutes=self.ttl)
+            clear_state(self.user_id, key, state_key=self.state_key)
         else:
             raise KeyError(key)
 
     def __iter__(self):
-        return iter(get_data(self.user_id))
+        return iter(get_data(self.user_id, state_key=self.state_key))
 
     def __len__(self):
-        return len(get_data(self.user_id))
+        return len(get_data(self.user_id, state_key=self.state_key))
 
     def get(self, key, default=None):
         # السطر المقطوع المشار إليه هو ببساطة الاستدعاء التالي لاسترجاع القيمة أو الافتراضي:
-        return get_kv(self.user_id, key, default)
+        return get_kv(self.user_id, key, default, state_key=self.state_key)
 
     def setdefault(self, key, default=None):
         current = self.get(key, None)
@@ -42,30 +46,80 @@ class _DictProxy(MutableMapping):
         return current
 
 class UserStateDictLike:
-    """واجهة مشابهة للقاموس: user_states[user_id]['step'] = '...' يكتب فوراً في القاعدة."""
+    """
+    واجهة مشابهة للقاموس: user_states[user_id]['step'] = '...' يكتب فوراً في مخزن الحالة
+    (services/state_backend: supabase/sqlite/memory حسب STATE_BACKEND).
+    state_key يفصل مساحات الأسماء: حالات الهاندلرات المحلية (طلبات المنتجات، الإعلانات، بث الأدمن)
+    لكلٍّ منها صف مستقل فلا تتداخل مع الحالة العامة.
+    القيم يجب أن تكون قابلة لـ JSON، وتعديل قائمة/قاموس متداخل يتطلب إعادة إسناده.
+    """
+    def __init__(self, state_key: str = DEFAULT_STATE_KEY, ttl_minutes: int = 120, live: bool = False):
+        self.state_key = state_key
+        self.ttl = ttl_minutes
+        # live=True: get() يرجع proxy حيًا بدل نسخة (بديل مباشر لقاموس عادي {user_id: dict}
+        # تُعدَّل قيمه في مكانها، مثل user_orders[uid]["player_id"] = ...)
+        self.live = live
+
     def __getitem__(self, user_id: int) -> _DictProxy:
-        return _DictProxy(user_id)
+        return _DictProxy(user_id, self.ttl, self.state_key)
 
     def __setitem__(self, user_id: int, value):
         # مرونة آمنة: لو حد حط سترينغ اعتبره خطوة state
         if isinstance(value, str):
             value = {"step": value}
-        elif not isinstance(value, dict):
+        elif not isinstance(value, Mapping):
             # نحافظ على الحزم مع الأنواع الأخرى (علشان ما نخزن هياكل غير متوقعة)
             raise TypeError("user_states[user_id] يجب أن يكون dict أو str (يُحفظ كـ step)")
 
         # TTL زي ما هو (120 دقيقة)
-        set_data(user_id, value, ttl_minutes=120)
+        set_data(user_id, dict(value), state_key=self.state_key, ttl_minutes=self.ttl)
+
+    def __contains__(self, user_id: int) -> bool:
+        return bool(get_data(user_id, state_key=self.state_key))
 
     def get(self, user_id: int, default=None):
-        data = get_data(user_id)
-        return data if data else (default if default is not None else {})
+        data = get_data(user_id, state_key=self.state_key)
+        if data:
+            return _DictProxy(user_id, self.ttl, self.state_key) if self.live else data
+        return default if default is not None else {}
+
+    def setdefault(self, user_id: int, default=None):
+        if user_id not in self:
+            self[user_id] = default or {}
+        return _DictProxy(user_id, self.ttl, self.state_key)
 
     def pop(self, user_id: int, default=None):
         try:
-            v = get_data(user_id)
-            clear_state(user_id)
-            set_data(user_id, {}, ttl_minutes=0)
-            return v
+            v = get_data(user_id, state_key=self.state_key)
+            if self.state_key == DEFAULT_STATE_KEY:
+                clear_state(user_id)
+                set_data(user_id, {}, ttl_minutes=0)
+            else:
+                purge_state(user_id, state_key=self.state_key)
+            return v if v else default
         except Exception:
             return default
+
+
+class StateSessionMiddleware(BaseMiddleware):
+    """
+    جلسة حالة لكل تحديث: قراءة واحدة لصف user_state عند أول وصول وكتابة واحدة
+    على الأكثر بعد انتهاء الهاندلر (services/state_service.begin_session/end_session).
+    يتطلب TeleBot(use_class_middlewares=True).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_sensitive = False
+        self.update_types = [
+            "message", "edited_message", "callback_query", "inline_query",
+            "chosen_inline_result", "pre_checkout_query", "shipping_query",
+            "my_chat_member", "chat_member", "chat_join_request",
+        ]
+
+    def pre_process(self, message, data):
+        begin_session()
+
+    def post_process(self, message, data, exception):
+        # نكتب حتى عند الاستثناء: السلوك القديم كان يكتب كل تعديل فورًا
+        end_session()
@@ -0,0 +1,433 @@
+# services/state_backend.py
+# -*- coding: utf-8 -*-
+"""
+مخزن حالة المحادثة القابل للتبديل (STATE_BACKEND):
+
+- supabase (الافتراضي): جدول user_state عبر PostgREST + دوال 0007/0008 (مع رجوع
+  لقراءة-تعديل-كتابة إن لم تُنشر الدوال). مناسب لعدة نسخ من البوت.
+- sqlite: ملف محلي STATE_DB_PATH بوضع WAL — أجزاء من الملّي ثانية ويبقى بعد restart_bot.
+  لنسخة واحدة فقط من البوت.
+- memory: قاموس داخل العملية (تجارب/اختبارات) — يضيع عند إعادة التشغيل.
+
+كل المخازن تتعامل مع (user_id, state_key) -> vars (dict قابل لـ JSON) + expires_at (ISO UTC).
+services/state_service يستخدم المخزن النشط (get_state_backend) وفوقه الجلسة والكاش.
+"""
+
+from __future__ import annotations
+
+import base64
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from database.db import get_table, client, with_retry as _with_retry
+
+TABLE = "user_state"
+
+STATE_BACKEND = (os.getenv("STATE_BACKEND", "supabase") or "supabase").lower()
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.db")
+STATE_RPC_ENABLED = os.getenv("STATE_RPC_ENABLED", "1") == "1"
+# القيم التي يتجاوز JSON الخاص بها هذا الحد تُخزَّن مضغوطة (0 = تعطيل)
+STATE_COMPACT_MIN_BYTES = int(os.getenv("STATE_COMPACT_MIN_BYTES", "1024"))
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _apply(vars_dict: Dict[str, Any], set_: Optional[Dict[str, Any]], delete, keep) -> Dict[str, Any]:
+    """keep (الإبقاء على هذه المفاتيح فقط) ثم delete ثم دمج set_ — نفس ترتيب state_set_keys."""
+    if keep is not None:
+        vars_dict = {k: v for k, v in vars_dict.items() if k in keep}
+    for k in (delete or ()):
+        vars_dict.pop(k, None)
+    vars_dict.update(set_ or {})
+    return vars_dict
+
+
+def _dumps(vars_dict: Dict[str, Any]) -> str:
+    return json.dumps(vars_dict, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+# ===================== ترميز مضغوط للقيم الكبيرة =====================
+# قيمة كبيرة داخل vars (نص إعلان + file_ids، طلب منتج...) تُخزَّن كـ {"__z": base64(zlib(json))}
+# فتبقى vars JSONB صالحًا ويبقى دمج المفاتيح على الخادم (state_set_keys) كما هو.
+# لا تُضغط إلا إن كان الناتج أصغر فعلًا (file_ids العشوائية لا تنضغط غالبًا).
+_Z = "__z"
+
+
+def _pack_value(v: Any) -> Any:
+    raw = json.dumps(v, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+    if len(raw) < STATE_COMPACT_MIN_BYTES:
+        return v
+    packed = base64.b64encode(zlib.compress(raw, 6)).decode("ascii")
+    return {_Z: packed} if len(packed) + 10 < len(raw) else v
+
+
+def _unpack_value(v: Any) -> Any:
+    if isinstance(v, dict) and len(v) == 1 and isinstance(v.get(_Z), str):
+        try:
+            return json.loads(zlib.decompress(base64.b64decode(v[_Z])).decode("utf-8"))
+        except Exception:
+            logging.warning("state_backend: قيمة مضغوطة تالفة — تُرجَع كما هي")
+    return v
+
+
+def encode_vars(vars_dict: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if not vars_dict or STATE_COMPACT_MIN_BYTES <= 0:
+        return vars_dict
+    return {k: _pack_value(v) for k, v in vars_dict.items()}
+
+
+def decode_vars(vars_dict: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if not vars_dict:
+        return vars_dict
+    return {k: _unpack_value(v) for k, v in vars_dict.items()}
+
+
+class StateBackend:
+    """الواجهة: كل الدوال ذرّية على مستوى (user_id, state_key)."""
+
+    name = "base"
+    # هل يفيد كاش services/state_cache فوقه؟ (لا معنى له فوق قاموس داخل العملية)
+    cacheable = True
+
+    def load(self, user_id: int, state_key: str) -> Optional[Dict[str, Any]]:
+        """vars أو None إن لم يوجد صف."""
+        raise NotImplementedError
+
+    def save(self, user_id: int, state_key: str, vars_dict: Dict[str, Any], expires_at: Optional[str]) -> None:
+        """استبدال vars كاملة (expires_at=None يُبقي القيمة السابقة)."""
+        raise NotImplementedError
+
+    def delete(self, user_id: int, state_key: str) -> None:
+        raise NotImplementedError
+
+    def patch(self, user_id: int, state_key: str, set_: Optional[Dict[str, Any]] = None, delete=None,
+              keep=None, expires_at: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """keep/delete/set_ ذرّيًا؛ يحذف الصف إن أصبحت vars فارغة. يرجع vars الناتجة (None = غير معروفة)."""
+        raise NotImplementedError
+
+    def touch(self, user_id: int, state_key: str, expires_at: str) -> None:
+        """تمديد expires_at (و __state_exp إن وُجد) دون تعديل باقي المتغيرات."""
+        raise NotImplementedError
+
+    def purge_expired(self, limit: int) -> List[Dict[str, Any]]:
+        """يحذف حتى limit صفًا انتهت صلاحيتها؛ يرجع [{user_id, state_key}, ...]."""
+        raise NotImplementedError
+
+
+# ===================== memory =====================
+
+class MemoryStateBackend(StateBackend):
+    name = "memory"
+    cacheable = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows: Dict[Tuple[int, str], Tuple[Dict[str, Any], Optional[str]]] = {}
+
+    def load(self, user_id, state_key):
+        with self._lock:
+            item = self._rows.get((int(user_id), state_key))
+            return copy.deepcopy(item[0]) if item else None
+
+    def save(self, user_id, state_key, vars_dict, expires_at):
+        k = (int(user_id), state_key)
+        with self._lock:
+            old = self._rows.get(k)
+            self._rows[k] = (copy.deepcopy(vars_dict), expires_at or (old[1] if old else None))
+
+    def delete(self, user_id, state_key):
+        with self._lock:
+            self._rows.pop((int(user_id), state_key), None)
+
+    def patch(self, user_id, state_key, set_=None, delete=None, keep=None, expires_at=None):
+        k = (int(user_id), state_key)
+        with self._lock:
+            old = self._rows.get(k)
+            vars_dict = _apply(copy.deepcopy(old[0]) if old else {}, copy.deepcopy(set_), delete, keep)
+            if vars_dict:
+                self._rows[k] = (vars_dict, expires_at or (old[1] if old else None))
+            else:
+                self._rows.pop(k, None)
+            return copy.deepcopy(vars_dict)
+
+    def touch(self, user_id, state_key, expires_at):
+        k = (int(user_id), state_key)
+        with self._lock:
+            old = self._rows.get(k)
+            if old:
+                if "__state_exp" in old[0]:
+                    old[0]["__state_exp"] = expires_at
+                self._rows[k] = (old[0], expires_at)
+
+    def purge_expired(self, limit):
+        now = _now_iso()
+        with self._lock:
+            doomed = sorted(
+                ((exp, k) for k, (_, exp) in self._rows.items() if exp and exp < now)
+            )[:max(int(limit), 1)]
+            for _, k in doomed:
+                del self._rows[k]
+        return [{"user_id": k[0], "state_key": k[1]} for _, k in doomed]
+
+
+# ===================== sqlite (WAL) =====================
+
+class SQLiteStateBackend(StateBackend):
+    """
+    ملف SQLite بوضع WAL: قرّاء متوازيون مع كاتب واحد، synchronous=NORMAL (لا fsync لكل commit).
+    اتصال لكل خيط؛ التعديلات داخل BEGIN IMMEDIATE فتبقى ذرّية بين الخيوط.
+    expires_at نص ISO UTC بنفس الصيغة دائمًا فيصح ترتيبه ومقارنته نصيًا.
+    """
+
+    name = "sqlite"
+    cacheable = True
+
+    def __init__(self, path: str = STATE_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_state ("
+                " user_id INTEGER NOT NULL, state_key TEXT NOT NULL, vars TEXT NOT NULL,"
+                " expires_at TEXT, updated_at TEXT, PRIMARY KEY (user_id, state_key))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_user_state_expires_at ON user_state(expires_at)"
+                " WHERE expires_at IS NOT NULL"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    def _tx(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def _read(self, conn, user_id, state_key) -> Optional[Tuple[Dict[str, Any], Optional[str]]]:
+        row = conn.execute(
+            "SELECT vars, expires_at FROM user_state WHERE user_id=? AND state_key=?",
+            (int(user_id), state_key),
+        ).fetchone()
+        return (decode_vars(json.loads(row[0])), row[1]) if row else None
+
+    def _write(self, conn, user_id, state_key, vars_dict, expires_at) -> None:
+        conn.execute(
+            "INSERT INTO user_state (user_id, state_key, vars, expires_at, updated_at) VALUES (?,?,?,?,?)"
+            " ON CONFLICT(user_id, state_key) DO UPDATE SET vars=excluded.vars,"
+            " expires_at=coalesce(excluded.expires_at, user_state.expires_at), updated_at=excluded.updated_at",
+            (int(user_id), state_key, _dumps(encode_vars(vars_dict)), expires_at, _now_iso()),
+        )
+
+    def _commit(self, conn, fn):
+        try:
+            out = fn()
+            conn.execute("COMMIT")
+            return out
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def load(self, user_id, state_key):
+        item = self._read(self._conn(), user_id, state_key)
+        return item[0] if item else None
+
+    def save(self, user_id, state_key, vars_dict, expires_at):
+        conn = self._conn()
+        self._write(conn, user_id, state_key, vars_dict, expires_at)
+
+    def delete(self, user_id, state_key):
+        self._conn().execute(
+            "DELETE FROM user_state WHERE user_id=? AND state_key=?", (int(user_id), state_key)
+        )
+
+    def patch(self, user_id, state_key, set_=None, delete=None, keep=None, expires_at=None):
+        conn = self._tx()
+
+        def _do():
+            item = self._read(conn, user_id, state_key)
+            vars_dict = _apply(item[0] if item else {}, set_, delete, keep)
+            if vars_dict:
+                self._write(conn, user_id, state_key, vars_dict, expires_at)
+            elif item is not None:
+                conn.execute("DELETE FROM user_state WHERE user_id=? AND state_key=?", (int(user_id), state_key))
+            return vars_dict
+
+        return self._commit(conn, _do)
+
+    def touch(self, user_id, state_key, expires_at):
+        conn = self._tx()
+
+        def _do():
+            item = self._read(conn, user_id, state_key)
+            if item is None:
+                return
+            vars_dict = item[0]
+            if "__state_exp" in vars_dict:
+                vars_dict["__state_exp"] = expires_at
+            self._write(conn, user_id, state_key, vars_dict, expires_at)
+
+        self._commit(conn, _do)
+
+    def purge_expired(self, limit):
+        conn = self._tx()
+
+        def _do():
+            rows = conn.execute(
+                "SELECT rowid, user_id, state_key FROM user_state"
+                " WHERE expires_at IS NOT NULL AND expires_at < ? ORDER BY expires_at LIMIT ?",
+                (_now_iso(), max(int(limit), 1)),
+            ).fetchall()
+            conn.executemany("DELETE FROM user_state WHERE rowid=?", [(r[0],) for r in rows])
+            return [{"user_id": r[1], "state_key": r[2]} for r in rows]
+
+        return self._commit(conn, _do)
+
+
+# ===================== supabase =====================
+
+class SupabaseStateBackend(StateBackend):
+    """
+    جدول user_state في Supabase. التعديلات عبر state_set_keys/state_del_keys/state_touch
+    (0007_state_rpcs.sql) والكنس عبر purge_expired_state (0008)؛ إن لم تُنشر الدوال
+    (PGRST202/42883) نرجع للطريقة القديمة: قراءة-تعديل-upsert و select+delete محدود.
+    """
+
+    name = "supabase"
+    cacheable = True
+
+    def __init__(self):
+        self.rpc_available = STATE_RPC_ENABLED
+        self.sweep_rpc_available = True
+
+    def _rpc(self, fn: str, params: Dict[str, Any]):
+        try:
+            return client().rpc(fn, params).execute().data
+        except Exception as e:
+            if str(getattr(e, "code", "") or "") in ("PGRST202", "42883"):
+                self.rpc_available = False
+                logging.warning("state_backend: %s غير منشورة (0007_state_rpcs.sql) — رجوع للطريقة القديمة", fn)
+            raise
+
+    def load(self, user_id, state_key):
+        resp = _with_retry(
+            get_table(TABLE).select("vars").eq("user_id", user_id).eq("state_key", state_key).limit(1).execute
+        )
+        data = getattr(resp, "data", None) or []
+        return decode_vars(dict(data[0].get("vars") or {})) if data else None
+
+    def save(self, user_id, state_key, vars_dict, expires_at):
+        payload = {"user_id": user_id, "state_key": state_key, "vars": encode_vars(vars_dict)}
+        if expires_at is not None:
+            payload["expires_at"] = expires_at
+        # on_conflict requires UNIQUE(user_id,state_key)
+        _with_retry(get_table(TABLE).upsert(payload, on_conflict="user_id,state_key").execute)
+
+    def delete(self, user_id, state_key):
+        _with_retry(get_table(TABLE).delete().eq("user_id", user_id).eq("state_key", state_key).execute)
+
+    def patch(self, user_id, state_key, set_=None, delete=None, keep=None, expires_at=None):
+        if self.rpc_available:
+            try:
+                if not set_ and keep is None and expires_at is None and delete:
+                    data = self._rpc("state_del_keys", {
+                        "p_user_id": user_id, "p_state_key": state_key, "p_keys": list(delete),
+                    })
+                else:
+                    data = self._rpc("state_set_keys", {
+                        "p_user_id": user_id,
+                        "p_state_key": state_key,
+                        "p_vars": encode_vars(set_) or {},
+                        "p_expires_at": expires_at,
+                        "p_del": list(delete) if delete else None,
+                        "p_keep": list(keep) if keep is not None else None,
+                    })
+                return decode_vars(data) if isinstance(data, dict) else None
+            except Exception:
+                if self.rpc_available:
+                    raise
+        vars_dict = _apply(self.load(user_id, state_key) or {}, set_, delete, keep)
+        if vars_dict:
+            self.save(user_id, state_key, vars_dict, expires_at or vars_dict.get("__state_exp"))
+        else:
+            self.delete(user_id, state_key)
+        return vars_dict
+
+    def touch(self, user_id, state_key, expires_at):
+        if self.rpc_available:
+            try:
+                self._rpc("state_touch", {"p_user_id": user_id, "p_state_key": state_key, "p_expires_at": expires_at})
+                return
+            except Exception:
+                if self.rpc_available:
+                    raise
+        vars_dict = self.load(user_id, state_key)
+        if vars_dict:
+            if "__state_exp" in vars_dict:
+                vars_dict["__state_exp"] = expires_at
+            self.save(user_id, state_key, vars_dict, expires_at)
+
+    def purge_expired(self, limit):
+        if self.sweep_rpc_available:
+            try:
+                return _with_retry(client().rpc("purge_expired_state", {"p_limit": limit}).execute).data or []
+            except Exception as e:
+                if str(getattr(e, "code", "") or "") not in ("PGRST202", "42883"):
+                    raise
+                self.sweep_rpc_available = False
+                logging.warning("state_backend: purge_expired_state غير منشورة (0008_user_state_expiry.sql) — select+delete")
+        now_iso = _now_iso()
+        resp = _with_retry(
+            get_table(TABLE).select("user_id,state_key")
+            .lt("expires_at", now_iso).order("expires_at").limit(limit).execute
+        )
+        rows = getattr(resp, "data", None) or []
+        if rows:
+            uids = sorted({int(r["user_id"]) for r in rows})
+            # الشرط على expires_at يبقى: صف جُدّد بعد الـ select لا يُحذف
+            resp = _with_retry(
+                get_table(TABLE).delete().in_("user_id", uids).lt("expires_at", now_iso).execute
+            )
+            rows = getattr(resp, "data", None) or rows
+        return rows
+
+
+_BACKENDS = {
+    "memory": MemoryStateBackend,
+    "sqlite": SQLiteStateBackend,
+    "supabase": SupabaseStateBackend,
+}
+_backend: Optional[StateBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend() -> StateBackend:
+    """المخزن النشط حسب STATE_BACKEND (يُنشأ مرة واحدة)."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                cls = _BACKENDS.get(STATE_BACKEND)
+                if cls is None:
+                    logging.warning("STATE_BACKEND=%s غير معروف — استخدام supabase", STATE_BACKEND)
+                    cls = SupabaseStateBackend
+                _backend = cls()
+                logging.info("[state] backend: %s", _backend.name)
+    return _backend
+
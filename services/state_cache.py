@@ -0,0 +1,142 @@
+# services/state_cache.py
+# -*- coding: utf-8 -*-
+"""
+كاش LRU محدود لصفوف user_state داخل العملية: (user_id, state_key) -> vars.
+
+- حدّان: عدد المدخلات STATE_CACHE_SIZE وحجمها الكلي STATE_CACHE_MAX_BYTES؛ الأقدم استخدامًا يُطرد.
+- عمر أقصى STATE_CACHE_TTL ثانية للتغييرات التي لا تمر بنا (التنظيف المجدول، لوحة Supabase...).
+- القيم تُخزَّن JSON مضغوط (separators) فتُحسب ذاكرتها بدقة، ولا يستطيع المنادي تعديل
+  المخزَّن عبر مراجع متداخلة.
+- الصف غير الموجود يُخزَّن كـ {} (أغلب المستخدمين بلا حالة → لا SELECT متكرر).
+- write-through: كل كتابة في state_service تضع vars الناتجة مباشرة؛ القراءة التي بدأت قبل
+  كتابة لا تُخزَّن نتيجتها (جيل لكل مفتاح كما في database/user_cache.py).
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+Key = Tuple[int, str]
+
+# تكلفة تقريبية للمدخل نفسه (مفتاح tuple + OrderedDict node + str header)
+_ENTRY_OVERHEAD = 160
+
+
+def _encode(vars_dict: Dict[str, Any]) -> str:
+    return json.dumps(vars_dict, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class StateCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 30.0, max_bytes: int = 32 * 1024 * 1024):
+        self.max_size = max(1, int(max_size))
+        self.ttl = float(ttl)
+        self.max_bytes = max(1024, int(max_bytes))
+        self._lock = threading.Lock()
+        self._rows: "OrderedDict[Key, Tuple[float, str, int]]" = OrderedDict()
+        self._gen: Dict[Key, int] = {}
+        self._epoch = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.writes = 0
+
+    @staticmethod
+    def _key(user_id, state_key) -> Optional[Key]:
+        try:
+            return int(user_id), state_key or "global"
+        except (TypeError, ValueError):
+            return None
+
+    def _pop(self, k: Key) -> None:
+        item = self._rows.pop(k, None)
+        if item is not None:
+            self.bytes -= item[2]
+
+    def _store(self, k: Key, vars_dict: Dict[str, Any]) -> None:
+        raw = _encode(vars_dict)
+        size = len(raw.encode("utf-8")) + _ENTRY_OVERHEAD
+        self._pop(k)
+        self._rows[k] = (time.monotonic(), raw, size)
+        self.bytes += size
+        while self._rows and (len(self._rows) > self.max_size or self.bytes > self.max_bytes):
+            _, (_, _, old) = self._rows.popitem(last=False)
+            self.bytes -= old
+            self.evictions += 1
+
+    def generation(self, user_id, state_key) -> Tuple[int, int]:
+        k = self._key(user_id, state_key)
+        with self._lock:
+            return self._epoch, self._gen.get(k, 0)
+
+    def get(self, user_id, state_key) -> Optional[Dict[str, Any]]:
+        """نسخة مستقلة من vars ({} = لا صف) أو None عند عدم وجودها/انتهاء عمرها."""
+        k = self._key(user_id, state_key)
+        with self._lock:
+            item = self._rows.get(k)
+            if item is not None and time.monotonic() - item[0] > self.ttl:
+                self._pop(k)
+                self.expired += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(k)
+            self.hits += 1
+            raw = item[1]
+        return json.loads(raw)
+
+    def put(self, user_id, state_key, vars_dict: Dict[str, Any], gen: Tuple[int, int]) -> None:
+        """نتيجة قراءة بدأت عند الجيل gen — تُخزَّن فقط إن لم تحدث كتابة بعدها."""
+        k = self._key(user_id, state_key)
+        if k is None:
+            return
+        with self._lock:
+            if (self._epoch, self._gen.get(k, 0)) == gen:
+                self._store(k, vars_dict or {})
+
+    def write(self, user_id, state_key, vars_dict: Optional[Dict[str, Any]]) -> None:
+        """write-through بعد كتابة ناجحة؛ vars_dict=None تعني أن الناتج غير معروف (إبطال)."""
+        k = self._key(user_id, state_key)
+        if k is None:
+            return
+        with self._lock:
+            self._bump(k)
+            self.writes += 1
+            if vars_dict is None:
+                self._pop(k)
+            else:
+                self._store(k, vars_dict)
+
+    def drop(self, user_id, state_key) -> None:
+        self.write(user_id, state_key, None)
+
+    def _bump(self, k: Key) -> None:
+        self._gen[k] = self._gen.get(k, 0) + 1
+        if len(self._gen) > self.max_size * 4:
+            # أجيال مفاتيح خارج الكاش لا تلزم؛ رفع epoch يُبطل القراءات الجارية
+            self._gen = {u: g for u, g in self._gen.items() if u in self._rows}
+            self._epoch += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rows.clear()
+            self._gen.clear()
+            self.bytes = 0
+            self._epoch += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._rows), "max_size": self.max_size,
+                "bytes": self.bytes, "max_bytes": self.max_bytes, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "expired": self.expired, "evictions": self.evictions, "writes": self.writes,
+            }
@@ -13,9 +13,13 @@
 from __future__ import annotations
 
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, Any, Tuple
-from database.db import get_table
+from typing import Optional, Dict, Any, List, Tuple
+import json
 import logging, time  # ← إضافة
+import os
+import threading
+from services.state_backend import get_state_backend, _apply
+from services.state_cache import StateCache
 
 TABLE = "user_state"
 DEFAULT_STATE_KEY = "global"
@@ -44,54 +48,200 @@ def _expires_from_ttl(ttl_minutes: Optional[int]) -> Optional[datetime]:
         return None
     return _utcnow() + timedelta(minutes=ttl_minutes)
 
-# ===================== Low-level DB =====================
+# ===================== Low-level (services/state_backend.py) =====================
+
+# المخزن حسب STATE_BACKEND (supabase/sqlite/memory)؛ إعادة المحاولة/قاطع الدائرة داخل مخزن supabase
+_backend = get_state_backend()
+
+# كاش LRU محدود لكل القراءات (services/state_cache.py)؛ كل كتابة هنا تحدّثه write-through.
+# لا يُستخدم فوق مخزن memory (قاموس داخل العملية أصلًا).
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "10000"))
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "30"))
+STATE_CACHE_MAX_BYTES = int(os.getenv("STATE_CACHE_MAX_MB", "32")) * 1024 * 1024
+_CACHE = StateCache(STATE_CACHE_SIZE if _backend.cacheable else 1, STATE_CACHE_TTL, STATE_CACHE_MAX_BYTES)
+
+# كتابة لا تغيّر شيئًا لا تُرسل: vars متطابقة بايتًا بايتًا، أو الفرق الوحيد تمديد __state_exp
+# بأقل من STATE_EXP_SLACK ثانية (set_kv/set_state تمدّده مع كل خطوة)
+STATE_EXP_SLACK = float(os.getenv("STATE_EXP_SLACK_SECONDS", "300"))
+_noop_skipped = 0
+
+def _fingerprint(vars_dict: Dict[str, Any]) -> str:
+    return json.dumps(vars_dict, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+
+def _is_noop(old: Optional[Dict[str, Any]], new: Dict[str, Any], expires_at: Optional[datetime]) -> bool:
+    if old is None:
+        return False
+    if _fingerprint(old) == _fingerprint(new):
+        # expires_at بلا __state_exp في vars: لا نعرف القيمة المخزّنة فنكتب
+        return expires_at is None
+    o, n = dict(old), dict(new)
+    oe, ne = _from_iso(o.pop("__state_exp", None)), _from_iso(n.pop("__state_exp", None))
+    if oe is None or ne is None or _fingerprint(o) != _fingerprint(n):
+        return False
+    return timedelta(0) <= ne - oe < timedelta(seconds=STATE_EXP_SLACK)
+
+def _skip_noop() -> None:
+    global _noop_skipped
+    _noop_skipped += 1
+
+def _cache_write(user_id: int, state_key: str, vars_dict: Optional[Dict[str, Any]]) -> None:
+    if _backend.cacheable:
+        _CACHE.write(user_id, state_key, vars_dict)
 
-# ← إضافة: منطق إعادة المحاولة مع backoff خفيف
-_RETRIES = 3
-_BACKOFF = 0.8  # seconds
+def _select_row(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> Optional[Dict[str, Any]]:
+    vars_dict = _backend.load(user_id, state_key)
+    return None if vars_dict is None else {"user_id": user_id, "state_key": state_key, "vars": vars_dict}
+
+def _upsert_row(user_id: int, *, vars_dict: Dict[str, Any], expires_at: Optional[datetime], state_key: str = DEFAULT_STATE_KEY) -> None:
+    try:
+        _backend.save(user_id, state_key, vars_dict, _to_iso(expires_at) if expires_at is not None else None)
+    except Exception:
+        _cache_write(user_id, state_key, None)  # ربما نُفّذت الكتابة رغم الخطأ
+        raise
+    _cache_write(user_id, state_key, vars_dict)
+
+def _delete_raw(user_id: int, state_key: str) -> None:
+    try:
+        _backend.delete(user_id, state_key)
+    except Exception:
+        _cache_write(user_id, state_key, None)
+        raise
+    _cache_write(user_id, state_key, {})
+
+def _patch_raw(user_id: int, state_key: str, set_=None, delete=None, keep=None,
+               expires_at: Optional[datetime] = None) -> None:
+    # تعديل ذرّي برحلة واحدة (state_set_keys/state_del_keys في supabase، معاملة في sqlite)
+    try:
+        result = _backend.patch(user_id, state_key, set_, delete, keep,
+                                _to_iso(expires_at) if expires_at is not None else None)
+    except Exception:
+        _cache_write(user_id, state_key, None)
+        raise
+    # vars الناتجة → write-through؛ None (غير معروفة) → إبطال
+    _cache_write(user_id, state_key, result)
+
+def _load_vars(user_id: int, state_key: str) -> Dict[str, Any]:
+    """vars من الكاش أو من المخزن (مع تخزين النتيجة، و{} للصف غير الموجود)."""
+    if not _backend.cacheable:
+        row = _select_row(user_id, state_key=state_key)
+        return dict(row["vars"]) if row else {}
+    cached = _CACHE.get(user_id, state_key)
+    if cached is not None:
+        return cached
+    gen = _CACHE.generation(user_id, state_key)
+    row = _select_row(user_id, state_key=state_key)
+    vars_dict = dict(row.get("vars") or {}) if row else {}
+    _CACHE.put(user_id, state_key, vars_dict, gen)
+    return vars_dict
 
-def _with_retry(op, *args, **kwargs):
-    for i in range(_RETRIES):
+def _delete_row(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> None:
+    entry = _session_entry(user_id, state_key, load=False)
+    if entry is not None:
+        entry.set({}, None)
+        return
+    _delete_raw(user_id, state_key)
+
+# ===================== جلسة حالة لكل تحديث =====================
+# داخل معالجة تحديث تيليغرام واحد (services/state_adapter.StateSessionMiddleware):
+# أول وصول يقرأ صف user_state مرة واحدة، وكل القراءات/الكتابات اللاحقة في الذاكرة،
+# ثم upsert/delete واحد عند انتهاء الهاندلر (ولا شيء إن لم يتغير).
+# خارج الجلسة (خيوط الخلفية، next_step handlers) يبقى السلوك المباشر كما هو.
+
+_session = threading.local()
+
+class _Entry:
+    __slots__ = ("vars", "orig", "expires_at", "dirty")
+
+    def __init__(self, vars_dict: Optional[Dict[str, Any]]):
+        self.vars = vars_dict
+        self.orig = dict(vars_dict) if vars_dict is not None else None
+        self.expires_at: Optional[datetime] = None
+        self.dirty = False
+
+    def set(self, vars_dict: Dict[str, Any], expires_at: Optional[datetime]) -> None:
+        self.vars = dict(vars_dict)
+        self.expires_at = expires_at
+        self.dirty = True
+
+def _session_entry(user_id: int, state_key: str, *, load: bool = True) -> Optional[_Entry]:
+    rows = getattr(_session, "rows", None)
+    if rows is None:
+        return None
+    k = (int(user_id), state_key)
+    entry = rows.get(k)
+    if entry is None:
+        entry = rows[k] = _Entry(None)
+    if entry.vars is None and load:
+        entry.vars = _load_vars(user_id, state_key)
+        entry.orig = dict(entry.vars)
+    return entry
+
+def begin_session() -> None:
+    """يبدأ جلسة حالة للخيط الحالي (تداخل الاستدعاءات مسموح)."""
+    if getattr(_session, "rows", None) is None:
+        _session.rows = {}
+        _session.depth = 0
+    _session.depth += 1
+
+def end_session() -> None:
+    """ينهي الجلسة ويكتب التغييرات: كتابة واحدة على الأكثر لكل (مستخدم، مفتاح)."""
+    if getattr(_session, "rows", None) is None:
+        return
+    _session.depth -= 1
+    if _session.depth > 0:
+        return
+    rows, _session.rows = _session.rows, None
+    for (user_id, state_key), entry in rows.items():
+        if not entry.dirty:
+            continue
+        if _is_noop(entry.orig, entry.vars, entry.expires_at):
+            _skip_noop()
+            continue
         try:
-            return op(*args, **kwargs)
+            if entry.vars:
+                _flush_patch(user_id, state_key, entry)
+            elif entry.orig != {}:
+                # orig=None: حذف بدون قراءة سابقة — لا نعرف إن كان الصف موجودًا
+                _delete_raw(user_id, state_key)
         except Exception as e:
-            if i == _RETRIES - 1:
-                raise
-            logging.warning("state_service retry %s/%s: %s", i + 1, _RETRIES, e)
-            time.sleep(_BACKOFF * (i + 1))
+            # قيم الجلسة لم تُحفظ: لا نترك الكاش يخدمها كأنها في المخزن
+            _cache_write(user_id, state_key, None)
+            logging.warning("state_service session flush failed for %s/%s: %s", user_id, state_key, e)
+
+def _flush_patch(user_id: int, state_key: str, entry: _Entry) -> None:
+    # فرق الجلسة فقط (مفاتيح تغيّرت/حُذفت) في تعديل واحد — لا يدهس كتابات متزامنة لمفاتيح أخرى
+    if entry.orig is None:
+        set_, delete, keep = entry.vars, None, ()
+    else:
+        set_ = {k: v for k, v in entry.vars.items() if k not in entry.orig or entry.orig[k] != v}
+        delete, keep = [k for k in entry.orig if k not in entry.vars], None
+    expires_at = entry.expires_at or _from_iso(entry.vars.get("__state_exp"))
+    _patch_raw(user_id, state_key, set_, delete, keep, expires_at)
 
-def _select_row(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> Optional[Dict[str, Any]]:
-    tbl = get_table(TABLE)
-    resp = _with_retry(
-        tbl.select("*").eq("user_id", user_id).eq("state_key", state_key).limit(1).execute
-    )
-    data = getattr(resp, "data", None) or []
-    return data[0] if data else None
-
-def _upsert_row(user_id: int, *, vars_dict: Dict[str, Any], expires_at: Optional[datetime], state_key: str = DEFAULT_STATE_KEY) -> Dict[str, Any]:
-    tbl = get_table(TABLE)
-    payload = {
-        "user_id": user_id,
-        "state_key": state_key,
-        "vars": vars_dict,
-    }
-    if expires_at is not None:
-        payload["expires_at"] = _to_iso(expires_at)
-    # on_conflict requires UNIQUE(user_id,state_key)
-    resp = _with_retry(tbl.upsert(payload, on_conflict="user_id,state_key").execute)
-    return getattr(resp, "data", None) or []
+class state_session:
+    """with state_session(): ... — نفس begin_session/end_session كسياق."""
 
-def _delete_row(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> None:
-    tbl = get_table(TABLE)
-    _with_retry(tbl.delete().eq("user_id", user_id).eq("state_key", state_key).execute)
+    def __enter__(self):
+        begin_session()
+        return self
+
+    def __exit__(self, *exc):
+        end_session()
+        return False
 
 # ===================== Vars helpers =====================
 
 def _get_vars(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> Dict[str, Any]:
-    row = _select_row(user_id, state_key=state_key)
-    return dict(row.get("vars") or {}) if row else {}
+    entry = _session_entry(user_id, state_key)
+    if entry is not None:
+        return dict(entry.vars)
+    return _load_vars(user_id, state_key)
 
 def _set_vars(user_id: int, vars_dict: Dict[str, Any], *, state_key: str = DEFAULT_STATE_KEY, ttl_minutes: Optional[int] = None) -> None:
+    entry = _session_entry(user_id, state_key, load=False)
+    if entry is not None:
+        entry.set(vars_dict, _expires_from_ttl(ttl_minutes))
+        return
     # إذا كانت vars فارغة نحذف الصف تمامًا
     if not vars_dict:
         _delete_row(user_id, state_key=state_key)
@@ -99,44 +249,73 @@ def _set_vars(user_id: int, vars_dict: Dict[str, Any], *, state_key: str = DEFAU
     expires_at = _expires_from_ttl(ttl_minutes) or _from_iso(vars_dict.get("__state_exp"))
     _upsert_row(user_id, vars_dict=vars_dict, expires_at=expires_at, state_key=state_key)
 
+# ===================== تعديل ذرّي =====================
+# كل تعديل = رحلة واحدة للمخزن: دمج/حذف/إبقاء مفاتيح وضبط expires_at معًا
+# (supabase: state_set_keys في 0007_state_rpcs.sql)، فلا تضيع كتابات متزامنة لنفس المستخدم.
+
+def _patch(user_id: int, *, state_key: str = DEFAULT_STATE_KEY, set_: Optional[Dict[str, Any]] = None,
+           delete=None, keep=None, ttl_minutes: Optional[int] = None) -> None:
+    """
+    يعدّل vars: keep (الإبقاء على هذه المفاتيح فقط) ثم delete ثم دمج set_، مع expires_at من ttl.
+    داخل جلسة التحديث يتم في الذاكرة؛ خارجها عبر تعديل واحد في المخزن.
+    """
+    entry = _session_entry(user_id, state_key)
+    expires_at = _expires_from_ttl(ttl_minutes)
+    if entry is not None:
+        entry.set(_apply(dict(entry.vars), set_, delete, keep), expires_at or entry.expires_at)
+        return
+    cached = _CACHE.get(user_id, state_key) if _backend.cacheable else None
+    if cached is not None and _is_noop(cached, _apply(dict(cached), set_, delete, keep), expires_at):
+        _skip_noop()
+        return
+    _patch_raw(user_id, state_key, set_, delete, keep, expires_at)
+
+def touch_state(user_id: int, *, state_key: str = DEFAULT_STATE_KEY, ttl_minutes: int = 120) -> None:
+    """يمدّد صلاحية الحالة (expires_at و __state_exp) دون قراءة أو تعديل باقي المتغيرات."""
+    exp = _expires_from_ttl(ttl_minutes)
+    entry = _session_entry(user_id, state_key)
+    if entry is not None:
+        vars_dict = dict(entry.vars)
+        if "__state_exp" in vars_dict:
+            vars_dict["__state_exp"] = _to_iso(exp)
+        if vars_dict:
+            entry.set(vars_dict, exp)
+        return
+    try:
+        _backend.touch(user_id, state_key, _to_iso(exp))
+    finally:
+        _cache_write(user_id, state_key, None)
+
 # ===================== Public API =====================
 
 def set_kv(user_id: int, key: str, value: Any, *, state_key: str = DEFAULT_STATE_KEY, ttl_minutes: Optional[int] = 120) -> None:
-    """خزن مفتاح/قيمة داخل vars، ويُحدِّث وقت الانتهاء."""
-    vars_dict = _get_vars(user_id, state_key=state_key)
-    vars_dict[key] = value
+    """خزن مفتاح/قيمة داخل vars، ويُحدِّث وقت الانتهاء."""
+    patch = {key: value}
     if ttl_minutes is not None:
-        vars_dict["__state_exp"] = _to_iso(_expires_from_ttl(ttl_minutes))
-    _set_vars(user_id, vars_dict, state_key=state_key, ttl_minutes=ttl_minutes)
+        patch["__state_exp"] = _to_iso(_expires_from_ttl(ttl_minutes))
+    _patch(user_id, state_key=state_key, set_=patch, ttl_minutes=ttl_minutes)
 
 def get_kv(user_id: int, key: str, default=None, *, state_key: str = DEFAULT_STATE_KEY):
     """اقرأ مفتاحاً من vars مع مراعاة مدة الصلاحية للحالة العامة إذا وُجدت."""
     vars_dict = _get_vars(user_id, state_key=state_key)
     exp = _from_iso(vars_dict.get("__state_exp"))
     if exp and exp < _utcnow():
-        # انتهت الصلاحية: امسح الحالة العامة فقط
-        vars_dict.pop("__state", None)
-        vars_dict.pop("__state_exp", None)
-        _set_vars(user_id, vars_dict, state_key=state_key, ttl_minutes=None)
+        # انتهت الصلاحية: لا كتابة في مسار القراءة — الكنس بالجملة عبر expires_at
+        # (cleanup_service.sweep_expired_state)
         return default
     return vars_dict.get(key, default)
 
 def set_state(user_id: int, value: str, *, state_key: str = DEFAULT_STATE_KEY, ttl_minutes: int = 120) -> None:
     """اضبط الحالة النصية الحالية."""
-    vars_dict = _get_vars(user_id, state_key=state_key)
-    vars_dict["__state"] = value
     exp = _expires_from_ttl(ttl_minutes)
-    vars_dict["__state_exp"] = _to_iso(exp)
-    _set_vars(user_id, vars_dict, state_key=state_key, ttl_minutes=ttl_minutes)
+    _patch(user_id, state_key=state_key, set_={"__state": value, "__state_exp": _to_iso(exp)},
+           ttl_minutes=ttl_minutes)
 
 def get_state_key(user_id: int, default=None, *, state_key: str = DEFAULT_STATE_KEY):
     """اقرأ الحالة النصية الحالية؛ ترجع default إن لم توجد أو إن انتهت صلاحيتها."""
     vars_dict = _get_vars(user_id, state_key=state_key)
     exp = _from_iso(vars_dict.get("__state_exp"))
     if exp and exp < _utcnow():
-        vars_dict.pop("__state", None)
-        vars_dict.pop("__state_exp", None)
-        _set_vars(user_id, vars_dict, state_key=state_key, ttl_minutes=None)
         return default
     return vars_dict.get("__state", default)
 
@@ -146,16 +325,8 @@ def clear_state(user_id: int, key: Optional[str] = None, *, state_key: str = DEF
     لو محدد key: احذف المفتاح المحدد من vars.
     إذا أصبحت vars فارغة بعد الحذف نحذف الصف بالكامل.
     """
-    vars_dict = _get_vars(user_id, state_key=state_key)
-    if key is None:
-        vars_dict.pop("__state", None)
-        vars_dict.pop("__state_exp", None)
-    else:
-        vars_dict.pop(key, None)
-    if vars_dict:
-        _set_vars(user_id, vars_dict, state_key=state_key, ttl_minutes=None)
-    else:
-        _delete_row(user_id, state_key=state_key)
+    keys = ("__state", "__state_exp") if key is None else (key,)
+    _patch(user_id, state_key=state_key, delete=keys)
 
 def pop_state(user_id: int, default=None, *, state_key: str = DEFAULT_STATE_KEY):
     val = get_state_key(user_id, default, state_key=state_key)
@@ -175,42 +346,43 @@ def set_var(user_id: int, key: str, value, *, state_key: str = DEFAULT_STATE_KEY
 # ====== واجهة مستوى أعلى لتعامل القاموس بالكامل (باستثناء المفاتيح الداخلية) ======
 _INTERNAL_KEYS = {"__state", "__state_exp"}
 
-# ← إضافة: كاش خفيف لقراءات get_data فقط
-_CACHE = {}
-_CACHE_TTL = 2.0  # ثانيتان
-
-def _cache_key(user_id, state_key):
-    return f"{user_id}:{state_key or 'global'}"
-
-def _cache_get(user_id, state_key):
-    t, val = _CACHE.get(_cache_key(user_id, state_key), (0, None))
-    return val if (time.time() - t) < _CACHE_TTL else None
-
-def _cache_set(user_id, state_key, val):
-    _CACHE[_cache_key(user_id, state_key)] = (time.time(), val)
-
 def get_data(user_id: int, *, state_key: str = DEFAULT_STATE_KEY) -> Dict[str, Any]:
     """يرجع نسخة من المتغيرات العامة (بدون مفاتيح النظام)."""
-    cached = _cache_get(user_id, state_key)
-    if cached is not None:
-        return cached
     try:
-        row = _select_row(user_id, state_key=state_key)
+        vars_dict = _get_vars(user_id, state_key=state_key)
     except Exception:
         # فشل الشبكة: ارجع حالة فارغة بدل الكراش
         return {}
-    vars_dict = dict(row.get("vars") or {}) if row else {}
-    result = {k: v for k, v in vars_dict.items() if k not in _INTERNAL_KEYS}
-    _cache_set(user_id, state_key, result)
-    return result
+    return {k: v for k, v in vars_dict.items() if k not in _INTERNAL_KEYS}
+
+def drop_cached_state(user_id: int, state_key: str = DEFAULT_STATE_KEY) -> None:
+    """إبطال صف من كاش الحالة بعد حذفه خارج هذه الوحدة."""
+    _cache_write(user_id, state_key, None)
+
+def prefetch_state(user_id: int, state_key: str = DEFAULT_STATE_KEY) -> bool:
+    """يسخّن كاش الحالة لصف واحد (services/prefetch)؛ False إن كان المخزن غير قابل للكاش."""
+    if not _backend.cacheable:
+        return False
+    _load_vars(user_id, state_key)
+    return True
+
+def purge_expired_batch(limit: int = 500) -> List[Dict[str, Any]]:
+    """يحذف حتى limit صفًا منتهيًا (expires_at) من المخزن ويُبطلها من الكاش."""
+    rows = _backend.purge_expired(limit)
+    for r in rows:
+        _cache_write(r.get("user_id"), r.get("state_key") or DEFAULT_STATE_KEY, None)
+    return rows
+
+def state_cache_stats() -> Dict[str, Any]:
+    """إحصاءات كاش الحالة: الحجم/الذاكرة/الإصابة/الطرد + الكتابات المتخطّاة (لا تغيير)."""
+    out = _CACHE.stats()
+    out["noop_skipped"] = _noop_skipped
+    return out
 
 def set_data(user_id: int, data: Dict[str, Any], *, state_key: str = DEFAULT_STATE_KEY, ttl_minutes: int = 120) -> None:
     """يحفظ القاموس كاملاً مع الإبقاء على مفاتيح النظام كما هي وتحديث وقت الانتهاء."""
-    vars_dict = _get_vars(user_id, state_key=state_key)
-    # أبقِ مفاتيح النظام
-    sys_part = {k: v for k, v in vars_dict.items() if k in _INTERNAL_KEYS}
-    merged = {**sys_part, **(data or {})}
-    _set_vars(user_id, merged, state_key=state_key, ttl_minutes=ttl_minutes)
+    # أبقِ مفاتيح النظام فقط ثم ادمج data (ذرّيًا عبر p_keep على الخادم)
+    _patch(user_id, state_key=state_key, set_=dict(data or {}), keep=_INTERNAL_KEYS, ttl_minutes=ttl_minutes)
 
 
 # ===== حذف كل حالة المستخدم فورًا (يمسح الصف) =====
@@ -0,0 +1,174 @@
+# services/ttl_dict.py
+# -*- coding: utf-8 -*-
+"""
+قواميس محدودة داخل العملية بديلًا عن dict على مستوى الموديول التي تكبر بلا نهاية.
+
+- TTLDict: انتهاء لكل مفتاح (ttl ثانية من آخر كتابة، أو من آخر وصول مع refresh_on_get)،
+  حد أقصى max_size (الأقدم استخدامًا يُطرد)، وكنس دوري للمنتهي كل sweep_every ثانية
+  يتم ضمن الكتابات نفسها (بلا خيط إضافي).
+- BoundedHistory: TTLDict قيمه قوائم حلقية بطول أقصى maxlen (سجل التنقل history):
+  history[uid] = [...] و history.setdefault(uid, []).append(...) تبقى كما هي، والقائمة
+  تحتفظ بآخر maxlen عنصر فقط (isinstance(..., list) يبقى صحيحًا).
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Dict, Hashable, Iterator, Optional, Tuple
+
+_MISSING = object()
+
+
+class TTLDict(MutableMapping):
+    def __init__(self, ttl: float, max_size: int = 10000, *, refresh_on_get: bool = False,
+                 sweep_every: Optional[float] = None):
+        self.ttl = float(ttl)
+        self.max_size = max(1, int(max_size))
+        self.refresh_on_get = refresh_on_get
+        self.sweep_every = float(sweep_every if sweep_every is not None else max(self.ttl, 30.0))
+        self._lock = threading.RLock()
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._next_sweep = time.monotonic() + self.sweep_every
+        self.expired = 0
+        self.evictions = 0
+
+    # ---------- داخلي ----------
+    def _live(self, key, now: float):
+        item = self._data.get(key)
+        if item is None:
+            return _MISSING
+        if item[0] <= now:
+            del self._data[key]
+            self.expired += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        if self.refresh_on_get:
+            self._data[key] = (now + self.ttl, item[1])
+        return item[1]
+
+    def _maybe_sweep(self, now: float) -> None:
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_every
+        dead = [k for k, (exp, _) in self._data.items() if exp <= now]
+        for k in dead:
+            del self._data[k]
+        self.expired += len(dead)
+
+    def _wrap(self, value):
+        return value
+
+    # ---------- MutableMapping ----------
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._live(key, time.monotonic())
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._maybe_sweep(now)
+            self._data[key] = (now + self.ttl, self._wrap(value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __delitem__(self, key) -> None:
+        with self._lock:
+            del self._data[key]
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return self._live(key, time.monotonic()) is not _MISSING
+
+    def __iter__(self) -> Iterator:
+        now = time.monotonic()
+        with self._lock:
+            keys = [k for k, (exp, _) in self._data.items() if exp > now]
+        return iter(keys)
+
+    def __len__(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for exp, _ in self._data.values() if exp > now)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._live(key, time.monotonic())
+        return default if value is _MISSING else value
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            value = self._live(key, time.monotonic())
+            if value is not _MISSING:
+                del self._data[key]
+                return value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            value = self._live(key, time.monotonic())
+            if value is _MISSING:
+                self[key] = default
+                value = self._data[key][1]
+            return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._data), "max_size": self.max_size, "ttl": self.ttl,
+                    "expired": self.expired, "evictions": self.evictions}
+
+
+class _Ring(list):
+    """list تحتفظ بآخر maxlen عنصر فقط."""
+    __slots__ = ("maxlen",)
+
+    def __init__(self, items=(), maxlen: int = 20):
+        super().__init__(items)
+        self.maxlen = maxlen
+        self._trim()
+
+    def _trim(self) -> None:
+        extra = len(self) - self.maxlen
+        if extra > 0:
+            del self[:extra]
+
+    def append(self, item) -> None:
+        super().append(item)
+        self._trim()
+
+    def extend(self, items) -> None:
+        super().extend(items)
+        self._trim()
+
+    def insert(self, index, item) -> None:
+        super().insert(index, item)
+        self._trim()
+
+    def __iadd__(self, items):
+        super().__iadd__(items)
+        self._trim()
+        return self
+
+
+class BoundedHistory(TTLDict):
+    def __init__(self, maxlen: int = 20, ttl: float = 6 * 3600, max_size: int = 50000):
+        super().__init__(ttl, max_size, refresh_on_get=True)
+        self.maxlen = max(1, int(maxlen))
+
+    def _wrap(self, value):
+        if isinstance(value, list) and not isinstance(value, _Ring):
+            return _Ring(value, self.maxlen)
+        return value
@@ -3,22 +3,27 @@
 import logging
 import uuid
 import time
-from httpx import ReadError
 from postgrest.exceptions import APIError
 
 from config import SUPABASE_TABLE_NAME
 from datetime import datetime, timedelta
 
+from database.batch_writer import insert_row
 from database.db import (
     get_table,
     DEFAULT_TABLE,
     # واجهات RPC الذرّية
     get_available_balance as _db_get_available_balance,
+    get_wallet as _db_get_wallet,
+    get_user_row as _db_get_user_row,
+    peek_user_row as _db_peek_user_row,
+    wallet_snapshot as _db_wallet_snapshot,
     create_hold_rpc as _rpc_create_hold,
     capture_hold_rpc as _rpc_capture_hold,
     release_hold_rpc as _rpc_release_hold,
     transfer_amount_rpc as _rpc_transfer_amount,
     try_deduct_rpc as _rpc_try_deduct,
+    with_retry as _with_retry,
 )
 
 # أسماء الجداول
@@ -42,22 +47,12 @@ def _is_uuid_like(x) -> bool:
         return False
 
 
-def _exec(q, tries: int = 3, base_delay: float = 0.4):
+def _exec(q):
     """
-    ينفّذ q.execute() مع إعادة محاولة تلقائية عند مشاكل الشبكة (HTTPX ReadError).
-    يحافظ على منطق الدوال كما هو بدون تغييره.
+    ينفّذ q.execute() بالسياسة الموحّدة لإعادة المحاولة/قاطع الدائرة (database/db.py).
+    أخطاء PostgREST المنطقية (APIError) تُرفع فورًا كما كانت.
     """
-    for i in range(tries):
-        try:
-            return q.execute()
-        except ReadError as e:
-            logging.warning("[NET] ReadError (try %d/%d): %s", i + 1, tries, e)
-            time.sleep(base_delay * (2 ** i))
-            continue
-        except APIError:
-            # أخطاء PostgREST المنطقية ليست شبكة — أعِد رفعها فورًا
-            raise
-    raise ReadError("Supabase execute() retry exhausted")
+    return _with_retry(q.execute)
 
 
 # ================= عمليات المستخدم =================
@@ -74,14 +69,19 @@ def register_user_if_not_exist(user_id: int, name: str = "مستخدم") -> None
         return
 
 def get_balance(user_id: int) -> int:
-    # نُبقيها كما كانت: تُرجع الرصيد الكامل (بدون طرح المحجوز)
+    # نُبقيها كما كانت: تُرجع الرصيد الكامل (بدون طرح المحجوز) — من كاش المستخدمين
+    row = _db_get_user_row(user_id)
+    return row["balance"] if row else 0
+
+def _fresh_balance(user_id: int) -> int:
+    # قراءة مباشرة من القاعدة (بدون كاش) قبل قراءة-ثم-تحديث
     q = (
         get_table(USER_TABLE)
         .select("balance")
         .eq("user_id", user_id)
         .limit(1)
     )
-    response = _exec(q)  # ← إعادة محاولة عند ReadError
+    response = _exec(q)  # ← إعادة محاولة موحّدة عند أخطاء الشبكة
     return response.data[0]["balance"] if response.data else 0
 
 def get_available_balance(user_id: int) -> int:
@@ -91,6 +91,65 @@ def get_available_balance(user_id: int) -> int:
     """
     return int(_db_get_available_balance(user_id))
 
+def get_wallet_snapshot(user_id: int, name: str = None) -> dict:
+    """
+    لقطة المحفظة في رحلة واحدة عبر RPC wallet_snapshot:
+      {balance, held, available, discount_percent, admin_percent, referral_percent, banned, ...}
+    لو مُرّر name يُسجَّل المستخدم/يُحدَّث اسمه (مثل register_user_if_not_exist).
+    لو الدالة غير منشورة بعد نرجع للاستدعاءات القديمة بنفس شكل النتيجة.
+    بلا name، وإن كانت الكاشات ساخنة (services/prefetch) تُبنى اللقطة محليًا بلا رحلة.
+    """
+    if not name:
+        snap = _local_wallet_snapshot(user_id)
+        if snap is not None:
+            return snap
+    try:
+        return _db_wallet_snapshot(user_id, name)
+    except Exception as e:
+        logging.warning("[wallet_service] wallet_snapshot RPC failed, using legacy calls: %s", e)
+
+    from services.discount_service import apply_discount_stacked
+    from services.ban_service import is_banned
+
+    if name:
+        register_user_if_not_exist(user_id, name)
+    res = _db_get_wallet(user_id)
+    row = (getattr(res, "data", None) or [{}])[0]
+    _, disc = apply_discount_stacked(user_id, 0)
+    return _compose_snapshot(user_id, row, disc, is_banned(user_id))
+
+def _local_wallet_snapshot(user_id: int):
+    """اللقطة من كاش المستخدمين + كاش الخصومات + كاش الحظر فقط؛ None إن كان أيّها باردًا."""
+    from services.discount_service import active_cache_warm, apply_discount_stacked
+    from services.ban_service import cached_ban
+
+    ban = cached_ban(user_id)
+    if ban is None or not active_cache_warm():
+        return None
+    row = _db_peek_user_row(user_id)
+    if row is None:
+        return None
+    _, disc = apply_discount_stacked(user_id, 0)
+    return _compose_snapshot(user_id, row, disc, ban)
+
+def _compose_snapshot(user_id: int, row: dict, disc: dict, ban) -> dict:
+    balance = int(row.get("balance") or 0)
+    held = int(row.get("held") or 0)
+    pcts = {b["source"]: int(b["percent"]) for b in disc.get("breakdown", [])}
+    banned, until, reason = ban
+    return {
+        "user_id": user_id,
+        "balance": balance,
+        "held": held,
+        "available": balance - held,
+        "admin_percent": pcts.get("admin", 0),
+        "referral_percent": pcts.get("referral", 0),
+        "discount_percent": int(disc.get("percent") or 0),
+        "banned": bool(banned),
+        "banned_until": until,
+        "ban_reason": reason,
+    }
+
 def _update_balance(user_id: int, delta: int) -> bool:
     """
     تعديل الرصيد داخليًا:
@@ -109,7 +168,7 @@ def _update_balance(user_id: int, delta: int) -> bool:
         return bool(resp.data)
     else:
         # زيادة الرصيد (غير حرِجة من ناحية السالب)
-        current = get_balance(user_id)
+        current = _fresh_balance(user_id)
         new_balance = current + delta
         get_table(USER_TABLE).update({"balance": new_balance}).eq("user_id", user_id).execute()
         return True
@@ -138,7 +197,7 @@ def record_transaction(user_id: int, amount: int, description: str) -> None:
         "description": description,
         "timestamp": datetime.utcnow().isoformat(),
     }
-    get_table(TRANSACTION_TABLE).insert(data).execute()
+    insert_row(TRANSACTION_TABLE, data, durability="commit")  # سجل مالي: المنادي يرى الفشل
 
 def transfer_balance(from_user_id: int, to_user_id: int, amount: int, fee: int = 0) -> bool:
     """
@@ -213,7 +272,7 @@ def add_purchase(user_id: int, product_id, product_name: str, price: int, player
         "created_at": datetime.utcnow().isoformat(),
         "expire_at": expire_at.isoformat(),
     }
-    get_table(PURCHASES_TABLE).insert(data).execute()
+    insert_row(PURCHASES_TABLE, data)
     deduct_balance(user_id, int(price), f"شراء {product_name}")
 
 
@@ -454,8 +513,8 @@ def get_wallet_transfers_only(user_id: int, limit: int = 50):
     return out
 
 
-# ===== تسجيلات إضافية في الجداول المتخصصة (Write-through) =====
-# (تبقى كما هي — بدون تغيير)
+# ===== تسجيلات إضافية في الجداول المتخصصة =====
+# جداول إلحاقية: تُكتب عبر الكاتب المؤجّل (database/batch_writer) كدفعات متعددة الصفوف.
 
 def add_game_purchase(user_id: int, product_id, product_name: str, price: int, player_id: str, created_at: str = None):
     pid = int(product_id) if product_id else None
@@ -475,7 +534,7 @@ def add_game_purchase(user_id: int, product_id, product_name: str, price: int, p
         "player_id": str(player_id or ""),
         "created_at": (created_at or datetime.utcnow().isoformat()),
     }
-    get_table("game_purchases").insert(data).execute()
+    insert_row("game_purchases", data)
 
 def add_bill_or_units_purchase(user_id: int, bill_name: str, price: int, number: str, created_at: str = None):
     data = {
@@ -486,7 +545,7 @@ def add_bill_or_units_purchase(user_id: int, bill_name: str, price: int, number:
         "number": number
     }
     try:
-        get_table("bill_and_units_purchases").insert(data).execute()
+        insert_row("bill_and_units_purchases", data)
     except Exception:
         pass
 
@@ -500,7 +559,7 @@ def add_internet_purchase(user_id: int, provider_name: str, price: int, phone: s
         "speed": speed
     }
     try:
-        get_table("internet_providers_purchases").insert(data).execute()
+        insert_row("internet_providers_purchases", data)
     except Exception:
         pass
 
@@ -513,7 +572,7 @@ def add_cash_transfer_purchase(user_id: int, transfer_name: str, price: int, num
         "number": number
     }
     try:
-        get_table("cash_transfer_purchases").insert(data).execute()
+        insert_row("cash_transfer_purchases", data)
     except Exception:
         pass
 
@@ -526,7 +585,7 @@ def add_companies_transfer_purchase(user_id: int, company_name: str, price: int,
         "beneficiary_number": beneficiary_number
     }
     try:
-        get_table("companies_transfer_purchases").insert(data).execute()
+        insert_row("companies_transfer_purchases", data)
     except Exception:
         pass
 
@@ -539,7 +598,7 @@ def add_university_fees_purchase(user_id: int, university_name: str, price: int,
         "university_id": university_id
     }
     try:
-        get_table("university_fees_purchases").insert(data).execute()
+        insert_row("university_fees_purchases", data)
     except Exception:
         pass
 
@@ -551,7 +610,7 @@ def add_ads_purchase(user_id: int, ad_name: str, price: int, created_at: str = N
         "created_at": (created_at or datetime.utcnow().isoformat())
     }
     try:
-        get_table("ads_purchases").insert(data).execute()
+        insert_row("ads_purchases", data)
     except Exception:
         pass
 
@@ -0,0 +1,58 @@
+# tests/test_queue_lanes.py
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta, timezone
+
+from services import queue_lanes
+from services.queue_lanes import LaneClock, schedule
+
+NOW = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _rows(lane, n, start_id, age=5):
+    created = (NOW - timedelta(seconds=age)).isoformat()
+    return [{"id": start_id + i, "lane": lane, "priority": 0, "created_at": created} for i in range(n)]
+
+
+def _serve(rows, clock, slots):
+    served = {}
+    rows = list(rows)
+    for _ in range(slots):
+        head = schedule(rows, NOW, clock=clock)[0]
+        rows.remove(head)
+        clock.served(head["lane"])
+        served[head["lane"]] = served.get(head["lane"], 0) + 1
+    return served
+
+
+def test_backlogged_lanes_share_slots_by_weight(monkeypatch):
+    monkeypatch.setitem(queue_lanes.LANE_WEIGHTS, "recharge", 4)
+    monkeypatch.setitem(queue_lanes.LANE_WEIGHTS, "ads", 1)
+    rows = _rows("recharge", 100, 1) + _rows("ads", 100, 1000)
+
+    served = _serve(rows, LaneClock(), 50)
+
+    # مكان واحد يتحرر في كل دورة: النسبة ≈ 4:1 لا 50:0
+    assert served == {"recharge": 40, "ads": 10}
+
+
+def test_idle_lane_does_not_bank_credit(monkeypatch):
+    monkeypatch.setitem(queue_lanes.LANE_WEIGHTS, "recharge", 4)
+    monkeypatch.setitem(queue_lanes.LANE_WEIGHTS, "ads", 1)
+    clock = LaneClock()
+    _serve(_rows("recharge", 40, 1), clock, 40)
+
+    served = _serve(_rows("recharge", 100, 100) + _rows("ads", 100, 1000), clock, 50)
+
+    assert 8 <= served["ads"] <= 12
+
+
+def test_postponed_request_keeps_sla_age(monkeypatch):
+    monkeypatch.setitem(queue_lanes.LANE_SLA, "purchase", 600)
+    postponed = {
+        "id": 7, "lane": "purchase", "priority": 0,
+        "created_at": NOW.isoformat(),  # التأجيل يعيد كتابة created_at
+        "enqueued_at": (NOW - timedelta(seconds=900)).isoformat(),
+    }
+    rows = _rows("recharge", 5, 1) + [postponed]
+
+    assert schedule(rows, NOW, clock=LaneClock())[0]["id"] == 7